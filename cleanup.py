@@ -50,6 +50,12 @@ def parse_args():
         help='Run cleanups for sightings, fort_sightings, mystery_sightings and raids. Recommended to run this once a minute',
         action='store_true'
     )
+    parser.add_argument(
+        '--archive',
+        dest='archive',
+        help='With --light or --set-cron, archive expired sightings, mystery_sightings and raids to ARCHIVE_DIRECTORY before deleting them.',
+        action='store_true'
+    )
     #parser.add_argument(
     #    '--heavy',
     #    dest='heavy',
@@ -64,13 +70,14 @@ def parse_args():
     )
     return parser.parse_args()
 
-def cron_jobs():
+def cron_jobs(archive=False):
     command = "cd {} && {} {}".format(root_dir, sys.executable, this_file)
     
     cron = CronTab(user=True)
     jobs = []
     
-    job_light = cron.new(command="{} --light >> {}/logs/cron.log 2>&1".format(command, root_dir),comment="{} --light".format(tag))
+    light = "--light --archive" if archive else "--light"
+    job_light = cron.new(command="{} {} >> {}/logs/cron.log 2>&1".format(command, light, root_dir),comment="{} --light".format(tag))
     jobs.append(job_light)
     
     #job_heavy = cron.new(command="{} --heavy >> {}/logs/cron.log 2>&1".format(command, root_dir),comment="{} --heavy".format(tag))
@@ -95,7 +102,7 @@ def main():
     args = parse_args()
 
     if args.show_cron:
-        cron, jobs = cron_jobs()
+        cron, jobs = cron_jobs(args.archive)
         print("-" * 53)
         print("The following cron jobs will be added to your crontab")
         print("-" * 53)
@@ -104,7 +111,7 @@ def main():
         print("")
     elif args.set_cron:
         remove_jobs()
-        cron, jobs = cron_jobs()
+        cron, jobs = cron_jobs(args.archive)
         cron.write()
         print("Crontab changed. Cron jobs added.")
     elif args.unset_cron:
@@ -112,7 +119,7 @@ def main():
         print("Crontab changed. Cron jobs removed.")
     elif args.light:
         log.info("Performing light cleanup.")
-        Cleanup.light()
+        Cleanup.light(archive=args.archive)
     #elif args.heavy:
     #    log.info("Performing heavy cleanup.")
     #    Cleanup.heavy()
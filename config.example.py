@@ -20,6 +20,45 @@ DB_ENGINE = 'sqlite:///db.sqlite'
 ## Reconnect db session after x seconds. It solves lost connection error if DB wait_timeout is set to lower values.
 # DB_POOL_RECYCLE = 600
 
+## The DB processor saves queued items in batches, grouped by type, one transaction per batch.
+## A batch is written once it holds DB_BATCH_SIZE items or DB_BATCH_LATENCY milliseconds
+## have passed since its first item, whichever comes first. When a batch fails it is
+## retried in halves, and items that still fail are appended to DIRECTORY/dead_letters.jsonl
+# DB_BATCH_SIZE = 500
+# DB_BATCH_LATENCY = 1000
+
+## The DB processor reads from two lanes in proportion to these weights: realtime for Pokemon,
+## raids, gyms and pokestops, background for mysteries, weather and spawnpoint bookkeeping.
+# DB_LANE_WEIGHTS = {'realtime': 4, 'background': 1}
+
+## Number of DB processor threads, each with its own connection. Items about the same
+## spawnpoint, fort or weather cell always go to the same thread, so they are saved in order.
+## Keep DB_POOL_SIZE above this. SQLite always uses a single thread.
+# DB_WRITERS = 1
+
+## Spawnpoint updates and failure counts are kept in memory and saved in bulk
+## every SPAWN_FLUSH_INTERVAL seconds.
+# SPAWN_FLUSH_INTERVAL = 5
+
+## Gym sightings that didn't change aren't written again, except for bumping their updated
+## column every FORT_SIGHTING_REFRESH seconds so that cleanup doesn't delete them.
+# FORT_SIGHTING_REFRESH = 600
+
+## Weather reports are kept in memory and saved every WEATHER_FLUSH_INTERVAL seconds,
+## one row per cell. Cells that have no row yet are saved right away.
+# WEATHER_FLUSH_INTERVAL = 60
+
+## Journal DB items to DIRECTORY/journal before they are queued, so that they survive a crash
+## and shutdown doesn't wait for the queue to drain. Unsaved items are replayed on the next start.
+# JOURNAL = False
+## fsync the journal at most every JOURNAL_FSYNC seconds, 0 to fsync after every item.
+## Above 0 items are buffered until the end of each DB batch, a crash loses at most
+## 8 KiB of them, or the last JOURNAL_FSYNC seconds if the whole system goes down.
+# JOURNAL_FSYNC = 1.0
+## items kept in memory per DB processor, the rest are read back from the journal
+# JOURNAL_MEMORY_ITEMS = 100000
+# JOURNAL_SEGMENT_SIZE = 16777216  # bytes
+
 AREA_NAME = 'SLC'     # the city or region you are scanning
 LANGUAGE = 'EN'       # ISO 639-1 codes EN, DE, ES, FR, IT, JA, KO, PT, or ZH for Pokémon/move names
 MAX_CAPTCHAS = 100    # stop launching new visits if this many CAPTCHAs are pending
@@ -296,6 +335,8 @@ TRASH_IDS = (
 # include these Pokémon on the "rare" report
 RARE_IDS = (3, 6, 9, 45, 62, 71, 80, 85, 87, 89, 91, 94, 114, 130, 131, 134)
 
+## Reports only cover the sightings that cleanup keeps. Pokemon are counted per hour, so
+## their counts start at the beginning of the hour REPORT_SINCE falls in.
 from datetime import datetime
 REPORT_SINCE = datetime(2017, 2, 17)  # base reports on data from after this date
 
@@ -786,8 +827,15 @@ MINIMUM_SCORE = 0.4  # the required score after FULL_TIME seconds have passed
 
 
 ### Cleanup
-## Max number of rows to delete in each execution per table. Not recommended to set it too high. It will choke the DB.
-# CLEANUP_LIMIT = 100000
+## Cleanup deletes expired rows in chunks of CLEANUP_CHUNK_SIZE primary keys until none are left,
+## at most CLEANUP_ROWS_PER_SECOND rows per second (0 for no limit). It pauses while the
+## scanner has more than CLEANUP_PAUSE_QUEUE DB items queued, and stops if the scanner stops.
+# CLEANUP_CHUNK_SIZE = 5000
+# CLEANUP_ROWS_PER_SECOND = 20000
+# CLEANUP_PAUSE_QUEUE = 5000
+## Max number of rows to delete per table in each execution, None to catch up every time.
+## It used to default to 100000, set it back to keep each run that short.
+# CLEANUP_LIMIT = None
 
 ## Table specific cleanup times. Set -1.0 to disable
 # CLEANUP_RAIDS_OLDER_THAN_X_HR = 6.0
@@ -795,6 +843,18 @@ MINIMUM_SCORE = 0.4  # the required score after FULL_TIME seconds have passed
 # CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR = 6.0
 # CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR = 24.0
 
+## With `cleanup.py --light --archive`, expired sightings, mystery sightings and raids are
+## saved to compressed files, one per table and hour, before they are deleted. See
+## monocle/archive.py for reading them back. Defaults to DIRECTORY/archive
+# ARCHIVE_DIRECTORY = None
+
+## On PostgreSQL 11+ or MySQL, partition sightings and mystery_sightings by
+## expire_timestamp and first_seen, PARTITION_HOURS per partition. Cleanup then drops
+## whole partitions past the times above instead of deleting rows, fort_sightings are
+## still deleted row by row. Set it before running `alembic upgrade head`, which converts
+## the tables. On MySQL this drops their foreign keys, which partitioned tables can't have.
+# PARTITION_HOURS = None
+
 ### Discord webhook url for sending scan log messages
 #SCAN_LOG_WEBHOOK = None
 
@@ -0,0 +1,35 @@
+"""add unique s2_cell_id to weather
+
+Revision ID: b1c4e7a92d3f
+Revises: 5afaec120529
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1c4e7a92d3f'
+down_revision = '5afaec120529'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('sightings_fk_cellid', 'sightings', type_='foreignkey')
+    op.drop_constraint('mystery_sightings_fk_cellid', 'mystery_sightings', type_='foreignkey')
+    # keep the latest row of each cell
+    op.execute('DELETE FROM weather WHERE id NOT IN ('
+               'SELECT id FROM (SELECT MAX(id) AS id FROM weather GROUP BY s2_cell_id) AS latest)')
+    op.create_unique_constraint('weather_s2_cell_id_unique', 'weather', ['s2_cell_id'])
+    op.create_foreign_key('sightings_fk_cellid', 'sightings', 'weather', ['weather_cell_id'], ['s2_cell_id'])
+    op.create_foreign_key('mystery_sightings_fk_cellid', 'mystery_sightings', 'weather', ['weather_cell_id'], ['s2_cell_id'])
+
+
+def downgrade():
+    op.drop_constraint('sightings_fk_cellid', 'sightings', type_='foreignkey')
+    op.drop_constraint('mystery_sightings_fk_cellid', 'mystery_sightings', type_='foreignkey')
+    op.drop_constraint('weather_s2_cell_id_unique', 'weather', type_='unique')
+    op.create_foreign_key('sightings_fk_cellid', 'sightings', 'weather', ['weather_cell_id'], ['s2_cell_id'])
+    op.create_foreign_key('mystery_sightings_fk_cellid', 'mystery_sightings', 'weather', ['weather_cell_id'], ['s2_cell_id'])
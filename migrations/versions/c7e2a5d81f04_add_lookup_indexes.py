@@ -0,0 +1,35 @@
+"""add lookup indexes
+
+Revision ID: c7e2a5d81f04
+Revises: b1c4e7a92d3f
+Create Date: 2026-10-18 11:02:17.604921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e2a5d81f04'
+down_revision = 'b1c4e7a92d3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # older sightings of a spawn are deleted without KEEP_SPAWNPOINT_HISTORY
+    op.create_index('ix_sightings_spawn_id_expire', 'sightings', ['spawn_id', 'expire_timestamp'], unique=False)
+    op.create_index(op.f('ix_raids_fort_id'), 'raids', ['fort_id'], unique=False)
+    # replaces the index on spawn_id alone
+    op.create_index('ix_mystery_sightings_spawn_id_first_seen', 'mystery_sightings', ['spawn_id', 'first_seen'], unique=False)
+    op.drop_index(op.f('ix_mystery_sightings_spawn_id'), table_name='mystery_sightings')
+    # fort_sightings lookups are covered by fort_id_last_modified_unique
+
+
+def downgrade():
+    op.create_index(op.f('ix_mystery_sightings_spawn_id'), 'mystery_sightings', ['spawn_id'], unique=False)
+    op.drop_index('ix_mystery_sightings_spawn_id_first_seen', table_name='mystery_sightings')
+    # MySQL uses it for the foreign key to forts and refuses to drop it
+    if op.get_bind().dialect.name != 'mysql':
+        op.drop_index(op.f('ix_raids_fort_id'), table_name='raids')
+    op.drop_index('ix_sightings_spawn_id_expire', table_name='sightings')
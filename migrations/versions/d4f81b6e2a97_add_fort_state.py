@@ -0,0 +1,56 @@
+"""add fort_state
+
+Revision ID: d4f81b6e2a97
+Revises: c7e2a5d81f04
+Create Date: 2026-10-18 11:48:05.227139
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sys
+from pathlib import Path
+monocle_dir = str(Path(__file__).resolve().parents[2])
+if monocle_dir not in sys.path:
+    sys.path.append(monocle_dir)
+from monocle import db as db
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f81b6e2a97'
+down_revision = 'c7e2a5d81f04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fort_state',
+    sa.Column('fort_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('sighting_id', db.PRIMARY_HUGE_TYPE, nullable=True),
+    sa.Column('team', db.TINY_TYPE, nullable=True),
+    sa.Column('guard_pokemon_id', sa.SmallInteger(), nullable=True),
+    sa.Column('slots_available', sa.SmallInteger(), nullable=True),
+    sa.Column('is_in_battle', sa.Boolean(), nullable=True),
+    sa.Column('last_modified', sa.Integer(), nullable=True),
+    sa.Column('updated', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['fort_id'], ['forts.id'], ),
+    sa.PrimaryKeyConstraint('fort_id')
+    )
+    op.create_index(op.f('ix_fort_state_updated'), 'fort_state', ['updated'], unique=False)
+    # the latest sighting of each fort, one last time
+    op.execute('''
+        INSERT INTO fort_state (fort_id, sighting_id, team, guard_pokemon_id,
+            slots_available, is_in_battle, last_modified, updated)
+        SELECT fs.fort_id, fs.id, fs.team, fs.guard_pokemon_id,
+            fs.slots_available, fs.is_in_battle, fs.last_modified, fs.updated
+        FROM fort_sightings fs
+        JOIN (
+            SELECT fort_id, MAX(last_modified) AS last_modified
+            FROM fort_sightings
+            GROUP BY fort_id
+        ) latest ON latest.fort_id = fs.fort_id AND latest.last_modified = fs.last_modified
+    ''')
+
+
+def downgrade():
+    op.drop_index(op.f('ix_fort_state_updated'), table_name='fort_state')
+    op.drop_table('fort_state')
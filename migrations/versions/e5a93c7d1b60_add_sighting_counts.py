@@ -0,0 +1,63 @@
+"""add sighting counts
+
+Revision ID: e5a93c7d1b60
+Revises: d4f81b6e2a97
+Create Date: 2026-10-18 12:31:54.640917
+
+"""
+from calendar import timegm
+from collections import Counter
+from time import localtime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a93c7d1b60'
+down_revision = 'd4f81b6e2a97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('sighting_counts_hourly',
+    sa.Column('pokemon_id', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('hour', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('pokemon_id', 'hour')
+    )
+    op.create_index(op.f('ix_sighting_counts_hourly_hour'), 'sighting_counts_hourly', ['hour'], unique=False)
+    op.create_table('sighting_counts_5min',
+    sa.Column('bucket', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+    # count the sightings that are already saved, per local hour like the
+    # scanner, 5 minute buckets never straddle two local hours
+    div = 'DIV' if op.get_bind().dialect.name == 'mysql' else '/'
+    buckets = op.get_bind().execute('''
+        SELECT pokemon_id, expire_timestamp {div} 300, COUNT(*)
+        FROM sightings
+        GROUP BY pokemon_id, expire_timestamp {div} 300
+    '''.format(div=div)).fetchall()
+    hours = Counter()
+    for pokemon_id, bucket, count in buckets:
+        hours[pokemon_id, timegm(localtime(int(bucket) * 300)) // 3600] += count
+    counts = sa.table('sighting_counts_hourly',
+                      sa.column('pokemon_id'), sa.column('hour'), sa.column('count'))
+    if hours:
+        op.bulk_insert(counts, [{'pokemon_id': p, 'hour': h, 'count': c}
+                                for (p, h), c in hours.items()])
+    op.execute('''
+        INSERT INTO sighting_counts_5min (bucket, count)
+        SELECT expire_timestamp {div} 300, COUNT(*)
+        FROM sightings
+        GROUP BY expire_timestamp {div} 300
+    '''.format(div=div))
+
+
+def downgrade():
+    op.drop_table('sighting_counts_5min')
+    op.drop_index(op.f('ix_sighting_counts_hourly_hour'), table_name='sighting_counts_hourly')
+    op.drop_table('sighting_counts_hourly')
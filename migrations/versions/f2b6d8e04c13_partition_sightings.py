@@ -0,0 +1,33 @@
+"""partition sightings
+
+Revision ID: f2b6d8e04c13
+Revises: e5a93c7d1b60
+Create Date: 2026-10-18 13:05:27.904518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sys
+from pathlib import Path
+monocle_dir = str(Path(__file__).resolve().parents[2])
+if monocle_dir not in sys.path:
+    sys.path.append(monocle_dir)
+from monocle import db, partitions
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d8e04c13'
+down_revision = 'e5a93c7d1b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # only with PARTITION_HOURS set, see monocle/partitions.py
+    if db.PARTITIONED:
+        partitions.partition_all(op.get_bind())
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('postgresql', 'mysql'):
+        partitions.unpartition_all(op.get_bind())
@@ -0,0 +1,257 @@
+"""Cold storage of expired sightings, mystery sightings and raids
+
+Rows are streamed out of the DB before cleanup deletes them, into one file
+per table and hour of their time column:
+
+    ARCHIVE_DIRECTORY/<table>/<YYYY-MM-DD>/<HH>.mca
+
+Rows saved after their hour was archived, like late reports and lure
+extensions, go to extra files of that hour named <HH>.<id>.mca, where id is
+the highest id archived before them.
+
+A file holds a JSON header followed by one zlib compressed array per
+column. NULLs are stored as -1 in signed integer columns, as the highest
+value of the type in unsigned ones (2**64 - 1 for 'Q') and as NaN in float
+ones, and come back as such.
+"""
+
+import json
+import sys
+
+from array import array
+from collections import Counter
+from calendar import timegm
+from os import listdir, makedirs, replace
+from os.path import dirname, exists, join
+from struct import Struct
+from time import gmtime, strftime, strptime
+from zlib import compress, decompress
+
+from sqlalchemy import select, or_
+
+from .db import _engine, Sighting, Mystery, Raid
+from .shared import get_logger
+from . import sanitized as conf
+
+log = get_logger(__name__)
+
+MAGIC = b'MCA1'
+HEADER = Struct('<4sI')
+# rows fetched from the server side cursor at a time
+FETCH_SIZE = 10000
+
+# table, time column, (column, array typecode) of the archived columns
+TABLES = {
+    'sightings': (Sighting.__table__, 'expire_timestamp', (
+        ('encounter_id', 'Q'), ('pokemon_id', 'h'), ('spawn_id', 'q'),
+        ('expire_timestamp', 'q'), ('lat', 'd'), ('lon', 'd'),
+        ('atk_iv', 'b'), ('def_iv', 'b'), ('sta_iv', 'b'),
+        ('move_1', 'h'), ('move_2', 'h'), ('gender', 'b'), ('form', 'h'),
+        ('cp', 'h'), ('level', 'b'), ('weight', 'f'),
+        ('weather_boosted_condition', 'b'))),
+    'mystery_sightings': (Mystery.__table__, 'first_seen', (
+        ('encounter_id', 'Q'), ('pokemon_id', 'h'), ('spawn_id', 'q'),
+        ('first_seen', 'q'), ('first_seconds', 'h'), ('last_seconds', 'h'),
+        ('seen_range', 'h'), ('lat', 'd'), ('lon', 'd'),
+        ('atk_iv', 'b'), ('def_iv', 'b'), ('sta_iv', 'b'),
+        ('move_1', 'h'), ('move_2', 'h'), ('gender', 'b'), ('form', 'h'),
+        ('cp', 'h'), ('level', 'b'))),
+    'raids': (Raid.__table__, 'time_spawn', (
+        ('external_id', 'q'), ('fort_id', 'i'), ('level', 'b'),
+        ('pokemon_id', 'h'), ('move_1', 'h'), ('move_2', 'h'),
+        ('time_spawn', 'q'), ('time_battle', 'q'), ('time_end', 'q'),
+        ('cp', 'i'))),
+}
+
+
+def directory():
+    return conf.ARCHIVE_DIRECTORY or join(conf.DIRECTORY, 'archive')
+
+
+def hour_path(table, hour, after_id=None):
+    """Path of the file of the rows of table in hour, an hour since the
+    epoch, or of its extra file for the rows with ids above after_id"""
+    when = gmtime(hour * 3600)
+    name = strftime('%H.mca', when) if after_id is None else \
+        '{}.{}.mca'.format(strftime('%H', when), after_id)
+    return join(directory(), table, strftime('%Y-%m-%d', when), name)
+
+
+def null_value(typecode):
+    if typecode in 'fd':
+        return float('nan')
+    if typecode in 'BHILQ':
+        return (1 << 8 * array(typecode).itemsize) - 1
+    return -1
+
+
+def write_file(path, table, columns):
+    """Write columns, a list of (name, array), atomically to path"""
+    blobs = []
+    for name, values in columns:
+        if sys.byteorder == 'big':
+            values = array(values.typecode, values)
+            values.byteswap()
+        blobs.append(compress(values.tobytes(), 6))
+    header = json.dumps({
+        'table': table,
+        'rows': len(columns[0][1]) if columns else 0,
+        'columns': [[name, values.typecode, len(blob)]
+                    for (name, values), blob in zip(columns, blobs)],
+    }).encode()
+    makedirs(dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    replace(path + '.tmp', path)
+
+
+def read_file(path, columns=None):
+    """{column: array} of an archive file, only the given columns if any"""
+    with open(path, 'rb') as f:
+        magic, length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not an archive file'.format(path))
+        header = json.loads(f.read(length).decode())
+        result = {}
+        for name, typecode, size in header['columns']:
+            if columns is not None and name not in columns:
+                f.seek(size, 1)
+                continue
+            values = array(typecode)
+            values.frombytes(decompress(f.read(size)))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            result[name] = values
+    return result
+
+
+def state_path(table):
+    return join(directory(), table, 'archived')
+
+
+def archived_until(table):
+    """(time, id) up to which the rows of table were archived"""
+    try:
+        with open(state_path(table)) as f:
+            until, last_id = f.read().split()
+            return int(until), int(last_id)
+    except (FileNotFoundError, ValueError):
+        return 0, 0
+
+
+def archive_table(name, before):
+    """Archive the rows of table whose time is below before, rounded down
+    to the hour, and that weren't archived yet. Returns the (time, id) up
+    to which rows are archived, rows with a time below it and an id above
+    it were saved since."""
+    table, time_col, columns = TABLES[name]
+    since, last_id = archived_until(name)
+    until = int(before) // 3600 * 3600
+    if until <= since:
+        return since, last_id
+
+    log.info("Archiving {}...", name)
+    time_column = table.c[time_col]
+    query = select([table.c.id] + [table.c[c] for c, _ in columns]) \
+        .where(time_column < until) \
+        .where(or_(time_column >= since, table.c.id > last_id)) \
+        .order_by(time_column)
+    time_index = [c for c, _ in columns].index(time_col) + 1
+    nulls = [null_value(typecode) for _, typecode in columns]
+    hour = None
+    buffer = None
+    archived = 0
+    max_id = last_id
+
+    def flush():
+        # hours below since already have a file
+        path = hour_path(name, hour, None if hour * 3600 >= since else last_id)
+        write_file(path, name, [(c, values) for (c, _), values in zip(columns, buffer)])
+
+    with _engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                row_hour = row[time_index] // 3600
+                if row_hour != hour:
+                    if buffer is not None:
+                        flush()
+                    hour = row_hour
+                    buffer = [array(typecode) for _, typecode in columns]
+                for values, value, null in zip(buffer, row[1:], nulls):
+                    values.append(null if value is None else value)
+                if row[0] > max_id:
+                    max_id = row[0]
+            archived += len(rows)
+        result.close()
+    if buffer is not None:
+        flush()
+
+    makedirs(dirname(state_path(name)), exist_ok=True)
+    with open(state_path(name) + '.tmp', 'w') as f:
+        f.write('{} {}'.format(until, max_id))
+    replace(state_path(name) + '.tmp', state_path(name))
+    log.info("=> Done. {} {} archived.", archived, name)
+    return until, max_id
+
+
+def files(table, start=None, end=None):
+    """(hour start, path) of the archive files of table that may hold rows
+    with a time in [start, end), in order"""
+    root = join(directory(), table)
+    if not exists(root):
+        return []
+    found = []
+    for day in sorted(listdir(root)):
+        if len(day) != 10:
+            continue
+        for name in sorted(listdir(join(root, day))):
+            if not name.endswith('.mca'):
+                continue
+            hour = timegm(strptime('{} {}'.format(day, name[:2]), '%Y-%m-%d %H'))
+            if (start is None or hour + 3600 > start) and (end is None or hour < end):
+                found.append((hour, join(root, day, name)))
+    return found
+
+
+def scan(table, start=None, end=None, columns=None):
+    """Yield {column: array} of the archived rows of table with a time in
+    [start, end), a file at a time"""
+    time_col = TABLES[table][1]
+    for hour, path in files(table, start, end):
+        whole = (start is None or hour >= start) and (end is None or hour + 3600 <= end)
+        if whole:
+            yield read_file(path, columns)
+            continue
+        wanted = None if columns is None else set(columns) | {time_col}
+        chunk = read_file(path, wanted)
+        keep = [i for i, t in enumerate(chunk[time_col])
+                if (start is None or t >= start) and (end is None or t < end)]
+        yield {name: array(values.typecode, (values[i] for i in keep))
+               for name, values in chunk.items()
+               if columns is None or name in columns}
+
+
+def pokemon_counts(start=None, end=None):
+    """Counter of archived sightings by Pokemon"""
+    counts = Counter()
+    for chunk in scan('sightings', start, end, ('pokemon_id',)):
+        counts.update(chunk['pokemon_id'])
+    return counts
+
+
+def heatmap(pokemon_ids=None, start=None, end=None, precision=3):
+    """Counter of archived sightings by (lat, lon) rounded to precision,
+    only of pokemon_ids if given"""
+    cells = Counter()
+    for chunk in scan('sightings', start, end, ('pokemon_id', 'lat', 'lon')):
+        for pokemon_id, lat, lon in zip(chunk['pokemon_id'], chunk['lat'], chunk['lon']):
+            if pokemon_ids is None or pokemon_id in pokemon_ids:
+                cells[round(lat, precision), round(lon, precision)] += 1
+    return cells
@@ -1,81 +1,200 @@
-import sys
-from time import time
-from sqlalchemy import func
-from sqlalchemy.dialects.mysql.mysqldb import MySQLDialect_mysqldb
-from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
-from .db import session_scope, _engine, Sighting, Mystery, FortSighting, Raid, Spawnpoint
+from fcntl import flock, LOCK_EX, LOCK_NB
+from os.path import join
+from time import time, monotonic, sleep
+from sqlalchemy import func, text
+from .db import session_scope, _engine, FortSighting, FortState, HourlyCount, BucketCount, \
+    PARTITIONED, get_heartbeat, local_hour
 from .shared import get_logger
-from . import sanitized as conf
+from . import archive as archiver, partitions, sanitized as conf
 
 log = get_logger(__name__)
-    
-db_dialect = None
 
-if isinstance(_engine.dialect, MySQLDialect_mysqldb):
-    db_dialect = "mysql"
-elif isinstance(_engine.dialect, PGDialect_psycopg2):
-    db_dialect = "pgsql"
-
-if db_dialect is None:
-    log.error("Unsupported DB dialect {}", _engine.dialect)
-    sys.exit()
-
-
-def del_statement(table, table_tmp):
-    if db_dialect == "pgsql":
-        return "DELETE FROM {} t USING {} tt WHERE t.id = tt.id".format(table, table_tmp)
-    elif db_dialect == "mysql":
-        return "DELETE t.* FROM {} t INNER JOIN {} tt ON t.id = tt.id".format(table, table_tmp)
-
-
-def cleanup_with_temp_table(table, time, limit=conf.CLEANUP_LIMIT, time_col="updated"):
-    with session_scope(autoflush=True) as session:
-        log.info("Cleaning up {}...", table)
-
-        table_tmp = "{}_tmp".format(table)
-        session.execute("""
-        CREATE TEMPORARY TABLE IF NOT EXISTS {}_tmp AS (
-          SELECT t.id
-          FROM {} t
-          WHERE t.{} IS NULL OR t.{} < :time
-          LIMIT :limit 
-        )""".format(table, table, time_col, time_col), {
-            'time': time,
-            'limit': limit,
-            })
-        session.execute(del_statement(table, table_tmp))
-        delete_count = session.execute("SELECT COUNT(*) AS delete_count FROM {}".format(table_tmp)).fetchall()
-        session.execute("DROP TABLE {}".format(table_tmp))
-
-        log.info("=> Done. {} {} deleted.", delete_count[0][0], table)
+# the scanner is considered stopped when its last heartbeat is older
+STALE_HEARTBEAT = 30 * 60
+# seconds between checks of the scanner's DB queue while paused
+PAUSE_INTERVAL = 5
+# seconds between checks of the last gym update when there's no heartbeat
+FALLBACK_INTERVAL = 5 * 60
+# (monotonic time, last gym update) of the last of these checks
+fallback = (-FALLBACK_INTERVAL, 0)
+
+
+def last_activity():
+    """(time, queued) of the last heartbeat of the scanner. Scanners that
+    don't save heartbeats are checked by their last gym update instead,
+    with nothing queued."""
+    global fallback
+    with session_scope() as session:
+        beat, queued = get_heartbeat(session)
+        if not beat:
+            # updated isn't indexed, so it's read once per FALLBACK_INTERVAL
+            checked, beat = fallback
+            if monotonic() - checked >= FALLBACK_INTERVAL:
+                beat = session.query(func.max(FortSighting.updated)).scalar() or 0
+                fallback = monotonic(), beat
+    return beat, queued
+
+
+def scanner_ready():
+    """Wait while the DB processor of the scanner is behind. Returns False
+    if the scanner seems to be stopped."""
+    paused = False
+    while True:
+        beat, queued = last_activity()
+        if beat < time() - STALE_HEARTBEAT:
+            return False
+        if not conf.CLEANUP_PAUSE_QUEUE or queued <= conf.CLEANUP_PAUSE_QUEUE:
+            return True
+        if not paused:
+            log.info("Pausing while {} DB items are queued...", queued)
+            paused = True
+        sleep(PAUSE_INTERVAL)
+
+
+def cleanup_rows(table, time, time_col="updated", max_id=None):
+    """Delete the rows of table that are older than time, and whose id
+    isn't above max_id if given, a chunk of primary keys at a time, until
+    none are left or CLEANUP_LIMIT rows were deleted"""
+    log.info("Cleaning up {}...", table)
+    # rows added during the run are never scanned, so that every chunk,
+    # the last one too, is a range of ids
+    with session_scope() as session:
+        last_id = session.execute(text("SELECT MAX(id) FROM {}".format(table))).scalar()
+    if last_id is None:
+        log.info("=> Done. 0 {} deleted.", table)
+        return
+    max_id = last_id if max_id is None else min(max_id, last_id)
+    expired = "({0} < :time OR {0} IS NULL) AND id <= :max_id".format(time_col)
+    next_chunk = text("SELECT MAX(id) FROM (SELECT id FROM {} WHERE id > :after AND {} "
+                      "ORDER BY id LIMIT :chunk) chunk".format(table, expired))
+    delete = text("DELETE FROM {} WHERE id > :after AND id <= :upto AND {}".format(table, expired))
+
+    after = 0
+    deleted = 0
+    while not conf.CLEANUP_LIMIT or deleted < conf.CLEANUP_LIMIT:
+        if not scanner_ready():
+            log.info("Stopping since the scanner seems to be stopped.")
+            break
+        started = monotonic()
+        with session_scope() as session:
+            upto = session.execute(next_chunk, {'after': after, 'time': time, 'max_id': max_id,
+                                                'chunk': conf.CLEANUP_CHUNK_SIZE}).scalar()
+            if upto is None:
+                break
+            count = session.execute(delete, {'after': after, 'upto': upto,
+                                             'time': time, 'max_id': max_id}).rowcount
+        deleted += count
+        after = upto
+        if conf.CLEANUP_ROWS_PER_SECOND:
+            sleep(max(count / conf.CLEANUP_ROWS_PER_SECOND - (monotonic() - started), 0))
+
+    log.info("=> Done. {} {} deleted.", deleted, table)
+
+
+def cleanup_table(table, time, time_col="updated", max_id=None):
+    """Drop the expired partitions of table if it's partitioned, delete
+    its expired rows otherwise"""
+    if PARTITIONED:
+        with _engine.begin() as conn:
+            dropped = partitions.maintain(conn, table, time, max_id)
+        if dropped is not None:
+            log.info("=> Done. {} partitions of {} dropped.", dropped, table)
+            if _engine.name == "postgresql":
+                # rows older than the first partition
+                cleanup_rows("{}_default".format(table), time,
+                             time_col=partitions.COLUMNS[table], max_id=max_id)
+            return
+    cleanup_rows(table, time, time_col=time_col, max_id=max_id)
+
+
+def prepare_partitions():
+    """Create the partitions of the coming hours, even for tables that
+    aren't cleaned up"""
+    with _engine.begin() as conn:
+        for table in partitions.COLUMNS:
+            partitions.maintain(conn, table, None)
+
+
+def cleanup_fort_state(time):
+    """Forget the state of forts whose sightings were cleaned up"""
+    with session_scope() as session:
+        deleted = session.query(FortState) \
+            .filter(FortState.updated < time) \
+            .delete(synchronize_session=False)
+        log.info("=> Done. {} fort_state deleted.", deleted)
+
+
+def cleanup_counts(time):
+    """Forget the report counts of sightings that expired before time, the
+    reports only cover the sightings that are kept"""
+    with session_scope() as session:
+        hours = session.query(HourlyCount) \
+            .filter(HourlyCount.hour < local_hour(time)) \
+            .delete(synchronize_session=False)
+        buckets = session.query(BucketCount) \
+            .filter(BucketCount.bucket < time // 300) \
+            .delete(synchronize_session=False)
+        log.info("=> Done. {} hourly and {} 5 minute counts deleted.", hours, buckets)
 
 
 def is_service_alive():
-    now = int(time())
-    thirty_min_ago = now - (30 * 60)
-
-    with session_scope(autoflush=True) as session:
-        last_updated = session.query(func.max(FortSighting.updated)).first()[0]
-        last_updated = last_updated if last_updated else 0 
-        if last_updated > thirty_min_ago:
-            return True 
-    return False 
-
-
-def light():
-    now = int(time())
-    x_hr_ago = now - (6 * 3600)
-
-    if is_service_alive():
-        if conf.CLEANUP_RAIDS_OLDER_THAN_X_HR > 0:
-            cleanup_with_temp_table("raids", now - (conf.CLEANUP_RAIDS_OLDER_THAN_X_HR * 3600), time_col="time_spawn")
-        if conf.CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR > 0:
-            cleanup_with_temp_table("fort_sightings", now - (conf.CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR * 3600))
-        if conf.CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR > 0:
-            cleanup_with_temp_table("mystery_sightings", now - (conf.CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR * 3600), time_col="first_seen")
-        if conf.CLEANUP_SIGHTINGS_OLDER_THAN_X_HR > 0:
-            cleanup_with_temp_table("sightings", now - (conf.CLEANUP_SIGHTINGS_OLDER_THAN_X_HR * 3600))
-    else:
-        log.info("Skipping cleanup since updates seem to be stopped for more than 30 mins.")
+    beat, _ = last_activity()
+    return beat > time() - STALE_HEARTBEAT
+
+
+def archive_before(table, time):
+    """Archive the rows of table older than time, returns the (time, id)
+    up to which its rows can be deleted"""
+    try:
+        until, max_id = archiver.archive_table(table, time)
+        return min(time, until), max_id
+    except Exception as e:
+        log.exception("A wild {} appeared while archiving {}, not deleting anything.", e.__class__.__name__, table)
+        return 0, 0
+
+
+def light(archive=False):
+    # cron starts a cleanup every minute, which may take longer than that
+    lock = open(join(conf.DIRECTORY, 'cleanup.lock'), 'w')
+    try:
+        flock(lock, LOCK_EX | LOCK_NB)
+    except OSError:
+        log.info("Skipping cleanup since the previous one is still running.")
+        lock.close()
+        return
+
+    with lock:
+        now = int(time())
+
+        if PARTITIONED:
+            prepare_partitions()
+
+        if is_service_alive():
+            if conf.CLEANUP_RAIDS_OLDER_THAN_X_HR > 0:
+                older_than = now - (conf.CLEANUP_RAIDS_OLDER_THAN_X_HR * 3600)
+                max_id = None
+                if archive:
+                    older_than, max_id = archive_before("raids", older_than)
+                cleanup_rows("raids", older_than, time_col="time_spawn", max_id=max_id)
+            if conf.CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR > 0:
+                cleanup_table("fort_sightings", now - (conf.CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR * 3600))
+                cleanup_fort_state(now - (conf.CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR * 3600))
+            if conf.CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR > 0:
+                older_than = now - (conf.CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR * 3600)
+                max_id = None
+                if archive:
+                    older_than, max_id = archive_before("mystery_sightings", older_than)
+                cleanup_table("mystery_sightings", older_than, time_col="first_seen", max_id=max_id)
+            if conf.CLEANUP_SIGHTINGS_OLDER_THAN_X_HR > 0:
+                older_than = now - (conf.CLEANUP_SIGHTINGS_OLDER_THAN_X_HR * 3600)
+                max_id = None
+                if archive:
+                    older_than, max_id = archive_before("sightings", older_than)
+                # by the column of the archive and of the report counts, so
+                # the counts cover the sightings that are kept
+                cleanup_table("sightings", older_than, time_col="expire_timestamp", max_id=max_id)
+                cleanup_counts(older_than)
+        else:
+            log.info("Skipping cleanup since updates seem to be stopped for more than 30 mins.")
 
     log.info("Light cleanup done.")
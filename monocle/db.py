@@ -1,20 +1,22 @@
+from calendar import timegm
 from datetime import datetime
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from contextlib import contextmanager
 from enum import Enum
-from time import time, mktime
+from time import time, mktime, localtime
 from datetime import datetime
 
 from sqlalchemy import Column, Boolean, Integer, String, Float, SmallInteger, \
         BigInteger, ForeignKey, Index, UniqueConstraint, \
-        create_engine, cast, func, desc, asc, desc, and_, exists
-from sqlalchemy.orm import sessionmaker, relationship, eagerload, foreign, remote
+        create_engine, cast, func, desc, asc, desc, and_, exists, bindparam, text, select
+from sqlalchemy.orm import sessionmaker, relationship, foreign, remote
 from sqlalchemy.types import TypeDecorator, Numeric, Text, TIMESTAMP
 from sqlalchemy.ext.declarative import declarative_base
 
 from . import bounds, spawns, db_proc, sanitized as conf
 from .utils import time_until_time, dump_pickle, load_pickle
-from .shared import call_at, get_logger
+from .shared import EXPIRY, get_logger
+from .idtable import IdTable
 import overpy
 
 try:
@@ -96,57 +98,72 @@ class SightingCache:
     """Simple cache for storing actual sightings
 
     It's used in order not to make as many queries to the database.
-    It schedules sightings to be removed as soon as they expire.
+    Sightings are kept until a minute after they expire.
     """
     def __init__(self):
-        self.store = {}
-        self.spawn_ids = {}
+        # {encounter_id: time it's kept until}
+        self.store = IdTable(expiring=True)
+        # {spawn_id: time its latest sighting is kept until}
+        self.spawn_ids = IdTable(expiring=True)
+        # encounter ids the workers added before the preload reached them
+        self.early = set()
 
     def __len__(self):
         return len(self.store)
 
+    @property
+    def nbytes(self):
+        return self.store.nbytes + self.spawn_ids.nbytes
+
     def add(self, sighting):
-        self.store[sighting['encounter_id']] = sighting['expire_timestamp']
-        self.spawn_ids[sighting['spawn_id']] = True
-        call_at(sighting['expire_timestamp'] + 60, self.remove, sighting['encounter_id'], sighting['spawn_id'])
+        if not sighting['expire_timestamp']:
+            return
+        until = int(sighting['expire_timestamp']) + 60
+        self.store.set(sighting['encounter_id'], until)
+        known = self.spawn_ids.get(sighting['spawn_id'])
+        if known is None or known[0] < until:
+            self.spawn_ids.set(sighting['spawn_id'], until)
 
     def remove(self, encounter_id, spawn_id):
-        if encounter_id in  self.store:
-            del self.store[encounter_id]
-        if spawn_id in self.spawn_ids:
-            del self.spawn_ids[spawn_id]
+        self.store.pop(encounter_id)
+        self.spawn_ids.pop(spawn_id)
 
     def __contains__(self, raw_sighting):
-        try:
-            return (self.store[raw_sighting['encounter_id']] is not None)
-        except KeyError:
-            return False
+        return raw_sighting['encounter_id'] in self.store
+
+    def preexisting(self, raw_sighting):
+        """Whether the preload found a sighting the workers took for new"""
+        return raw_sighting['encounter_id'] in self.early
 
     # Preloading from db
     def preload(self):
+        now = int(time())
         with session_scope() as session:
-            sightings = session.query(Sighting) \
+            columns = (Sighting.encounter_id, Sighting.spawn_id, Sighting.expire_timestamp,
+                       Sighting.lat, Sighting.lon)
+            sightings = session.query(*columns) \
                 .join(Sighting.spawnpoint) \
-                .filter(Sighting.expire_timestamp >= int(time())) \
+                .filter(Sighting.expire_timestamp >= now) \
                 .filter(Spawnpoint.lat.between(bounds.south, bounds.north),
                         Spawnpoint.lon.between(bounds.west, bounds.east))
 
-            sightings_lured = session.query(Sighting) \
+            sightings_lured = session.query(*columns) \
                 .filter(Sighting.spawn_id == 0) \
-                .filter(Sighting.expire_timestamp >= int(time())) \
+                .filter(Sighting.expire_timestamp >= now) \
                 .filter(Sighting.lat.between(bounds.south, bounds.north),
                         Sighting.lon.between(bounds.west, bounds.east))
 
             sightings = sightings.union(sightings_lured)
-            for sighting in sightings:
-                if (sighting.lat, sighting.lon) not in bounds:
+            for encounter_id, spawn_id, expire_timestamp, lat, lon in sightings:
+                if (lat, lon) not in bounds:
                     continue
-                obj = {
-                    'encounter_id': sighting.encounter_id,
-                    'spawn_id': sighting.spawn_id,
-                    'expire_timestamp': sighting.expire_timestamp,
-                }
-                self.add(obj)
+                if encounter_id in self.store:
+                    self.early.add(encounter_id)
+                self.add({
+                    'encounter_id': encounter_id,
+                    'spawn_id': spawn_id,
+                    'expire_timestamp': expire_timestamp,
+                })
             log.info("Preloaded {} sightings", len(self))
 
 
@@ -157,32 +174,40 @@ class MysteryCache:
     It schedules sightings to be removed an hour after being seen.
     """
     def __init__(self):
-        self.store = {}
+        # {encounter_id: (spawn_id, first seen, last seen)}
+        self.store = IdTable('qII')
 
     def __len__(self):
         return len(self.store)
 
+    @property
+    def nbytes(self):
+        return self.store.nbytes
+
     def add(self, sighting):
-        key = combine_key(sighting)
-        self.store[key] = [sighting['seen']] * 2
-        call_at(sighting['seen'] + 3510, self.remove, key)
+        self.store.set(sighting['encounter_id'], sighting['spawn_id'], sighting['seen'], sighting['seen'])
+        EXPIRY.call_at(sighting['seen'] + 3510, self.remove, combine_key(sighting))
 
     def __contains__(self, raw_sighting):
-        key = combine_key(raw_sighting)
-        try:
-            first, last = self.store[key]
-        except (KeyError, TypeError):
+        encounter_id = raw_sighting['encounter_id']
+        row = self.store.get(encounter_id)
+        if row is None or row[0] != raw_sighting['spawn_id']:
             return False
+        spawn_id, first, last = row
         new_time = raw_sighting['seen']
         if new_time > last:
-            self.store[key][1] = new_time
+            self.store.set(encounter_id, spawn_id, first, new_time)
         return True
 
     def remove(self, key):
-        first, last = self.store[key]
-        del self.store[key]
+        encounter_id, spawn_id = key
+        row = self.store.get(encounter_id)
+        if row is None or row[0] != spawn_id:
+            return
+        self.store.pop(encounter_id)
+        _, first, last = row
         if last != first:
-            encounter_id, spawn_id = key
+            # journaled and written after the insert, by the same processor
             db_proc.add({
                 'type': 'mystery-update',
                 'spawn': spawn_id,
@@ -191,8 +216,14 @@ class MysteryCache:
                 'last': last
             })
 
+    def remove_all(self):
+        """Queue the seen ranges of every mystery, before shutting down"""
+        for encounter_id, (spawn_id, _, _) in list(self.store.items()):
+            self.remove((encounter_id, spawn_id))
+
     def items(self):
-        return self.store.items()
+        return (((encounter_id, spawn_id), [first, last])
+                for encounter_id, (spawn_id, first, last) in self.store.items())
 
 
 class RaidCache:
@@ -209,7 +240,7 @@ class RaidCache:
 
     def add(self, raid):
         self.store[raid['fort_external_id']] = raid
-        call_at(raid['time_end'], self.remove, raid['fort_external_id'])
+        EXPIRY.call_at(raid['time_end'], self.remove, raid['fort_external_id'])
 
     def remove(self, cache_id):
         try:
@@ -232,23 +263,25 @@ class RaidCache:
     # Preloading from db
     def preload(self):
         with session_scope() as session:
-            raids = session.query(Raid) \
-                .options(eagerload(Raid.fort)) \
+            raids = session.query(Raid.time_end, Raid.pokemon_id,
+                                  Fort.external_id, Fort.lat, Fort.lon) \
                 .join(Fort, Fort.id == Raid.fort_id) \
                 .filter(Raid.time_end > int(time())) \
                 .filter(Fort.lat.between(bounds.south, bounds.north),
                         Fort.lon.between(bounds.west, bounds.east))
-            for raid in raids:
-                fort = raid.fort
-                if (fort.lat, fort.lon) not in bounds:
+            for time_end, pokemon_id, external_id, lat, lon in raids:
+                if (lat, lon) not in bounds:
                     continue
-                r = {}
-                r['fort_external_id'] = fort.external_id
-                r['time_end'] = raid.time_end
-                r['pokemon_id'] = raid.pokemon_id
-                self.add(r)
+                self.add({
+                    'fort_external_id': external_id,
+                    'time_end': time_end,
+                    'pokemon_id': pokemon_id,
+                })
             log.info("Preloaded {} raids", len(self))
-            
+
+
+# columns of a fort sighting that are compared to skip writes
+FORT_STATE = ('team', 'guard_pokemon_id', 'slots_available', 'is_in_battle', 'last_modified')
 
 
 class FortCache:
@@ -261,7 +294,12 @@ class FortCache:
         self.pokestop_names = {}
         self.sponsors = {}
         self.park = {}
-        self.class_version = 2.1
+        # {external_id: {defender external_id: fingerprint}}
+        self.defenders = {}
+        # {external_id: (fort_sighting id, state, updated)} of the last write
+        self.sightings = {}
+        self.suppressed = 0
+        self.class_version = 2.3
 
     def __len__(self):
         return len(self.gyms)
@@ -276,6 +314,10 @@ class FortCache:
             del self.internal_ids[external_id]
         if external_id in self.gym_info:
             del self.gym_info[external_id]
+        if external_id in self.defenders:
+            del self.defenders[external_id]
+        if external_id in self.sightings:
+            del self.sightings[external_id]
 
     def __contains__(self, sighting):
         try:
@@ -287,7 +329,9 @@ class FortCache:
         return self.gyms[index]
 
     def pickle(self):
-        state = self.__dict__.copy()
+        # the DB processors change the dicts meanwhile, copying each one
+        # happens at once while pickling it doesn't
+        state = {k: v.copy() if isinstance(v, dict) else v for k, v in self.__dict__.items()}
         state['db_hash'] = spawns.db_hash
         state['bounds_hash'] = hash(bounds)
         dump_pickle('forts', state)
@@ -295,39 +339,46 @@ class FortCache:
     # Preloading from db
     def preload(self):
         with session_scope() as session:
-            fort_sightings = session.query(FortSighting) \
+            fort_sightings = session.query(
+                    Fort.external_id, Fort.lat, Fort.lon, Fort.name, Fort.url,
+                    Fort.sponsor, Fort.park, Fort.weather_cell_id,
+                    FortSighting.id, FortSighting.fort_id, FortSighting.updated,
+                    *(getattr(FortSighting, c) for c in FORT_STATE)) \
                 .join(FortSighting.fort) \
                 .filter(Fort.lat.between(bounds.south, bounds.north),
                         Fort.lon.between(bounds.west, bounds.east))
-            for fort_sighting in fort_sightings:
-                if (fort_sighting.fort.lat, fort_sighting.fort.lon) not in bounds:
+            for row in fort_sightings:
+                if (row.lat, row.lon) not in bounds:
                     continue
-                fort = fort_sighting.fort
-                external_id = fort.external_id
-                self.internal_ids[external_id] = fort_sighting.fort_id
-                self.sponsors[external_id] = fort.sponsor
-                if fort.park:
-                    self.park[external_id] = fort.park
-                if fort.name:
-                    self.gym_info[external_id] = (fort.name, fort.url, fort.sponsor)
+                external_id = row.external_id
+                self.internal_ids[external_id] = row.fort_id
+                self.sponsors[external_id] = row.sponsor
+                if row.park:
+                    self.park[external_id] = row.park
+                if row.name:
+                    self.gym_info[external_id] = (row.name, row.url, row.sponsor)
                 obj = {
-                    'external_id': fort_sighting.fort.external_id,
-                    'weather_cell_id': fort.weather_cell_id,
-                    'last_modified': fort_sighting.last_modified
+                    'external_id': external_id,
+                    'weather_cell_id': row.weather_cell_id,
+                    'last_modified': row.last_modified
                 }
                 self.add(obj)
+                known = self.sightings.get(external_id)
+                if not known or known[1][-1] <= row.last_modified:
+                    state = tuple(getattr(row, c) for c in FORT_STATE)
+                    self.sightings[external_id] = (row.id, state, row.updated)
             log.info("Preloaded {} fort_sightings ", len(self))
             log.info("Preloaded {} fort parks", len(self.park))
 
-            pokestops = session.query(Pokestop) \
+            pokestops = session.query(Pokestop.external_id, Pokestop.lat, Pokestop.lon, Pokestop.name) \
                 .filter(Pokestop.lat.between(bounds.south, bounds.north),
                         Pokestop.lon.between(bounds.west, bounds.east))
-            for pokestop in pokestops:
-                if (pokestop.lat, pokestop.lon) not in bounds:
+            for external_id, lat, lon, name in pokestops:
+                if (lat, lon) not in bounds:
                     continue
-                self.pokestops[pokestop.external_id] = (pokestop.lat, pokestop.lon)
-                if pokestop.name:
-                    self.pokestop_names[pokestop.external_id] = pokestop.name
+                self.pokestops[external_id] = (lat, lon)
+                if name:
+                    self.pokestop_names[external_id] = name
             log.info("Preloaded {} pokestops", len(self.pokestop_names))
 
 
@@ -343,13 +394,15 @@ Base = declarative_base()
 _engine = create_engine(conf.DB_ENGINE, pool_size=conf.DB_POOL_SIZE, max_overflow=conf.DB_MAX_OVERFLOW, pool_recycle=conf.DB_POOL_RECYCLE, isolation_level='READ_UNCOMMITTED')
 Session = sessionmaker(bind=_engine)
 DB_TYPE = _engine.name
+# see partitions.py
+PARTITIONED = bool(conf.PARTITION_HOURS) and DB_TYPE in ('postgresql', 'mysql')
 
 
 if conf.REPORT_SINCE:
     SINCE_TIME = mktime(conf.REPORT_SINCE.timetuple())
-    SINCE_QUERY = 'WHERE expire_timestamp > {}'.format(SINCE_TIME)
-else:
-    SINCE_QUERY = ''
+
+# rows fetched at a time by queries that stream their results
+STREAM_SIZE = 5000
 
 
 class Common(Base):
@@ -396,14 +449,32 @@ class Sighting(Base):
             'expire_timestamp',
             name='timestamp_encounter_id_unique'
         ),
+        Index('ix_sightings_spawn_id_expire', 'spawn_id', 'expire_timestamp'),
     )
 
+class HourlyCount(Base):
+    """Sightings per Pokemon per local hour of expiration, for the reports"""
+    __tablename__ = 'sighting_counts_hourly'
+
+    pokemon_id = Column(SmallInteger, primary_key=True, autoincrement=False)
+    hour = Column(Integer, primary_key=True, autoincrement=False, index=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class BucketCount(Base):
+    """Sightings per 5 minutes of expiration, for the punch card"""
+    __tablename__ = 'sighting_counts_5min'
+
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+
+
 class Raid(Base):
     __tablename__ = 'raids'
 
     id = Column(Integer, primary_key=True)
     external_id = Column(BigInteger, unique=True)
-    fort_id = Column(Integer, ForeignKey('forts.id'))
+    fort_id = Column(Integer, ForeignKey('forts.id'), index=True)
     level = Column(TINY_TYPE)
     pokemon_id = Column(SmallInteger)
     move_1 = Column(SmallInteger)
@@ -419,7 +490,7 @@ class Mystery(Base):
 
     id = Column(PRIMARY_HUGE_TYPE, primary_key=True)
     pokemon_id = Column(SmallInteger)
-    spawn_id = Column(BigInteger, index=True)
+    spawn_id = Column(BigInteger)
     encounter_id = Column(UNSIGNED_HUGE_TYPE, index=True)
     lat = Column(FLOAT_TYPE)
     lon = Column(FLOAT_TYPE)
@@ -446,6 +517,7 @@ class Mystery(Base):
             'spawn_id',
             name='unique_encounter'
         ),
+        Index('ix_mystery_sightings_spawn_id_first_seen', 'spawn_id', 'first_seen'),
     )
 
 
@@ -523,6 +595,19 @@ class FortSighting(Base):
         ),
     )
 
+class FortState(Base):
+    """Latest sighting of each fort, kept up to date by the DB processor"""
+    __tablename__ = 'fort_state'
+
+    fort_id = Column(Integer, ForeignKey('forts.id'), primary_key=True, autoincrement=False)
+    sighting_id = Column(PRIMARY_HUGE_TYPE)
+    team = Column(TINY_TYPE)
+    guard_pokemon_id = Column(SmallInteger)
+    slots_available = Column(SmallInteger)
+    is_in_battle = Column(Boolean, default=False)
+    last_modified = Column(Integer)
+    updated = Column(Integer, index=True)
+
 class GymDefender(Base):
     __tablename__ = 'gym_defenders'
 
@@ -585,126 +670,339 @@ def get_common(session, key, lock=False):
     return common
 
 
+def save_heartbeat(session, queued):
+    """Record that the scanner is running, and how many items its DB
+    processor has queued"""
+    common = get_common(session, 'heartbeat')
+    common.val = '{} {}'.format(int(time()), queued)
+    session.commit()
+
+
+def get_heartbeat(session):
+    """(time, queued) of the last heartbeat of the scanner"""
+    common = session.query(Common.val).filter(Common.key == 'heartbeat').first()
+    try:
+        beat, queued = common[0].split()
+        return int(beat), int(queued)
+    except (TypeError, ValueError, AttributeError):
+        return 0, 0
+
+
+def sighting_row(pokemon, now):
+    row = {
+        'pokemon_id': pokemon['pokemon_id'],
+        'spawn_id': pokemon['spawn_id'],
+        'encounter_id': pokemon['encounter_id'],
+        'expire_timestamp': pokemon['expire_timestamp'],
+        'lat': pokemon['lat'],
+        'lon': pokemon['lon'],
+        'atk_iv': pokemon.get('individual_attack'),
+        'def_iv': pokemon.get('individual_defense'),
+        'sta_iv': pokemon.get('individual_stamina'),
+        'move_1': pokemon.get('move_1'),
+        'move_2': pokemon.get('move_2'),
+        'gender': pokemon.get('gender', 0),
+        'form': pokemon.get('form', 0),
+        'cp': pokemon.get('cp'),
+        'level': pokemon.get('level'),
+        'weather_boosted_condition': pokemon.get('weather_boosted_condition', 0),
+        'weather_cell_id': pokemon.get('weather_cell_id'),
+        'weight': None,
+        'updated': now,
+    }
+    if row['pokemon_id'] in [19,129]:
+        row['weight'] = pokemon.get('weight')
+    return row
+
 
-def add_sighting(session, pokemon):
-    if pokemon['spawn_id'] == 0 or pokemon.get('check_duplicate'):
-        sighting = session.query(Sighting) \
-                .filter(Sighting.encounter_id==pokemon['encounter_id']) \
-                .first()
-    elif not conf.KEEP_SPAWNPOINT_HISTORY:
-        sighting = session.query(Sighting) \
-                .filter(Sighting.spawn_id==pokemon['spawn_id']) \
-                .order_by(desc(Sighting.id)) \
-                .first()
+def local_hour(timestamp):
+    """Number of the hour of timestamp in local time since the epoch, its
+    hour of the day is the remainder by 24"""
+    return timegm(localtime(timestamp)) // 3600
+
+
+def chunks(seq, size=500):
+    """Split seq into lists of at most size items, to keep IN () lists
+    below the bound parameter limits of every dialect."""
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def merge_sightings(pokemons):
+    """Collapse reports of the same Pokemon within a batch, keeping any
+    encounter details an earlier report had."""
+    merged = OrderedDict()
+    for pokemon in pokemons:
+        key = pokemon['encounter_id'], pokemon['expire_timestamp']
+        if key in merged:
+            merged[key].update((k, v) for k, v in pokemon.items() if v is not None)
+        else:
+            merged[key] = dict(pokemon)
+    return list(merged.values())
+
+
+def upsert(session, table, rows, keys, update=(), keep=(), increment=()):
+    """Insert rows with a single statement each, resolving conflicts on the
+    unique columns in keys the way the dialect supports natively.
+
+    Columns in update are overwritten on conflict, columns in keep only
+    fill in NULLs and columns in increment are added to. Without any of
+    them, conflicting rows are left untouched.
+    """
+    if not rows:
+        return
+    table = getattr(table, '__table__', table)
+    columns = list(rows[0])
+    dialect = session.get_bind().dialect
+    quote = dialect.identifier_preparer.quote
+    name = dialect.identifier_preparer.format_table(table)
+
+    names = ', '.join(quote(c) for c in columns)
+    values = [':' + c for c in columns]
+
+    if dialect.name == 'mysql':
+        sets = ['{0} = VALUES({0})'.format(quote(c)) for c in update]
+        sets.extend('{0} = COALESCE(VALUES({0}), {0})'.format(quote(c)) for c in keep)
+        sets.extend('{0} = {0} + VALUES({0})'.format(quote(c)) for c in increment)
+        if sets:
+            sql = 'INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}'.format(
+                name, names, ', '.join(values), ', '.join(sets))
+        else:
+            sql = 'INSERT IGNORE INTO {} ({}) VALUES ({})'.format(name, names, ', '.join(values))
+    elif dialect.name == 'sqlite' and dialect.dbapi.sqlite_version_info < (3, 24, 0):
+        sql = 'INSERT OR IGNORE INTO {} ({}) VALUES ({})'.format(name, names, ', '.join(values))
+        if update or keep or increment:
+            # no ON CONFLICT before 3.24: the existing rows are updated in
+            # place, keeping their ids, then the missing ones are inserted
+            sets = ['{0} = :{1}'.format(quote(c), c) for c in update]
+            sets.extend('{0} = COALESCE(:{1}, {0})'.format(quote(c), c) for c in keep)
+            sets.extend('{0} = {0} + :{1}'.format(quote(c), c) for c in increment)
+            match = ' AND '.join('{0} = :{1}'.format(quote(k), k) for k in keys)
+            changes = text('UPDATE {} SET {} WHERE {}'.format(name, ', '.join(sets), match)).bindparams(
+                *(bindparam(c, type_=table.c[c].type) for c in columns
+                  if c in keys or c in update or c in keep or c in increment))
+            statement = text(sql).bindparams(
+                *(bindparam(c, type_=table.c[c].type) for c in columns))
+            # a row whose keys repeat must see the ones before it, so each
+            # round holds one occurrence of every key
+            rounds = []
+            seen = Counter()
+            for row in rows:
+                key = tuple(row[k] for k in keys)
+                if seen[key] == len(rounds):
+                    rounds.append([])
+                rounds[seen[key]].append(row)
+                seen[key] += 1
+            for batch in rounds:
+                session.execute(changes, batch)
+                session.execute(statement, batch)
+            return
     else:
-        sighting = None
-
-    if not sighting:
-        sighting = Sighting()
-
-    sighting.pokemon_id = pokemon['pokemon_id']
-    sighting.spawn_id = pokemon['spawn_id']
-    sighting.encounter_id = pokemon['encounter_id']
-    sighting.expire_timestamp = pokemon['expire_timestamp']
-    sighting.lat = pokemon['lat']
-    sighting.lon = pokemon['lon']
-    sighting.atk_iv = pokemon.get('individual_attack')
-    sighting.def_iv = pokemon.get('individual_defense')
-    sighting.sta_iv = pokemon.get('individual_stamina')
-    sighting.move_1 = pokemon.get('move_1')
-    sighting.move_2 = pokemon.get('move_2')
-    sighting.gender = pokemon.get('gender', 0)
-    sighting.form = pokemon.get('form', 0)
-    sighting.cp = pokemon.get('cp')
-    sighting.level = pokemon.get('level')
-    sighting.weather_boosted_condition = pokemon.get('weather_boosted_condition', 0)
-    sighting.weather_cell_id = pokemon.get('weather_cell_id')
-
-    if sighting.pokemon_id in [19,129]:
-        sighting.weight = pokemon.get('weight')
-
-    session.merge(sighting)
+        sets = ['{0} = excluded.{0}'.format(quote(c)) for c in update]
+        sets.extend('{0} = COALESCE(excluded.{0}, {1}.{0})'.format(quote(c), name) for c in keep)
+        sets.extend('{0} = {1}.{0} + excluded.{0}'.format(quote(c), name) for c in increment)
+        conflict = ', '.join(quote(k) for k in keys)
+        sql = 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) '.format(
+            name, names, ', '.join(values), conflict)
+        if sets:
+            sql += 'DO UPDATE SET ' + ', '.join(sets)
+        else:
+            sql += 'DO NOTHING'
+
+    statement = text(sql).bindparams(
+        *(bindparam(c, type_=table.c[c].type) for c in columns))
+    session.execute(statement, rows)
+
+
+def add_sightings(session, pokemons):
+    """Save a batch of sightings
+
+    Each sighting is upserted on (encounter_id, expire_timestamp). Encounter
+    details are never overwritten with blanks from a plain sighting.
+    """
+    pokemons = merge_sightings(pokemons)
+    now = int(time())
+    rows = [sighting_row(p, now) for p in pokemons]
+    count_sightings(session, rows)
+    upsert(session, Sighting, rows,
+           keys=('encounter_id', 'expire_timestamp'),
+           update=('pokemon_id', 'spawn_id', 'lat', 'lon', 'gender', 'form',
+                   'weather_boosted_condition', 'weather_cell_id', 'updated'),
+           keep=('atk_iv', 'def_iv', 'sta_iv', 'move_1', 'move_2', 'cp',
+                 'level', 'weight'))
+
+    table = Sighting.__table__
+    # a lure can be extended, which moves the expiration of its Pokemon
+    lured = [{'encounter': p['encounter_id'], 'expire': p['expire_timestamp']}
+             for p in pokemons if p['spawn_id'] == 0]
+    if lured:
+        session.execute(table.delete()
+            .where(and_(table.c.encounter_id == bindparam('encounter', type_=table.c.encounter_id.type),
+                        table.c.expire_timestamp != bindparam('expire'))),
+            lured)
+    if not conf.KEEP_SPAWNPOINT_HISTORY:
+        # only the latest sighting of a spawn is kept
+        older = [{'spawn': p['spawn_id'], 'expire': p['expire_timestamp']}
+                 for p in pokemons if p['spawn_id'] != 0]
+        if older:
+            session.execute(table.delete()
+                .where(and_(table.c.spawn_id == bindparam('spawn'),
+                            table.c.expire_timestamp < bindparam('expire'))),
+                older)
 
     # Reset failures to 0 if needed
-    spawn_id = pokemon['spawn_id']
-    failures = spawns.failures.get(spawn_id, 0)
-    if failures > 0:
-        spawns.failures[spawn_id] = 0
-        spawnpoint = session.query(Spawnpoint) \
-            .filter(Spawnpoint.spawn_id == spawn_id) \
-            .first()
-        if spawnpoint:
-            spawnpoint.failures = 0
+    for pokemon in pokemons:
+        if spawns.failures.get(pokemon['spawn_id'], 0) > 0:
+            spawns.set_failures(pokemon['spawn_id'], 0)
+
+
+def count_sightings(session, rows):
+    """Add sightings that aren't saved yet to the report rollups"""
+    table = Sighting.__table__
+    saved = set()
+    for encounter_ids in chunks({r['encounter_id'] for r in rows}):
+        query = select([table.c.encounter_id]).where(table.c.encounter_id.in_(encounter_ids))
+        saved.update(r[0] for r in session.execute(query))
+
+    hours = Counter()
+    buckets = Counter()
+    for row in rows:
+        # also skips lured Pokemon whose lure was extended
+        if row['encounter_id'] in saved:
+            continue
+        saved.add(row['encounter_id'])
+        hours[row['pokemon_id'], local_hour(row['expire_timestamp'])] += 1
+        buckets[row['expire_timestamp'] // 300] += 1
+    upsert(session, HourlyCount,
+           [{'pokemon_id': p, 'hour': h, 'count': c} for (p, h), c in hours.items()],
+           keys=('pokemon_id', 'hour'), increment=('count',))
+    upsert(session, BucketCount,
+           [{'bucket': b, 'count': c} for b, c in buckets.items()],
+           keys=('bucket',), increment=('count',))
+
+
+def defender_fingerprint(cp, stamina, team, last_modified):
+    return cp, stamina, team, last_modified
 
 
 def add_gym_defenders(session, fort_internal_id, gym_defenders, raw_fort):
-        
-    session.query(GymDefender).filter(GymDefender.fort_id==fort_internal_id).delete()
-
+    """Write only the defenders that were added, removed or changed since
+    the roster of the fort was last seen"""
+    external_id = raw_fort['external_id']
+    known = FORT_CACHE.defenders.get(external_id)
+    if known is None:
+        known = {
+            row.external_id: defender_fingerprint(row.cp, row.stamina, row.team, row.last_modified)
+            for row in session.query(GymDefender.external_id, GymDefender.cp, GymDefender.stamina,
+                                     GymDefender.team, GymDefender.last_modified)
+                .filter(GymDefender.fort_id == fort_internal_id)
+        }
+
+    team = raw_fort.get('team')
+    last_modified = raw_fort.get('last_modified')
+    now = int(time())
+    current = {}
+    inserts = []
+    updates = []
     for gym_defender in gym_defenders:
-        obj = GymDefender(
-            fort_id=fort_internal_id,
-            external_id=gym_defender['external_id'],
-            pokemon_id=gym_defender['pokemon_id'],
-            owner_name=gym_defender['owner_name'],
-            nickname=gym_defender['nickname'],
-            cp=gym_defender['cp'],
-            stamina=gym_defender['stamina'],
-            stamina_max=gym_defender['stamina_max'],
-            atk_iv=gym_defender['atk_iv'],
-            def_iv=gym_defender['def_iv'],
-            sta_iv=gym_defender['sta_iv'],
-            move_1=gym_defender['move_1'],
-            move_2=gym_defender['move_2'],
-            battles_attacked=gym_defender['battles_attacked'],
-            battles_defended=gym_defender['battles_defended'],
-            num_upgrades=gym_defender['num_upgrades'],
-            created=int(time()),
-        )
-        team = raw_fort.get('team')
-        if team is not None:
-            obj.team = team
-        last_modified = raw_fort.get('last_modified')
-        if last_modified is not None:
-            obj.last_modified = last_modified
-        session.add(obj)
+        row = {
+            'fort_id': fort_internal_id,
+            'external_id': gym_defender['external_id'],
+            'pokemon_id': gym_defender['pokemon_id'],
+            'owner_name': gym_defender['owner_name'],
+            'nickname': gym_defender['nickname'],
+            'cp': gym_defender['cp'],
+            'stamina': gym_defender['stamina'],
+            'stamina_max': gym_defender['stamina_max'],
+            'atk_iv': gym_defender['atk_iv'],
+            'def_iv': gym_defender['def_iv'],
+            'sta_iv': gym_defender['sta_iv'],
+            'move_1': gym_defender['move_1'],
+            'move_2': gym_defender['move_2'],
+            'battles_attacked': gym_defender['battles_attacked'],
+            'battles_defended': gym_defender['battles_defended'],
+            'num_upgrades': gym_defender['num_upgrades'],
+            'team': team,
+            'last_modified': last_modified,
+        }
+        fingerprint = defender_fingerprint(row['cp'], row['stamina'], team, last_modified)
+        current[row['external_id']] = fingerprint
+        if row['external_id'] not in known:
+            row['created'] = now
+            inserts.append(row)
+        elif known[row['external_id']] != fingerprint:
+            updates.append(row)
+    removed = [defender for defender in known if defender not in current]
+
+    table = GymDefender.__table__
+    if removed:
+        session.execute(table.delete()
+            .where(and_(table.c.fort_id == fort_internal_id,
+                        table.c.external_id.in_(removed))))
+    if updates:
+        columns = [c for c in updates[0] if c not in ('fort_id', 'external_id')]
+        session.execute(table.update()
+            .where(and_(table.c.fort_id == fort_internal_id,
+                        table.c.external_id == bindparam('defender', type_=table.c.external_id.type)))
+            .values({c: bindparam(c + '_') for c in columns}),
+            [dict(((c + '_', row[c]) for c in columns), defender=row['external_id'])
+             for row in updates])
+    if inserts:
+        session.execute(table.insert(), inserts)
+    FORT_CACHE.defenders[external_id] = current
+
+
+def load_spawnpoint(session, spawn_id):
+    """Read a spawnpoint that spawns does not know about yet"""
+    spawnpoint = session.query(Spawnpoint) \
+        .filter(Spawnpoint.spawn_id == spawn_id) \
+        .first()
+    if not spawnpoint:
+        spawns.internal_ids[spawn_id] = None
+    # the row of a spawnpoint pending deletion is left uncached, it's
+    # still there if the spawnpoint is revived
+    elif spawn_id not in spawns.pending_delete:
+        spawns.load(spawnpoint)
+        return spawnpoint
 
 
+def spawnpoint_exists(session, spawn_id):
+    try:
+        return spawns.internal_ids[spawn_id] is not None
+    except KeyError:
+        return load_spawnpoint(session, spawn_id) is not None
+
 
 def add_spawnpoint(session, pokemon):
     # Check if the same entry already exists
     spawn_id = pokemon['spawn_id']
     new_time = pokemon['expire_timestamp'] % 3600
-    try:
-        if new_time == spawns.despawn_times[spawn_id]:
-            return
-    except KeyError:
-        pass
-    existing = session.query(Spawnpoint) \
-        .filter(Spawnpoint.spawn_id == spawn_id) \
-        .first()
+    old_time = spawns.despawn_times.get(spawn_id)
+    if new_time == old_time:
+        return
     now = int(time())
     point = pokemon['lat'], pokemon['lon']
+    spawns.revive(spawn_id)
+    existing = spawnpoint_exists(session, spawn_id)
     spawns.add_known(spawn_id, new_time, point)
+    spawns.updated_at[spawn_id] = now
     if existing:
-        existing.updated = now
-        existing.failures = 0
-
-        if (existing.despawn_time is None or
-                existing.updated < conf.LAST_MIGRATION):
+        values = {'updated': now, 'failures': 0, 'despawn_time': new_time}
+        # unknown spawnpoints, or ones last seen before LAST_MIGRATION
+        if old_time is None:
             widest = get_widest_range(session, spawn_id)
             if widest and widest > 1800:
-                existing.duration = 60
-        elif new_time == existing.despawn_time:
-            return
-
-        existing.despawn_time = new_time
+                values['duration'] = spawns.durations[spawn_id] = 60
+        session.query(Spawnpoint) \
+            .filter(Spawnpoint.spawn_id == spawn_id) \
+            .update(values, synchronize_session=False)
     else:
         widest = get_widest_range(session, spawn_id)
 
         duration = 60 if widest and widest > 1800 else None
 
-        session.add(Spawnpoint(
+        spawnpoint = Spawnpoint(
             spawn_id=spawn_id,
             despawn_time=new_time,
             lat=pokemon['lat'],
@@ -712,82 +1010,93 @@ def add_spawnpoint(session, pokemon):
             updated=now,
             duration=duration,
             failures=0
-        ))
+        )
+        session.add(spawnpoint)
+        session.flush()
+        spawns.load(spawnpoint)
 
 
-def touch_spawnpoint(session, spawn_id):
-    if spawn_id in spawns.internal_ids: 
-        internal_id = spawns.internal_ids[spawn_id]
+def touch_spawnpoint(session, spawn_id, now):
+    if spawnpoint_exists(session, spawn_id):
+        spawns.touch(spawn_id, now)
     else:
-        internal_id = session.query(Spawnpoint.id) \
-            .filter(Spawnpoint.spawn_id == spawn_id) \
-            .scalar()
-        spawns.internal_ids[spawn_id] = internal_id
-    now = int(time())
-    spawnpoint = session.query(Spawnpoint) \
-        .filter(Spawnpoint.id == internal_id) \
-        .first()
-    if spawnpoint:
-        spawnpoint.updated = now
-    return now
-
+        # don't look it up again for a while
+        spawns.updated_at[spawn_id] = now
 
-def add_mystery_spawnpoint(session, pokemon):
-    # Check if the same entry already exists
-    spawn_id = pokemon['spawn_id']
-    point = pokemon['lat'], pokemon['lon']
-    if point in spawns.unknown or session.query(exists().where(
-            Spawnpoint.spawn_id == spawn_id)).scalar():
-        return
 
-    session.add(Spawnpoint(
-        spawn_id=spawn_id,
-        despawn_time=None,
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-        updated=0,
-        duration=None,
-        failures=0
-    ))
-
-    if point in bounds:
-        spawns.add_unknown(point)
-
-
-def add_mystery(session, pokemon):
-    add_mystery_spawnpoint(session, pokemon)
-    existing = session.query(Mystery) \
-        .filter(Mystery.encounter_id == pokemon['encounter_id']) \
-        .filter(Mystery.spawn_id == pokemon['spawn_id']) \
-        .first()
-    if existing:
-        key = combine_key(pokemon)
-        MYSTERY_CACHE.store[key] = [existing.first_seen, pokemon['seen']]
-        return
+def mystery_row(pokemon):
     seconds = pokemon['seen'] % 3600
-    obj = Mystery(
-        pokemon_id=pokemon['pokemon_id'],
-        spawn_id=pokemon['spawn_id'],
-        encounter_id=pokemon['encounter_id'],
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-        first_seen=pokemon['seen'],
-        first_seconds=seconds,
-        last_seconds=seconds,
-        seen_range=0,
-        atk_iv=pokemon.get('individual_attack'),
-        def_iv=pokemon.get('individual_defense'),
-        sta_iv=pokemon.get('individual_stamina'),
-        move_1=pokemon.get('move_1'),
-        move_2=pokemon.get('move_2'),
-        gender=pokemon.get('gender', 0),
-        form=pokemon.get('form', 0),
-        cp=pokemon.get('cp'),
-        level=pokemon.get('level'),
-        weather_boosted_condition=pokemon.get('weather_boosted_condition', 0),
-        weather_cell_id=pokemon.get('weather_cell_id')
-    )
-    session.add(obj)
+    return {
+        'pokemon_id': pokemon['pokemon_id'],
+        'spawn_id': pokemon['spawn_id'],
+        'encounter_id': pokemon['encounter_id'],
+        'lat': pokemon['lat'],
+        'lon': pokemon['lon'],
+        'first_seen': pokemon['seen'],
+        'first_seconds': seconds,
+        'last_seconds': seconds,
+        'seen_range': 0,
+        'atk_iv': pokemon.get('individual_attack'),
+        'def_iv': pokemon.get('individual_defense'),
+        'sta_iv': pokemon.get('individual_stamina'),
+        'move_1': pokemon.get('move_1'),
+        'move_2': pokemon.get('move_2'),
+        'gender': pokemon.get('gender', 0),
+        'form': pokemon.get('form', 0),
+        'cp': pokemon.get('cp'),
+        'level': pokemon.get('level'),
+        'weather_boosted_condition': pokemon.get('weather_boosted_condition', 0),
+        'weather_cell_id': pokemon.get('weather_cell_id')
+    }
+
+
+def add_mysteries(session, mysteries):
+    """Save a batch of Pokemon with unknown expiration times
+
+    Spawnpoints that spawns doesn't know are inserted unless they exist,
+    and mysteries that were already saved are left alone: their seen
+    ranges are applied later by update_mysteries.
+    """
+    spawnpoints = OrderedDict()
+    rows = OrderedDict()
+    for pokemon in mysteries:
+        spawn_id = pokemon['spawn_id']
+        point = pokemon['lat'], pokemon['lon']
+        if not spawns.internal_ids.get(spawn_id) and point not in spawns.unknown:
+            spawnpoints[spawn_id] = {
+                'spawn_id': spawn_id,
+                'despawn_time': None,
+                'lat': pokemon['lat'],
+                'lon': pokemon['lon'],
+                'updated': 0,
+                'duration': None,
+                'failures': 0
+            }
+        key = pokemon['encounter_id'], spawn_id
+        if key not in rows:
+            rows[key] = mystery_row(pokemon)
+
+    upsert(session, Spawnpoint, list(spawnpoints.values()), keys=('spawn_id',))
+    for spawn_id, row in spawnpoints.items():
+        # forget that it didn't exist
+        spawns.internal_ids.pop(spawn_id, None)
+        point = row['lat'], row['lon']
+        if point in bounds:
+            spawns.add_unknown(point)
+    if PARTITIONED:
+        # the unique key includes first_seen, which differs when a mystery
+        # is seen again after a restart
+        table = Mystery.__table__
+        for encounter_ids in chunks({e for e, _ in rows}):
+            query = select([table.c.encounter_id, table.c.spawn_id]) \
+                .where(table.c.encounter_id.in_(encounter_ids))
+            for key in session.execute(query):
+                rows.pop(tuple(key), None)
+        keys = ('encounter_id', 'spawn_id', 'first_seen')
+    else:
+        keys = ('encounter_id', 'spawn_id')
+    upsert(session, Mystery, list(rows.values()), keys=keys)
+
 
 def get_fort_internal_id(session, external_id):
     if external_id in FORT_CACHE.internal_ids and FORT_CACHE.internal_ids[external_id]:
@@ -875,72 +1184,205 @@ def add_fort_sighting(session, raw_fort):
     if 'gym_defenders' in raw_fort and len(raw_fort['gym_defenders']) > 0:
         add_gym_defenders(session, internal_id, raw_fort['gym_defenders'], raw_fort)
 
-    if conf.KEEP_GYM_HISTORY:
-        fort_sighting = None
-    else:
-        fort_sighting = session.query(FortSighting) \
-                .filter(FortSighting.fort_id==internal_id) \
-                .order_by(desc(FortSighting.id)) \
-                .first()
-
-    if not fort_sighting:
-        fort_sighting = FortSighting()
-    
-    fort_sighting.fort_id = internal_id 
-    fort_sighting.team = raw_fort['team']
-    fort_sighting.guard_pokemon_id = raw_fort['guard_pokemon_id']
-    fort_sighting.last_modified = raw_fort['last_modified']
-    fort_sighting.slots_available = raw_fort['slots_available']
-    fort_sighting.is_in_battle = raw_fort['is_in_battle']
-    fort_sighting.updated = int(time())
+    return {
+        'fort_id': internal_id,
+        'team': raw_fort['team'],
+        'guard_pokemon_id': raw_fort['guard_pokemon_id'],
+        'last_modified': raw_fort['last_modified'],
+        'slots_available': raw_fort['slots_available'],
+        'is_in_battle': raw_fort['is_in_battle'],
+        'updated': int(time()),
+    }
 
-    session.merge(fort_sighting)
 
+def fort_state(row):
+    return tuple(row[c] for c in FORT_STATE)
 
-def add_raid(session, raw_raid):
-    fort_external_id = raw_raid['fort_external_id']
-    fort_id = get_fort_internal_id(session, fort_external_id)
 
-    raid = session.query(Raid) \
-        .filter(Raid.external_id == raw_raid['external_id']) \
-        .first()
-    if raid:
-        if raid.pokemon_id == 0 and raw_raid['pokemon_id'] != 0:
-            raid.pokemon_id = raw_raid['pokemon_id']
-            raid.cp = raw_raid['cp']
-            raid.move_1 = raw_raid['move_1']
-            raid.move_2 = raw_raid['move_2']
-            session.merge(raid)
-            touch_fort_sighting(session, fort_id)
-        return
+def add_fort_sightings(session, raw_forts):
+    """Save a batch of gym sightings
 
-    if fort_id:
+    Sightings that match the last one written for their gym are skipped,
+    unless their updated column is due for a refresh. Gyms whose sighting
+    row is known are updated by primary key, the others are upserted.
+    """
+    rows = OrderedDict()
+    for raw_fort in raw_forts:
+        row = add_fort_sighting(session, raw_fort)
         if conf.KEEP_GYM_HISTORY:
-            raid = None
+            rows[row['fort_id'], row['last_modified']] = raw_fort['external_id'], row
         else:
-            raid = session.query(Raid) \
-                    .filter(Raid.fort_id==fort_id) \
-                    .order_by(desc(Raid.id)) \
-                    .first()
+            rows[row['fort_id']] = raw_fort['external_id'], row
+
+    refresh = int(time()) - conf.FORT_SIGHTING_REFRESH
+    updates = []
+    inserts = []
+    for external_id, row in rows.values():
+        known = FORT_CACHE.sightings.get(external_id)
+        # with history a new last_modified is a new row
+        if known and (not conf.KEEP_GYM_HISTORY or known[1][-1] == row['last_modified']):
+            if known[1] == fort_state(row) and (known[2] or 0) > refresh:
+                FORT_CACHE.suppressed += 1
+                continue
+            updates.append((external_id, known[0], row))
+        else:
+            inserts.append((external_id, row))
+
+    # rows deleted by cleanup since they were cached are inserted again
+    inserts.extend(update_fort_sightings(session, updates))
+    ids = insert_fort_sightings(session, inserts)
+
+    written = [(sighting_id, row) for _, sighting_id, row in updates]
+    written.extend((ids[r['fort_id'], r['last_modified']], r) for _, r in inserts
+                   if (r['fort_id'], r['last_modified']) in ids)
+    update_fort_states(session, written)
+
+
+def insert_fort_sightings(session, inserts):
+    """Upsert (external_id, row), return the ids of their rows by
+    (fort_id, last_modified)"""
+    if not inserts:
+        return {}
+    upsert(session, FortSighting, [row for _, row in inserts],
+           keys=('fort_id', 'last_modified'),
+           update=('team', 'guard_pokemon_id', 'slots_available', 'is_in_battle', 'updated'))
+
+    table = FortSighting.__table__
+    if not conf.KEEP_GYM_HISTORY:
+        session.execute(table.delete()
+            .where(and_(table.c.fort_id == bindparam('fort'),
+                        table.c.last_modified != bindparam('last_modified_'))),
+            [{'fort': r['fort_id'], 'last_modified_': r['last_modified']} for _, r in inserts])
+    ids = {}
+    # only the written rows are read back, not the history of their gyms:
+    # both columns are filtered by IN and the pairs that weren't written
+    # are dropped here
+    for pairs in chunks({(r['fort_id'], r['last_modified']) for _, r in inserts}):
+        written = set(pairs)
+        query = select([table.c.id, table.c.fort_id, table.c.last_modified]) \
+            .where(and_(table.c.fort_id.in_({fort_id for fort_id, _ in pairs}),
+                        table.c.last_modified.in_({last_modified for _, last_modified in pairs})))
+        for sighting_id, fort_id, last_modified in session.execute(query):
+            if (fort_id, last_modified) in written:
+                ids[fort_id, last_modified] = sighting_id
+    for external_id, row in inserts:
+        sighting_id = ids.get((row['fort_id'], row['last_modified']))
+        known = FORT_CACHE.sightings.get(external_id)
+        # with history, the cache holds the latest sighting of the gym
+        if sighting_id is not None and (not known or known[1][-1] <= row['last_modified']):
+            FORT_CACHE.sightings[external_id] = sighting_id, fort_state(row), row['updated']
+    return ids
+
+
+def update_fort_states(session, written):
+    """Copy the latest of the (fort_sighting id, row) that were written
+    for each fort to fort_state"""
+    states = {}
+    for sighting_id, row in written:
+        latest = states.get(row['fort_id'])
+        if latest and latest['last_modified'] > row['last_modified']:
+            continue
+        states[row['fort_id']] = {
+            'fort_id': row['fort_id'],
+            'sighting_id': sighting_id,
+            'team': row['team'],
+            'guard_pokemon_id': row['guard_pokemon_id'],
+            'slots_available': row['slots_available'],
+            'is_in_battle': row['is_in_battle'],
+            'last_modified': row['last_modified'],
+            'updated': row['updated'],
+        }
+    upsert(session, FortState, list(states.values()),
+           keys=('fort_id',),
+           update=('sighting_id', 'team', 'guard_pokemon_id', 'slots_available',
+                   'is_in_battle', 'last_modified', 'updated'))
+
+
+def update_fort_sightings(session, updates):
+    """Update (external_id, fort_sighting id, row) in place, return the
+    (external_id, row) of those whose sighting no longer exists"""
+    if not updates:
+        return []
+    table = FortSighting.__table__
+    columns = FORT_STATE + ('updated',)
+    statement = table.update() \
+        .where(table.c.id == bindparam('sighting')) \
+        .values({c: bindparam(c + '_') for c in columns})
+
+    def params(sighting_id, row):
+        values = {c + '_': row[c] for c in columns}
+        values['sighting'] = sighting_id
+        return values
+
+    if session.get_bind().dialect.supports_sane_multi_rowcount:
+        result = session.execute(statement, [params(i, row) for _, i, row in updates])
+        # can't tell which ones are missing, upserting all of them is harmless
+        missing = updates if result.rowcount != len(updates) else ()
+    else:
+        missing = [(external_id, sighting_id, row) for external_id, sighting_id, row in updates
+                   if session.execute(statement, params(sighting_id, row)).rowcount == 0]
+    for external_id, sighting_id, row in updates:
+        FORT_CACHE.sightings[external_id] = sighting_id, fort_state(row), row['updated']
+    return [(external_id, row) for external_id, _, row in missing]
+
+
+def add_raids(session, raw_raids):
+    rows = OrderedDict()
+    for raw_raid in raw_raids:
+        fort_id = get_fort_internal_id(session, raw_raid['fort_external_id'])
+        if not fort_id:
+            continue
+        row = {
+            'external_id': raw_raid['external_id'],
+            'fort_id': fort_id,
+            'level': raw_raid['level'],
+            'pokemon_id': raw_raid['pokemon_id'],
+            'time_spawn': raw_raid['time_spawn'],
+            'time_battle': raw_raid['time_battle'],
+            'time_end': raw_raid['time_end'],
+            'cp': raw_raid['cp'],
+            'move_1': raw_raid['move_1'],
+            'move_2': raw_raid['move_2'],
+        }
+        if conf.KEEP_GYM_HISTORY:
+            rows[row['external_id']] = row
+        else:
+            rows[fort_id] = row
+    if not rows:
+        return
+    raids = list(rows.values())
+    upsert(session, Raid, raids,
+           keys=('external_id',),
+           update=('fort_id', 'level', 'pokemon_id', 'time_spawn', 'time_battle',
+                   'time_end', 'cp', 'move_1', 'move_2'))
+    if not conf.KEEP_GYM_HISTORY:
+        table = Raid.__table__
+        session.execute(table.delete()
+            .where(and_(table.c.fort_id == bindparam('fort'),
+                        table.c.external_id != bindparam('external'))),
+            [{'fort': r['fort_id'], 'external': r['external_id']} for r in raids])
+
+    touch_fort_sightings(session, {r['fort_id'] for r in raids})
+
+
+def touch_fort_sightings(session, fort_ids):
+    """Bump updated on the latest sighting and the state of each fort, so
+    that cleanup keeps forts with an ongoing raid."""
+    tables = [FortState.__table__]
+    if conf.KEEP_GYM_HISTORY:
+        for fort_id in fort_ids:
+            touch_fort_sighting(session, fort_id)
+    else:
+        # there is only one sighting per fort
+        tables.append(FortSighting.__table__)
+    params = [{'fort': fort_id} for fort_id in fort_ids]
+    for table in tables:
+        session.execute(table.update()
+            .where(table.c.fort_id == bindparam('fort'))
+            .values(updated=int(time())),
+            params)
+
 
-        if not raid:
-            raid = Raid()
-    
-        raid.external_id = raw_raid['external_id']
-        raid.fort_id = fort_id
-        raid.level = raw_raid['level']
-        raid.pokemon_id = raw_raid['pokemon_id']
-        raid.time_spawn = raw_raid['time_spawn']
-        raid.time_battle = raw_raid['time_battle']
-        raid.time_end = raw_raid['time_end']
-        raid.cp = raw_raid['cp']
-        raid.move_1 = raw_raid['move_1']
-        raid.move_2 = raw_raid['move_2']
-
-        session.merge(raid)
-        touch_fort_sighting(session, fort_id)
-
-        
 def touch_fort_sighting(session, fort_id):
     fort_sighting = session.query(FortSighting) \
             .filter(FortSighting.fort_id==fort_id) \
@@ -950,99 +1392,110 @@ def touch_fort_sighting(session, fort_id):
         fort_sighting.updated = int(time())
 
 
-def add_pokestop(session, raw_pokestop):
-    pokestop_id = raw_pokestop['external_id']
-
-    if session.query(exists().where(
-            Pokestop.external_id == pokestop_id)).scalar():
-        FORT_CACHE.pokestops[pokestop_id] = (raw_pokestop['lat'], raw_pokestop['lon'])
+def add_pokestops(session, raw_pokestops):
+    """Save a batch of pokestops
 
-        if pokestop_id in FORT_CACHE.pokestop_names:
-            return
-        elif raw_pokestop['name'] is None:
-            return 
-
-    pokestop = session.query(Pokestop) \
-        .filter(Pokestop.external_id == pokestop_id) \
-        .first()
-
-    if not pokestop:
-        pokestop = Pokestop(
-            external_id=pokestop_id,
-            lat=raw_pokestop['lat'],
-            lon=raw_pokestop['lon'],
-            name=raw_pokestop['name'],
-            url=raw_pokestop['url'],
-        )
+    FORT_CACHE.pokestops is the authority on which stops have a row, so
+    unknown stops are inserted in bulk and known ones only get their
+    missing name and url.
+    """
+    rows = OrderedDict()
+    names = OrderedDict()
+    now = int(time())
+    for raw_pokestop in raw_pokestops:
+        pokestop_id = raw_pokestop['external_id']
+        if pokestop_id not in FORT_CACHE.pokestops:
+            if pokestop_id in rows and raw_pokestop['name'] is None:
+                continue
+            rows[pokestop_id] = {
+                'external_id': pokestop_id,
+                'lat': raw_pokestop['lat'],
+                'lon': raw_pokestop['lon'],
+                'name': raw_pokestop['name'],
+                'url': raw_pokestop['url'],
+                'updated': now,
+            }
+        elif pokestop_id not in FORT_CACHE.pokestop_names and raw_pokestop['name'] is not None:
+            names[pokestop_id] = {
+                'stop': pokestop_id,
+                'name_': raw_pokestop['name'],
+                'url_': raw_pokestop['url'],
+                'updated_': now,
+            }
+
+    # another instance may have inserted the stop since the preload
+    upsert(session, Pokestop, list(rows.values()),
+           keys=('external_id',),
+           update=('updated',),
+           keep=('name', 'url'))
+    if names:
+        table = Pokestop.__table__
+        session.execute(table.update()
+            .where(table.c.external_id == bindparam('stop'))
+            .values(name=bindparam('name_'), url=bindparam('url_'), updated=bindparam('updated_')),
+            list(names.values()))
+
+    for pokestop_id, row in rows.items():
+        FORT_CACHE.pokestops[pokestop_id] = (row['lat'], row['lon'])
+        if row['name'] is not None:
+            FORT_CACHE.pokestop_names[pokestop_id] = row['name']
+    for pokestop_id, row in names.items():
+        FORT_CACHE.pokestop_names[pokestop_id] = row['name_']
+
+
+def update_failure(session, spawn_id, success, allowed=conf.FAILURES_ALLOWED):
+    if not spawnpoint_exists(session, spawn_id):
+        return
+    failures = spawns.failures.get(spawn_id, 0)
+    if success:
+        spawns.set_failures(spawn_id, 0)
+    elif failures >= allowed:
+        if spawns.durations.get(spawn_id) == 60:
+            spawns.set_duration(spawn_id, None)
+            spawns.set_failures(spawn_id, 0)
+            log.warning('{} consecutive failures on {}, no longer treating as an hour spawn.', allowed + 1, spawn_id)
+        elif conf.SB_DETECTOR:
+            spawns.mark_deleted(spawn_id)
+            log.warning('{} consecutive failures on {}, deleted.', allowed + 1, spawn_id)
+        else:
+            spawns.mark_unknown(spawn_id)
+            log.warning('{} consecutive failures on {}, will treat as an unknown from now on.', allowed + 1, spawn_id)
     else:
-        pokestop.name = raw_pokestop['name']
-        pokestop.url = raw_pokestop['url']
+        spawns.set_failures(spawn_id, failures + 1)
 
-    session.add(pokestop)
 
-    FORT_CACHE.pokestops[pokestop_id] = (raw_pokestop['lat'], raw_pokestop['lon'])
-    if raw_pokestop['name'] is not None:
-        FORT_CACHE.pokestop_names[pokestop_id] = raw_pokestop['name']
+def update_failures(session, targets):
+    """Count the outcome of visits in spawns, the resulting changes are
+    saved in bulk by spawns.flush()"""
+    for target in targets:
+        update_failure(session, target['spawn_id'], target['seen'])
 
 
-def update_failures(session, spawn_id, success, allowed=conf.FAILURES_ALLOWED):
-    spawnpoint = session.query(Spawnpoint) \
-        .filter(Spawnpoint.spawn_id == spawn_id) \
-        .first()
-    if not spawnpoint:
-        return
-    try:
-        if success:
-            spawnpoint.failures = 0
-        elif spawnpoint.failures >= allowed:
-            if spawnpoint.duration == 60:
-                spawnpoint.duration = None
-                spawnpoint.failures = 0
-                log.warning('{} consecutive failures on {}, no longer treating as an hour spawn.', allowed + 1, spawn_id)
-            elif conf.SB_DETECTOR:
-                session.delete(spawnpoint)
-                spawns.remove_known(spawn_id)
-                session.commit()
-                log.warning('{} consecutive failures on {}, deleted.', allowed + 1, spawn_id)
-                return
-            else:
-                spawnpoint.updated = 0
-                spawnpoint.failures = 0
-                spawns.remove_known(spawn_id)
-                session.commit()
-                log.warning('{} consecutive failures on {}, will treat as an unknown from now on.', allowed + 1, spawn_id)
-                return
-        else:
-            spawnpoint.failures += 1
-        spawns.failures[spawn_id] = spawnpoint.failures
-    except TypeError:
-        spawnpoint.failures = 1
-        spawns.failures[spawn_id] = spawnpoint.failures
-    session.commit()
-
-
-def update_mystery(session, mystery):
-    encounter = session.query(Mystery) \
-                .filter(Mystery.spawn_id == mystery['spawn']) \
-                .filter(Mystery.encounter_id == mystery['encounter']) \
-                .first()
-    if not encounter:
-        return
-    hour = encounter.first_seen - (encounter.first_seen % 3600)
-    encounter.last_seconds = mystery['last'] - hour
-    encounter.seen_range = mystery['last'] - mystery['first']
+def update_mysteries(session, mysteries):
+    """Apply the seen ranges of expired mysteries with one bulk UPDATE"""
+    table = Mystery.__table__
+    # the range starts at the saved first_seen, which is earlier than the
+    # cached one if the mystery was seen before a restart
+    last = bindparam('last', type_=Integer)
+    session.execute(table.update()
+        .where(and_(table.c.spawn_id == bindparam('spawn'),
+                    table.c.encounter_id == bindparam('encounter')))
+        .values(last_seconds=last - (table.c.first_seen - table.c.first_seen % 3600),
+                seen_range=last - table.c.first_seen),
+        [{'spawn': m['spawn'],
+          'encounter': m['encounter'],
+          'last': m['last']} for m in mysteries])
 
 
 def get_pokestops(session):
     return session.query(Pokestop).all()
 
 
-def _get_forts_sqlite(session):
-    # SQLite version is sloooooow compared to MySQL
+def get_forts(session):
     return session.execute('''
         SELECT
             fs.fort_id,
-            fs.id,
+            fs.sighting_id AS id,
             fs.team,
             fs.guard_pokemon_id,
             fs.last_modified,
@@ -1051,47 +1504,26 @@ def _get_forts_sqlite(session):
             f.name,
             f.url,
             fs.slots_available
-        FROM fort_sightings fs
+        FROM fort_state fs
         JOIN forts f ON f.id=fs.fort_id
-        WHERE fs.fort_id || '-' || fs.last_modified IN (
-            SELECT fort_id || '-' || MAX(last_modified)
-            FROM fort_sightings
-            GROUP BY fort_id
-        )
     ''').fetchall()
 
 
-def _get_forts(session):
-    return session.execute('''
-        SELECT
-            fs.fort_id,
-            fs.id,
-            fs.team,
-            fs.guard_pokemon_id,
-            fs.last_modified,
-            f.lat,
-            f.lon,
-            f.name,
-            f.url,
-            fs.slots_available
-        FROM fort_sightings fs
-        JOIN forts f ON f.id=fs.fort_id
-        WHERE (fs.fort_id, fs.last_modified) IN (
-            SELECT fort_id, MAX(last_modified)
-            FROM fort_sightings
-            GROUP BY fort_id
-        )
-    ''').fetchall()
-
-get_forts = _get_forts_sqlite if DB_TYPE == 'sqlite' else _get_forts
+def pokemon_counts(session):
+    """(pokemon_id, sightings) of every Pokemon seen, from the rollups"""
+    query = session.query(HourlyCount.pokemon_id, func.sum(HourlyCount.count)) \
+        .group_by(HourlyCount.pokemon_id)
+    if conf.REPORT_SINCE:
+        query = query.filter(HourlyCount.hour >= local_hour(SINCE_TIME))
+    # SUM is a decimal on MySQL
+    return [(pokemon_id, int(count)) for pokemon_id, count in query]
 
 
 def get_session_stats(session):
-    query = session.query(func.min(Sighting.expire_timestamp),
-        func.max(Sighting.expire_timestamp))
+    query = session.query(func.min(BucketCount.bucket), func.max(BucketCount.bucket))
     if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    min_max_result = query.one()
+        query = query.filter(BucketCount.bucket >= SINCE_TIME // 300)
+    min_max_result = [b * 300 for b in query.one()]
     length_hours = (min_max_result[1] - min_max_result[0]) // 3600
     if length_hours == 0:
         length_hours = 1
@@ -1140,11 +1572,10 @@ def estimate_remaining_time(session, spawn_id, seen):
 
 
 def get_punch_card(session):
-    query = session.query(cast(Sighting.expire_timestamp / 300, Integer).label('ts_date'), func.count('ts_date')) \
-        .group_by('ts_date') \
-        .order_by('ts_date')
+    query = session.query(BucketCount.bucket, BucketCount.count) \
+        .order_by(BucketCount.bucket)
     if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
+        query = query.filter(BucketCount.bucket >= SINCE_TIME // 300)
     results = query.all()
     results_dict = {r[0]: r[1] for r in results}
     filled = []
@@ -1154,22 +1585,12 @@ def get_punch_card(session):
 
 
 def get_top_pokemon(session, count=30, order='DESC'):
-    query = session.query(Sighting.pokemon_id, func.count(Sighting.pokemon_id).label('how_many')) \
-        .group_by(Sighting.pokemon_id)
-    if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    order = desc if order == 'DESC' else asc
-    query = query.order_by(order('how_many')).limit(count)
-    return query.all()
+    counts = sorted(pokemon_counts(session), key=lambda r: r[1], reverse=order == 'DESC')
+    return counts[:count]
 
 
 def get_pokemon_ranking(session):
-    query = session.query(Sighting.pokemon_id, func.count(Sighting.pokemon_id).label('how_many')) \
-        .group_by(Sighting.pokemon_id) \
-        .order_by(asc('how_many'))
-    if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    ranked = [r[0] for r in query]
+    ranked = [r[0] for r in sorted(pokemon_counts(session), key=lambda r: r[1])]
     none_seen = [x for x in range(1,387) if x not in ranked]
     return none_seen + ranked
 
@@ -1180,12 +1601,7 @@ def get_gym(session,raw_fort):
     return fort
 
 def get_sightings_per_pokemon(session):
-    query = session.query(Sighting.pokemon_id, func.count(Sighting.pokemon_id).label('how_many')) \
-        .group_by(Sighting.pokemon_id) \
-        .order_by('how_many')
-    if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    return OrderedDict(query.all())
+    return OrderedDict(sorted(pokemon_counts(session), key=lambda r: r[1]))
 
 
 def sightings_to_csv(since=None, output='sightings.csv'):
@@ -1208,85 +1624,61 @@ def sightings_to_csv(since=None, output='sightings.csv'):
 
 
 def get_rare_pokemon(session):
-    result = []
-
-    for pokemon_id in conf.RARE_IDS:
-        query = session.query(Sighting) \
-            .filter(Sighting.pokemon_id == pokemon_id)
-        if conf.REPORT_SINCE:
-            query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-        count = query.count()
-        if count > 0:
-            result.append((pokemon_id, count))
-    return result
+    counts = dict(pokemon_counts(session))
+    return [(pokemon_id, counts[pokemon_id]) for pokemon_id in conf.RARE_IDS
+            if counts.get(pokemon_id)]
 
 
 def get_nonexistent_pokemon(session):
-    query = session.execute('''
-        SELECT DISTINCT pokemon_id FROM sightings
-        {report_since}
-    '''.format(report_since=SINCE_QUERY))
-    db_ids = [r[0] for r in query]
+    db_ids = {r[0] for r in pokemon_counts(session)}
     return [x for x in range(1,387) if x not in db_ids]
 
 
 def get_all_sightings(session, pokemon_ids):
+    """Iterate over the pokemon_id, lat and lon of the sightings of
+    pokemon_ids, fetched from a server side cursor"""
     # TODO: rename this and get_sightings
-    query = session.query(Sighting) \
+    query = session.query(Sighting.pokemon_id, Sighting.lat, Sighting.lon) \
         .filter(Sighting.pokemon_id.in_(pokemon_ids))
     if conf.REPORT_SINCE:
         query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    return query.all()
+    return query.yield_per(STREAM_SIZE)
 
 
 def get_spawns_per_hour(session, pokemon_id):
-    if DB_TYPE == 'sqlite':
-        ts_hour = 'STRFTIME("%H", expire_timestamp)'
-    elif DB_TYPE == 'postgresql':
-        ts_hour = "TO_CHAR(TO_TIMESTAMP(expire_timestamp), 'HH24')"
-    else:
-        ts_hour = 'HOUR(FROM_UNIXTIME(expire_timestamp))'
-    query = session.execute('''
-        SELECT
-            {ts_hour} AS ts_hour,
-            COUNT(*) AS how_many
-        FROM sightings
-        WHERE pokemon_id = {pokemon_id}
-        {report_since}
-        GROUP BY ts_hour
-        ORDER BY ts_hour
-    '''.format(
-        pokemon_id=pokemon_id,
-        ts_hour=ts_hour,
-        report_since=SINCE_QUERY.replace('WHERE', 'AND')
-    ))
+    query = session.query(HourlyCount.hour, HourlyCount.count) \
+        .filter(HourlyCount.pokemon_id == pokemon_id)
+    if conf.REPORT_SINCE:
+        query = query.filter(HourlyCount.hour >= local_hour(SINCE_TIME))
+    per_hour = Counter()
+    for hour, count in query:
+        per_hour[hour % 24] += count
     results = []
-    for result in query:
+    for hour in sorted(per_hour):
         results.append((
             {
-                'v': [int(result[0]), 30, 0],
-                'f': '{}:00 - {}:00'.format(
-                    int(result[0]), int(result[0]) + 1
-                ),
+                'v': [hour, 30, 0],
+                'f': '{}:00 - {}:00'.format(hour, hour + 1),
             },
-            result[1]
+            per_hour[hour]
         ))
     return results
 
 
 def get_total_spawns_count(session, pokemon_id):
-    query = session.query(Sighting) \
-        .filter(Sighting.pokemon_id == pokemon_id)
+    query = session.query(func.sum(HourlyCount.count)) \
+        .filter(HourlyCount.pokemon_id == pokemon_id)
     if conf.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > SINCE_TIME)
-    return query.count()
+        query = query.filter(HourlyCount.hour >= local_hour(SINCE_TIME))
+    return int(query.scalar() or 0)
 
 
 def get_all_spawn_coords(session, pokemon_id=None):
+    """Iterate over the (lat, lon) of sightings, from a server side cursor"""
     points = session.query(Sighting.lat, Sighting.lon)
     if pokemon_id:
         points = points.filter(Sighting.pokemon_id == int(pokemon_id))
     if conf.REPORT_SINCE:
         points = points.filter(Sighting.expire_timestamp > SINCE_TIME)
-    return points.all()
+    return points.yield_per(STREAM_SIZE)
 
@@ -1,109 +1,549 @@
 import sys
+import json
 
-from queue import Queue
-from threading import Thread
-from time import sleep, time
+from collections import defaultdict, deque, OrderedDict
+from os import listdir
+from os.path import join, isdir
+from queue import Queue, Empty
+from threading import Thread, Lock, Condition, Event
+from time import time, monotonic
+from zlib import crc32
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from . import db, spawns, sanitized as conf
+from .journal import Journal, replay
+from .shared import get_logger
+
+class Lanes:
+    """The queues of a DB processor, one per lane. Lanes are read in
+    proportion to their weights, so a backlog in one lane doesn't hold up
+    the others, and none of them starves."""
+
+    def __init__(self, weights):
+        self.queues = OrderedDict((lane, Queue()) for lane in weights)
+        self.cycle = [lane for lane, weight in weights.items()
+                      for _ in range(max(int(weight), 1))]
+        self.position = 0
+        self.cond = Condition()
+        self.interrupted = False
+
+    def __len__(self):
+        return sum(q.qsize() for q in self.queues.values())
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return len(self) == 0
+
+    def depths(self):
+        return OrderedDict((lane, q.qsize()) for lane, q in self.queues.items())
+
+    def put(self, obj, lane):
+        self.queues[lane].put(obj)
+        with self.cond:
+            self.cond.notify()
+
+    def get_nowait(self):
+        for _ in range(len(self.cycle)):
+            lane = self.cycle[self.position]
+            self.position = (self.position + 1) % len(self.cycle)
+            try:
+                return self.queues[lane].get_nowait()
+            except Empty:
+                pass
+        raise Empty
+
+    def get(self, timeout=None):
+        """Like Queue.get, but also raises Empty once interrupted and empty"""
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cond:
+            while True:
+                try:
+                    return self.get_nowait()
+                except Empty:
+                    if self.interrupted:
+                        raise
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.cond.wait(remaining)
+
+    def interrupt(self):
+        with self.cond:
+            self.interrupted = True
+            self.cond.notify_all()
+
+
+def is_transient(error):
+    """Whether error is about the connection or the server rather than the
+    values written, so that the same items may be saved later"""
+    return isinstance(error, DBAPIError) and (
+        error.connection_invalidated or isinstance(error, (OperationalError, InterfaceError)))
+
+
+class Unavailable(Exception):
+    """The database couldn't be reached before the processor was stopped"""
 
-from . import db, spawns
-from .shared import get_logger, LOOP
 
 class DatabaseProcessor(Thread):
+    # Groups are written in this order within a batch. Forts go before raids
+    # so that a newly discovered fort has an internal id when its raid is saved.
+    ORDER = ('pokestop', 'fort', 'raid', 'pokemon', 'mystery', 'mystery-update', 'weather')
+    LANES = {
+        'pokemon': 'realtime',
+        'raid': 'realtime',
+        'fort': 'realtime',
+        'pokestop': 'realtime',
+        'mystery': 'background',
+        'mystery-update': 'background',
+        'target': 'background',
+        'weather': 'background',
+    }
+    DEAD_LETTERS = join(conf.DIRECTORY, 'dead_letters.jsonl')
+    HEARTBEAT_INTERVAL = 10
+    # failures of a batch while the database answers before it is split,
+    # some drivers report values they reject as operational errors
+    MAX_RETRIES = 3
+    MAX_RETRY_DELAY = 60
+    dead_letter_lock = Lock()
+    # held from taking weather cells to their commit, so that a writer
+    # flushing new cells first waits for those another writer took
+    weather_lock = Lock()
 
-    def __init__(self):
-        super().__init__()
-        self.queue = Queue()
-        self.log = get_logger('dbprocessor')
+    def __init__(self, name='dbprocessor', batch_size=conf.DB_BATCH_SIZE, batch_latency=conf.DB_BATCH_LATENCY):
+        super().__init__(name=name)
+        self.queue = Lanes(OrderedDict((lane, conf.DB_LANE_WEIGHTS.get(lane, 1))
+                                       for lane in ('realtime', 'background')))
+        self.log = get_logger(name)
         self.running = True
+        self.stopping = Event()
         self.count = 0
-        self._commit = False
         self.session = None
+        self.journals = []
+
+        self.batch_size = max(batch_size, 1)
+        self.batch_latency = batch_latency / 1000
+        self.batches = 0
+        self.saved = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        # (monotonic, saved) samples used for the items/sec figure
+        self.samples = deque(maxlen=60)
+        self.next_spawn_flush = monotonic() + conf.SPAWN_FLUSH_INTERVAL
+        self.next_weather_flush = monotonic() + conf.WEATHER_FLUSH_INTERVAL
+        # set on the processor that saves the heartbeat, returns the queue depth
+        self.backlog = None
+        self.next_heartbeat = 0
 
     def __len__(self):
         return self.queue.qsize()
 
     def stop(self):
-        self.update_mysteries()
         self.running = False
-        self.queue.put({'type': False})
+        self.stopping.set()
+        # without a journal the queue is drained first, otherwise whatever
+        # is left is replayed on the next start
+        self.queue.interrupt()
+
+    def open_journal(self, directory):
+        """Replace the queue of each lane with a journal in directory"""
+        for lane, queue in self.queue.queues.items():
+            journal = Journal('{}-{}'.format(directory, lane),
+                              segment_size=conf.JOURNAL_SEGMENT_SIZE,
+                              fsync_interval=conf.JOURNAL_FSYNC,
+                              memory_items=conf.JOURNAL_MEMORY_ITEMS)
+            # move items that were added before the start
+            while True:
+                try:
+                    journal.put(queue.get_nowait())
+                except Empty:
+                    break
+            self.queue.queues[lane] = journal
+            self.journals.append(journal)
 
     def add(self, obj):
-        self.queue.put(obj)
+        self.queue.put(obj, self.LANES.get(obj['type'], 'background'))
+
+    def depths(self):
+        return self.queue.depths()
+
+    @property
+    def avg_batch_size(self):
+        try:
+            return self.saved / self.batches
+        except ZeroDivisionError:
+            return 0.0
+
+    @property
+    def items_per_second(self):
+        try:
+            start, start_saved = self.samples[0]
+            end, end_saved = self.samples[-1]
+            return (end_saved - start_saved) / (end - start)
+        except (IndexError, ZeroDivisionError):
+            return 0.0
+
+    def get_batch(self):
+        """Wait for an item, then drain up to batch_size items or until
+        batch_latency has passed, whichever comes first."""
+        try:
+            batch = [self.queue.get(timeout=self.HEARTBEAT_INTERVAL if self.backlog else None)]
+        except Empty:
+            # stopped and nothing left to save, or idle
+            return []
+        deadline = monotonic() + self.batch_latency
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except Empty:
+                pass
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
 
     def run(self):
         session = db.Session()
         self.session = session
-        LOOP.call_soon_threadsafe(self.commit)
+        self.handlers = {
+            'pokemon': self.save_pokemon,
+            'mystery': db.add_mysteries,
+            'raid': db.add_raids,
+            'fort': db.add_fort_sightings,
+            'pokestop': db.add_pokestops,
+            'weather': self.Weather.add_weathers,
+            'mystery-update': db.update_mysteries,
+        }
+
+        while self.running or (not self.journals and not self.queue.empty()):
+            batch = self.get_batch()
+            # cells without a row go first, sightings may refer to them
+            self.flush_weather(session, monotonic() < self.next_weather_flush)
+            items = [item for item in batch if item['type'] != 'target']
+            targets = [item for item in batch if item['type'] == 'target']
 
-        while self.running or not self.queue.empty():
             try:
-                item = self.queue.get()
-                item_type = item['type']
-
-                if item_type == 'pokemon':
-                    spawn_id = item['spawn_id']
-                    if not item['inferred']:
-                        db.add_spawnpoint(session, item)
-                        spawns.updated_at[spawn_id] = int(time())
-                    else:
-                        # touch every 6 hours
-                        if (spawn_id > 0 and (spawn_id not in spawns.updated_at or spawns.updated_at[spawn_id] < (time() - 21600))):
-                            updated_at = db.touch_spawnpoint(session, spawn_id)
-                            spawns.updated_at[spawn_id] = updated_at
-                    db.add_sighting(session, item)
-                    self.count += 1
-
-                elif item_type == 'mystery':
-                    db.add_mystery(session, item)
-                    self.count += 1
-                elif item_type == 'raid':
-                    db.add_raid(session, item)
-                elif item_type == 'fort':
-                    db.add_fort_sighting(session, item)
-                elif item_type == 'pokestop':
-                    db.add_pokestop(session, item)
-                elif item_type == 'weather':
-                    self.Weather.add_weather(session, item)
-                elif item_type == 'target':
-                    db.update_failures(session, item['spawn_id'], item['seen'])
-                elif item_type == 'mystery-update':
-                    db.update_mystery(session, item)
-                elif item_type is False:
-                    break
-                self.log.debug('Item saved to db')
-                if self._commit:
+                saved = self.save(session, items) if items else 0
+            except Unavailable:
+                # not acknowledged, so replayed from the journal on the next start
+                self.log.warning('Database unavailable, {} items left in the journal.', len(items))
+                break
+            if targets:
+                # only counted in memory, so never retried
+                try:
+                    db.update_failures(session, targets)
                     session.commit()
-                    self._commit = False
-            except IntegrityError as e:
-                session.rollback()
-                self.log.error('A wild {} appeared in the DB processor!: {}', e.__class__.__name__, e.args[0])
+                    saved += len(targets)
+                except Exception as e:
+                    session.rollback()
+                    self.log.exception('A wild {} appeared in the DB processor!', e.__class__.__name__)
+            self.log.debug('{} items saved to db', saved)
+            self.count_batch(saved)
+            for journal in self.journals:
+                journal.ack()
+                journal.maybe_sync()
+
+            if monotonic() >= self.next_spawn_flush:
+                self.flush_spawns(session)
+            if self.backlog and monotonic() >= self.next_heartbeat:
+                self.save_heartbeat(session)
+        self.flush_spawns(session)
+        self.flush_weather(session)
+        session.close()
+        for journal in self.journals:
+            journal.close()
+
+    def write(self, session, items):
+        """Write items grouped by type, in one transaction"""
+        groups = defaultdict(list)
+        for item in items:
+            groups[item['type']].append(item)
+        for item_type in self.ORDER:
+            group = groups.get(item_type)
+            if group:
+                self.handlers[item_type](session, group)
+                # bulk statements bypass the unit of work, so pending
+                # objects must reach the DB before the next group
+                session.flush()
+        session.commit()
+        self.count += len(groups['pokemon']) + len(groups['mystery'])
+
+    def save(self, session, items):
+        """Write items. Batches that fail because of the connection or the
+        server are retried whole until they are saved, batches that fail
+        because of their values are retried in halves, until the items that
+        can't be saved are isolated. Returns how many items were saved."""
+        retries = 0
+        attempt = 0
+        while True:
+            try:
+                self.write(session, items)
+                return len(items)
             except Exception as e:
-                session.rollback()
-                self.log.exception('A wild {} appeared in the DB processor!', e.__class__.__name__)
+                error = e
+            session.rollback()
+            self.invalidate(items)
+            if not is_transient(error):
+                break
+            if self.reachable(session):
+                retries += 1
+                if retries > self.MAX_RETRIES:
+                    break
+            if not self.running:
+                if self.journals:
+                    raise Unavailable from error
+                # nothing would keep the items otherwise
+                break
+            delay = min(2 ** attempt, self.MAX_RETRY_DELAY)
+            attempt += 1
+            self.log.warning('A wild {} appeared in the DB processor, retrying {} items in {}s: {}',
+                             error.__class__.__name__, len(items), delay, error)
+            self.stopping.wait(delay)
+
+        if len(items) == 1:
+            self.dead_letter(items[0], error)
+            return 0
+        self.log.warning('A wild {} appeared in the DB processor, retrying {} items in halves: {}',
+                         error.__class__.__name__, len(items), error)
+        half = len(items) // 2
+        return self.save(session, items[:half]) + self.save(session, items[half:])
+
+    def reachable(self, session):
+        """Whether the database answers a query"""
         try:
-            session.commit()
+            session.execute(text('SELECT 1'))
+            return True
         except Exception:
-            pass
-        session.close()
+            return False
+        finally:
+            session.rollback()
+
+    def invalidate(self, items):
+        """Forget what was cached about rows written in a rolled back transaction"""
+        for item in items:
+            item_type = item['type']
+            if item_type == 'fort':
+                db.FORT_CACHE.remove_gym(item['external_id'])
+                db.FORT_CACHE.sponsors.pop(item['external_id'], None)
+            elif item_type == 'raid':
+                db.FORT_CACHE.internal_ids.pop(item['fort_external_id'], None)
+            elif item_type == 'pokestop':
+                db.FORT_CACHE.pokestops.pop(item['external_id'], None)
+                db.FORT_CACHE.pokestop_names.pop(item['external_id'], None)
+            elif item_type == 'pokemon' and not item['inferred']:
+                # so that the spawnpoint is written again
+                spawns.despawn_times.pop(item['spawn_id'], None)
+                spawns.internal_ids.pop(item['spawn_id'], None)
+
+    def dead_letter(self, item, error):
+        self.log.error('Could not save {} item, adding it to {}: {}', item['type'], self.DEAD_LETTERS, error)
+        line = json.dumps({'time': int(time()),
+                           'error': '{}: {}'.format(error.__class__.__name__, error),
+                           'item': item}, default=repr)
+        try:
+            with self.dead_letter_lock, open(self.DEAD_LETTERS, 'a') as f:
+                f.write(line + '\n')
+        except OSError as e:
+            self.log.error('Could not write dead letter: {}', e)
+
+    def flush_spawns(self, session):
+        """Save spawnpoint changes that were only kept in memory"""
+        self.next_spawn_flush = monotonic() + conf.SPAWN_FLUSH_INTERVAL
+        try:
+            flushed = spawns.flush(session)
+            if flushed:
+                self.log.debug('{} spawnpoints flushed to db', flushed)
+        except Exception as e:
+            self.log.exception('A wild {} appeared while flushing spawnpoints!', e.__class__.__name__)
+
+    def flush_weather(self, session, new_only=False):
+        """Save the weather states queued by the workers"""
+        if not new_only:
+            self.next_weather_flush = monotonic() + conf.WEATHER_FLUSH_INTERVAL
+        try:
+            with self.weather_lock:
+                flushed = self.Weather.flush(session, new_only)
+            if flushed:
+                self.log.debug('{} weather cells flushed to db', flushed)
+        except Exception as e:
+            self.log.exception('A wild {} appeared while flushing weather!', e.__class__.__name__)
+
+    def save_heartbeat(self, session):
+        """Let cleanup know that the scanner is running, and how far behind
+        it is"""
+        self.next_heartbeat = monotonic() + self.HEARTBEAT_INTERVAL
+        try:
+            db.save_heartbeat(session, self.backlog())
+        except Exception as e:
+            session.rollback()
+            self.log.exception('A wild {} appeared while saving the heartbeat!', e.__class__.__name__)
+
+    def count_batch(self, size):
+        if size:
+            self.batches += 1
+            self.saved += size
+            self.last_batch_size = size
+            if size > self.max_batch_size:
+                self.max_batch_size = size
+            self.samples.append((monotonic(), self.saved))
+
+    def save_pokemon(self, session, items):
+        now = int(time())
+        for item in items:
+            spawn_id = item['spawn_id']
+            if not item['inferred']:
+                db.add_spawnpoint(session, item)
+                spawns.updated_at[spawn_id] = now
+            # touch every 6 hours
+            elif (spawn_id > 0 and (spawn_id not in spawns.updated_at or spawns.updated_at[spawn_id] < (now - 21600))):
+                db.touch_spawnpoint(session, spawn_id, now)
+        db.add_sightings(session, items)
+
+
+
+class DatabaseProcessorPool:
+    """Spreads items over DB_WRITERS processors by a stable shard key, so
+    that everything about one spawnpoint, fort or cell is written in order
+    by the same thread."""
+
+    def __init__(self, writers=conf.DB_WRITERS):
+        if conf.DB_ENGINE.startswith('sqlite'):
+            writers = 1
+        writers = max(writers, 1)
+        if writers == 1:
+            self.writers = [DatabaseProcessor()]
+        else:
+            self.writers = [DatabaseProcessor('dbprocessor-{}'.format(i)) for i in range(writers)]
+        # one heartbeat for the pool, with the depth of every writer
+        self.writers[0].backlog = self.__len__
+        # counted items that never reach a processor
+        self.skipped = 0
+
+    def __len__(self):
+        return sum(len(w) for w in self.writers)
+
+    @staticmethod
+    def shard_key(obj):
+        item_type = obj['type']
+        if item_type == 'pokemon':
+            # lured Pokemon have no spawnpoint
+            return obj['spawn_id'] or obj['encounter_id']
+        elif item_type in ('mystery', 'target'):
+            return obj['spawn_id']
+        elif item_type == 'mystery-update':
+            return obj['spawn']
+        elif item_type in ('fort', 'pokestop'):
+            return obj['external_id']
+        elif item_type == 'raid':
+            # same writer as the fort, which must exist before its raid
+            return obj['fort_external_id']
+        elif item_type == 'weather':
+            return obj['s2_cell_id']
+        return 0
+
+    def route(self, obj):
+        if len(self.writers) == 1:
+            return self.writers[0]
+        key = self.shard_key(obj)
+        if isinstance(key, str):
+            key = crc32(key.encode())
+        return self.writers[key % len(self.writers)]
+
+    def add(self, obj):
+        self.route(obj).add(obj)
+
+    @property
+    def count(self):
+        return self.skipped + sum(w.count for w in self.writers)
+
+    @count.setter
+    def count(self, value):
+        self.skipped += value - self.count
+
+    @property
+    def Weather(self):
+        return self.writers[0].Weather
+
+    @Weather.setter
+    def Weather(self, value):
+        for writer in self.writers:
+            writer.Weather = value
+
+    @property
+    def batches(self):
+        return sum(w.batches for w in self.writers)
+
+    @property
+    def saved(self):
+        return sum(w.saved for w in self.writers)
+
+    @property
+    def last_batch_size(self):
+        return max(w.last_batch_size for w in self.writers)
+
+    @property
+    def max_batch_size(self):
+        return max(w.max_batch_size for w in self.writers)
+
+    @property
+    def avg_batch_size(self):
+        try:
+            return self.saved / self.batches
+        except ZeroDivisionError:
+            return 0.0
+
+    @property
+    def items_per_second(self):
+        return sum(w.items_per_second for w in self.writers)
+
+    def start(self):
+        if conf.JOURNAL:
+            self.open_journals(join(conf.DIRECTORY, 'journal'))
+        for writer in self.writers:
+            writer.start()
+
+    def open_journals(self, directory):
+        for i, writer in enumerate(self.writers):
+            writer.open_journal(join(directory, str(i)))
+        # journals of writers or lanes that were removed from the config
+        current = {'{}-{}'.format(i, lane) for i, writer in enumerate(self.writers)
+                   for lane in writer.queue.queues}
+        for name in listdir(directory):
+            path = join(directory, name)
+            if isdir(path) and name not in current:
+                count = replay(path, self.add)
+                if count:
+                    self.writers[0].log.warning('Moved {} items from DB journal {}.', count, path)
+
+    def depths(self):
+        depths = OrderedDict()
+        for writer in self.writers:
+            for lane, depth in writer.depths().items():
+                depths[lane] = depths.get(lane, 0) + depth
+        return depths
+
+    def is_alive(self):
+        return any(w.is_alive() for w in self.writers)
+
+    def stop(self):
+        # queued before the writers stop, behind the inserts they update
+        db.MYSTERY_CACHE.remove_all()
+        for writer in self.writers:
+            writer.stop()
+
+    def join(self, timeout=None):
+        for writer in self.writers:
+            writer.join(timeout)
 
-    def commit(self):
-        self._commit = True
-        if self.running:
-            LOOP.call_later(1, self.commit)
-
-    def update_mysteries(self):
-       for key, times in db.MYSTERY_CACHE.items():
-           first, last = times
-           if last != first:
-               encounter_id, spawn_id = key
-               mystery = {
-                   'type': 'mystery-update',
-                   'spawn': spawn_id,
-                   'encounter': encounter_id,
-                   'first': first,
-                   'last': last
-               }
-               self.add(mystery)
-
-sys.modules[__name__] = DatabaseProcessor()
+sys.modules[__name__] = DatabaseProcessorPool()
@@ -0,0 +1,268 @@
+"""Compact hash tables of 64-bit ids
+
+The sighting and mystery caches hold an entry per live Pokemon, millions of
+them in a large city. As dicts every entry costs a few boxed ints and a
+tuple, here it costs one slot of a few arrays: 8 bytes for the id and the
+size of the values, at a load of at most 3/4.
+"""
+
+from array import array
+from threading import Lock
+from time import time
+
+# slot markers, ids equal to them are kept in a dict
+EMPTY = 0
+DELETED = 2 ** 64 - 1
+MASK = 2 ** 64 - 1
+# Fibonacci hashing, spreads sequential ids too
+GOLDEN = 0x9E3779B97F4A7C15
+MIN_BITS = 10
+# slots moved to a resized table by each change
+STEP = 256
+
+
+class IdTable:
+    """Open addressing hash table of 64-bit ids to a row of integers, one
+    array per column of typecodes.
+
+    Resizing is incremental: a table sized for the ids is allocated, and
+    every change moves the next STEP slots of the previous one to it. Until
+    they are all moved, lookups check both.
+
+    With expiring set, the first column is the time the id expires at.
+    Expired ids aren't in the table anymore, they are left in place until
+    the next resize but neither len nor the size of the next table counts
+    them, give or take the ids that expired within the last minute.
+    """
+    def __init__(self, typecodes='I', expiring=False):
+        self.typecodes = typecodes
+        self.expiring = expiring
+        # {id: row} of the ids that collide with the markers
+        self.special = {}
+        # slots of the current table not EMPTY, and ids in the tables
+        self.used = 0
+        self.count = 0
+        # {minute: ids in the tables expiring in that minute}
+        self.expiries = {}
+        self.lock = Lock()
+        # (current table, table being moved to it or None), replaced at once
+        self.tables = self.empty_table(MIN_BITS), None
+        # next slot to move from the previous table
+        self.moved = 0
+
+    def empty_table(self, bits):
+        size = 1 << bits
+        columns = tuple(array(t, bytes(size * array(t).itemsize)) for t in self.typecodes)
+        return array('Q', bytes(size * 8)), columns, size - 1, 64 - bits
+
+    @property
+    def table(self):
+        """The current table"""
+        return self.tables[0]
+
+    def __len__(self):
+        if not self.expiring:
+            return self.count
+        minute = int(time()) // 60
+        return self.count - sum(n for m, n in list(self.expiries.items()) if m < minute)
+
+    def expire(self, until, change):
+        """Count an id expiring at until in or out"""
+        minute = until // 60
+        left = self.expiries.get(minute, 0) + change
+        if left:
+            self.expiries[minute] = left
+        else:
+            del self.expiries[minute]
+
+    @property
+    def nbytes(self):
+        return sum(keys.itemsize * len(keys) + sum(c.itemsize * len(c) for c in columns)
+                   for keys, columns, _, _ in filter(None, self.tables))
+
+    @staticmethod
+    def probe(table, key):
+        """(slot of key or -1, first free slot of its probe sequence)"""
+        keys, _, mask, shift = table
+        i = ((key * GOLDEN) & MASK) >> shift
+        free = -1
+        while True:
+            k = keys[i]
+            if k == key:
+                return i, free
+            if k == EMPTY:
+                return -1, i if free < 0 else free
+            if k == DELETED and free < 0:
+                free = i
+            i = (i + 1) & mask
+
+    def find(self, key):
+        """Row of key, None if it isn't in the tables. The previous table
+        is checked first, ids are written to the current one before being
+        removed from it."""
+        probe = self.probe
+        while True:
+            tables = self.tables
+            table, previous = tables
+            if previous is not None:
+                slot, _ = probe(previous, key)
+                if slot >= 0:
+                    return tuple(c[slot] for c in previous[1])
+            slot, _ = probe(table, key)
+            if slot >= 0:
+                return tuple(c[slot] for c in table[1])
+            # unless a resize started meanwhile
+            if self.tables is tables:
+                return None
+
+    def get(self, key, default=None):
+        """The row of key, default if it isn't in the table"""
+        key &= MASK
+        if key == EMPTY or key == DELETED:
+            row = self.special.get(key)
+        else:
+            row = self.find(key)
+        if row is None or (self.expiring and row[0] < time()):
+            return default
+        return row
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def place(self, table, key, row, slot=-1):
+        """Write key and row to a free slot of table, the first one of its
+        probe sequence unless given, key isn't in it"""
+        keys, columns, _, _ = table
+        if slot < 0:
+            _, slot = self.probe(table, key)
+        if keys[slot] == EMPTY:
+            self.used += 1
+        # the row first, so that readers never see key with another row
+        for column, value in zip(columns, row):
+            column[slot] = value
+        keys[slot] = key
+
+    def set(self, key, *row):
+        key &= MASK
+        with self.lock:
+            if key == EMPTY or key == DELETED:
+                replaced = self.special.get(key)
+                self.special[key] = row
+            else:
+                table, previous = self.tables
+                slot, free = self.probe(table, key)
+                if slot >= 0:
+                    replaced = tuple(c[slot] for c in table[1])
+                    for column, value in zip(table[1], row):
+                        column[slot] = value
+                else:
+                    self.place(table, key, row, free)
+                    moved = self.probe(previous, key)[0] if previous else -1
+                    if moved >= 0:
+                        replaced = tuple(c[moved] for c in previous[1])
+                        previous[0][moved] = DELETED
+                    else:
+                        replaced = None
+                if previous is not None:
+                    self.step()
+            if replaced is None:
+                self.count += 1
+            elif self.expiring:
+                self.expire(replaced[0], -1)
+            if self.expiring:
+                self.expire(row[0], 1)
+            if self.used * 4 > len(self.tables[0][0]) * 3:
+                self.resize()
+
+    def pop(self, key, default=None):
+        """Remove key and return its row, default if it isn't in the table"""
+        key &= MASK
+        with self.lock:
+            if key == EMPTY or key == DELETED:
+                row = self.special.pop(key, None)
+            else:
+                row = None
+                for table in filter(None, self.tables):
+                    slot, _ = self.probe(table, key)
+                    if slot >= 0:
+                        row = tuple(c[slot] for c in table[1])
+                        table[0][slot] = DELETED
+                        break
+                if self.tables[1] is not None:
+                    self.step()
+            if row is None:
+                return default
+            self.count -= 1
+            if self.expiring:
+                self.expire(row[0], -1)
+                if row[0] < time():
+                    return default
+            return row
+
+    def items(self):
+        """(id, row) of the ids in the table"""
+        now = time()
+        with self.lock:
+            # copies, the rows may move while they are iterated over
+            tables = [(keys[:], [c[:] for c in columns])
+                      for keys, columns, _, _ in filter(None, self.tables)]
+            special = list(self.special.items())
+        for keys, columns in tables:
+            for i, key in enumerate(keys):
+                if key != EMPTY and key != DELETED:
+                    row = tuple(c[i] for c in columns)
+                    if not self.expiring or row[0] >= now:
+                        yield key, row
+        for key, row in special:
+            if not self.expiring or row[0] >= now:
+                yield key, row
+
+    def step(self):
+        """Move the next slots of the previous table, dropping the expired
+        ids, called with the lock"""
+        table, previous = self.tables
+        if previous is None:
+            return
+        keys, columns, _, _ = previous
+        new_keys, new_columns, mask, shift = table
+        pairs = tuple(zip(columns, new_columns))
+        expiring = self.expiring
+        until = columns[0]
+        now = time()
+        end = min(self.moved + STEP, len(keys))
+        for i in range(self.moved, end):
+            key = keys[i]
+            if key == EMPTY or key == DELETED:
+                continue
+            if expiring and until[i] < now:
+                self.count -= 1
+                self.expire(until[i], -1)
+            else:
+                # like probe, the key isn't in the table
+                slot = ((key * GOLDEN) & MASK) >> shift
+                while new_keys[slot]:
+                    slot = (slot + 1) & mask
+                self.used += 1
+                for old, new in pairs:
+                    new[slot] = old[i]
+                new_keys[slot] = key
+            keys[i] = DELETED
+        self.moved = end
+        if end == len(keys):
+            self.tables = table, None
+
+    def resize(self):
+        """Start moving the ids to a table sized for them, called with the
+        lock"""
+        while self.tables[1] is not None:
+            self.step()
+        keys = self.tables[0][0]
+        # the ids that aren't expired, plus the ones that may be added
+        # until every slot is moved
+        needed = len(self) - len(self.special) + len(keys) // STEP + 1
+        bits = MIN_BITS
+        while needed * 2 > 1 << bits:
+            bits += 1
+        self.tables = self.empty_table(bits), self.tables[0]
+        self.used = 0
+        self.moved = 0
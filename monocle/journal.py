@@ -0,0 +1,303 @@
+import marshal
+import pickle
+
+from collections import deque
+from os import fsync, listdir, makedirs, remove, replace, rmdir
+from os.path import join
+from queue import Empty
+from struct import Struct
+from threading import Condition
+from time import monotonic
+from zlib import crc32
+
+from .shared import get_logger
+
+# length of the body, crc32 of the body
+HEADER = Struct('<II')
+# sequence number, codec
+BODY = Struct('<QB')
+MARSHAL = 0
+PICKLE = 1
+
+
+def encode(seq, obj):
+    try:
+        codec, payload = MARSHAL, marshal.dumps(obj)
+    except ValueError:
+        codec, payload = PICKLE, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    body = BODY.pack(seq, codec) + payload
+    return HEADER.pack(len(body), crc32(body)) + body
+
+
+def decode(body):
+    codec = body[BODY.size - 1]
+    payload = body[BODY.size:]
+    if codec == MARSHAL:
+        return marshal.loads(payload)
+    return pickle.loads(payload)
+
+
+def read_records(f):
+    """Yield (seq, body) from a segment file until its end, raise
+    ValueError on an incomplete or corrupt record."""
+    while True:
+        header = f.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise ValueError('incomplete record')
+        length, crc = HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length or crc32(body) != crc:
+            raise ValueError('corrupt record')
+        yield BODY.unpack_from(body)[0], body
+
+
+class Journal:
+    """Append-only log of the items of a DB processor, split in segment
+    files named after the sequence number of their first record.
+
+    Items are encoded into the write buffer of the segment before put()
+    returns, and kept in memory up to memory_items. Beyond that they are
+    only on disk and read back when the memory queue runs dry. ack() marks
+    everything handed out by get() as saved, and removes segments that are
+    fully saved. Records that weren't acknowledged are replayed when the
+    journal is opened again.
+
+    With fsync_interval above 0, put() makes no system call: the buffer is
+    written by maybe_sync(), which the DB processor calls after each batch,
+    and fsynced at most every fsync_interval seconds. A crash of the
+    process loses the items put since the last batch, at most a write
+    buffer of them (io.DEFAULT_BUFFER_SIZE bytes), and a crash of the
+    system the ones put since the last fsync. With 0 every put() is
+    written and fsynced before it returns.
+    """
+
+    def __init__(self, directory, segment_size=16777216, fsync_interval=1.0, memory_items=100000):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.memory_items = memory_items
+        self.log = get_logger('journal')
+
+        self.cond = Condition()
+        self.memory = deque()
+        self.interrupted = False
+        self.last_sync = monotonic()
+        self.unsynced = False
+
+        makedirs(directory, exist_ok=True)
+        self.acked = self.read_ack()
+        self.segments = sorted(int(name[:-4]) for name in listdir(directory)
+                               if name.endswith('.log'))
+        # next sequence number to hand out, and to write
+        self.read_seq = self.acked + 1
+        if self.segments:
+            self.read_seq = max(self.read_seq, self.segments[0])
+        self.next_seq = max(self.last_seq(), self.read_seq - 1) + 1
+        self.reader = None
+        self.reader_segment = None
+        self.records = None
+        # unacknowledged records from the last run are only on disk
+        self.spilling = self.next_seq > self.read_seq
+        if self.spilling:
+            self.log.warning('Replaying {} items from the DB journal in {}.',
+                             self.next_seq - self.read_seq, directory)
+        self.file = None
+        self.open_segment()
+
+    def __len__(self):
+        return self.next_seq - self.read_seq
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return len(self) == 0
+
+    def path(self, first_seq):
+        return join(self.directory, '{:020d}.log'.format(first_seq))
+
+    def read_ack(self):
+        try:
+            with open(join(self.directory, 'ack')) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_ack(self):
+        path = join(self.directory, 'ack')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.acked))
+        replace(path + '.tmp', path)
+
+    def last_seq(self):
+        if not self.segments:
+            return 0
+        last = self.segments[-1] - 1
+        with open(self.path(self.segments[-1]), 'rb') as f:
+            try:
+                for seq, _ in read_records(f):
+                    last = seq
+            except ValueError:
+                self.log.warning('DB journal segment {} ends with a corrupt record.', self.segments[-1])
+        return last
+
+    def open_segment(self):
+        """Start a new segment, never appending to one from an earlier run
+        that might end with a partial record"""
+        if self.file:
+            self.file.close()
+        if not self.segments or self.segments[-1] != self.next_seq:
+            self.segments.append(self.next_seq)
+        self.file = open(self.path(self.next_seq), 'ab')
+
+    def put(self, obj):
+        with self.cond:
+            record = encode(self.next_seq, obj)
+            if self.file.tell() + len(record) > self.segment_size and self.file.tell():
+                self.open_segment()
+            self.file.write(record)
+            self.unsynced = True
+            if self.fsync_interval <= 0:
+                self.sync()
+            if not self.spilling and len(self.memory) < self.memory_items:
+                self.memory.append(obj)
+            else:
+                self.spilling = True
+            self.next_seq += 1
+            self.cond.notify()
+
+    def get_nowait(self):
+        with self.cond:
+            obj = self.next_item()
+            if obj is None:
+                raise Empty
+            return obj
+
+    def get(self, timeout=None):
+        with self.cond:
+            deadline = None if timeout is None else monotonic() + timeout
+            while True:
+                obj = self.next_item()
+                if obj is not None:
+                    return obj
+                if self.interrupted:
+                    raise Empty
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self.cond.wait(remaining)
+
+    def next_item(self):
+        # items in memory are older than the ones that are only on disk
+        while self.spilling and not self.memory:
+            record = self.read_disk()
+            if record:
+                self.read_seq = record[0] + 1
+                return record[1]
+            self.spilling = False
+            self.close_reader()
+        if self.memory:
+            self.read_seq += 1
+            return self.memory.popleft()
+
+    def read_disk(self):
+        """Next record with a sequence number of at least read_seq, or None
+        once the reader caught up with the writer"""
+        # the buffered records are read too, and never half of one
+        self.file.flush()
+        while True:
+            if self.records is None:
+                segment = self.segment_of(self.read_seq)
+                if segment is None:
+                    return None
+                self.reader = open(self.path(segment), 'rb')
+                self.reader_segment = segment
+                self.records = read_records(self.reader)
+            try:
+                for seq, body in self.records:
+                    if seq >= self.read_seq:
+                        return seq, decode(body)
+            except ValueError:
+                self.log.error('Skipping the rest of DB journal segment {} after a corrupt record.', self.reader_segment)
+            # end of this segment, continue with the next one if there is one
+            following = [s for s in self.segments if s > self.reader_segment]
+            self.close_reader()
+            if not following:
+                return None
+            self.read_seq = max(self.read_seq, following[0])
+
+    def segment_of(self, seq):
+        found = None
+        for first in self.segments:
+            if first <= seq:
+                found = first
+        return found
+
+    def close_reader(self):
+        if self.reader:
+            self.reader.close()
+        self.reader = None
+        self.reader_segment = None
+        self.records = None
+
+    def ack(self):
+        """Mark every item handed out so far as saved"""
+        with self.cond:
+            if self.read_seq - 1 <= self.acked:
+                return
+            self.acked = self.read_seq - 1
+            self.write_ack()
+            while (len(self.segments) > 1 and self.segments[1] <= self.acked + 1
+                    and self.segments[0] != self.reader_segment):
+                remove(self.path(self.segments[0]))
+                del self.segments[0]
+
+    def sync(self):
+        if self.unsynced:
+            self.file.flush()
+            fsync(self.file.fileno())
+            self.unsynced = False
+        self.last_sync = monotonic()
+
+    def maybe_sync(self):
+        """Write the buffered records, and fsync them if the last fsync is
+        fsync_interval old"""
+        with self.cond:
+            if self.fsync_interval > 0 and monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+            else:
+                self.file.flush()
+
+    def interrupt(self):
+        """Wake up and stop a blocked get()"""
+        with self.cond:
+            self.interrupted = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.sync()
+            self.file.close()
+            self.close_reader()
+
+
+def replay(directory, add):
+    """Hand the unacknowledged records of a journal to add, then remove it"""
+    journal = Journal(directory)
+    count = 0
+    try:
+        while True:
+            add(journal.get_nowait())
+            count += 1
+    except Empty:
+        pass
+    journal.close()
+    for name in listdir(directory):
+        remove(join(directory, name))
+    rmdir(directory)
+    return count
@@ -4,7 +4,7 @@ from math import sqrt
 from time import monotonic, time
 from pkg_resources import resource_stream
 from tempfile import TemporaryFile
-from asyncio import gather, CancelledError, TimeoutError, Lock
+from asyncio import gather, CancelledError, TimeoutError, Event, Lock
 from base64 import b64encode
 from s2sphere import Cell, CellId, LatLng
 
@@ -25,7 +25,7 @@ from .web_utils import (
 
 from .db import session_scope, get_gym, get_pokemon_ranking, estimate_remaining_time, FORT_CACHE
 from .names import MOVES, POKEMON
-from .shared import get_logger, SessionManager, LOOP, run_threaded
+from .shared import get_logger, SessionManager, LOOP, EXPIRY, run_threaded
 from . import sanitized as conf
 
 import os
@@ -157,7 +157,7 @@ class NotificationCache:
 
     def add(self, item, delay):
         self.store.add(item)
-        return LOOP.call_later(delay, self.remove, item)
+        return EXPIRY.call_later(delay, self.remove, item)
 
     def remove(self, item):
         self.store.discard(item)
@@ -846,6 +846,8 @@ class Notification:
 class Notifier:
     
     db_access_lock = Lock(loop=LOOP)
+    # set once the caches are preloaded, what's known can't be told before
+    preloaded = Event(loop=LOOP)
 
     def __init__(self):
         self.cache = NotificationCache()
@@ -944,7 +946,7 @@ class Notifier:
     def cleanup(self, unique_id, handle):
         self.cache.remove(unique_id)
         if handle:
-            handle.cancel()
+            EXPIRY.cancel(handle)
         return False
 
     def unique_id(self, obj):
@@ -1016,7 +1018,7 @@ class Notifier:
                 self.log.exception('An exception occurred while trying to estimate remaining time.')
                 now_epoch = time()
                 tth = (pokemon['seen'] + 90 - now_epoch, pokemon['seen'] + 3600 - now_epoch)
-            cache_handle = LOOP.call_later(tth[1], self.cache.remove, unique_id)
+            cache_handle = EXPIRY.call_later(tth[1], self.cache.remove, unique_id)
             if pokemon_id not in self.always_notify:
                 mean = sum(tth) / 2
                 if mean < conf.TIME_REQUIRED:
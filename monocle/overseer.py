@@ -22,7 +22,7 @@ from .worker import Worker
 from .worker30 import Worker30, ENCOUNTER_CACHE
 from .worker_raider import WorkerRaider
 from .notification import Notifier
-from .weather import Weather 
+from .weather import Weather, WEATHER_CACHE
 from .parks import Parks
 
 
@@ -74,6 +74,9 @@ class Overseer:
         self.coroutines_count = 0
         self.skipped = 0
         self.visits = 0
+        # monotonic time of the launch, and seconds from it to the first visit
+        self.launched = monotonic()
+        self.first_visit = None
         self.coroutine_semaphore = Semaphore(conf.COROUTINES_LIMIT, loop=LOOP)
         self.redundant = 0
         self.running = True
@@ -258,19 +261,29 @@ class Overseer:
         counts_template = (
             'Known spawns: {}, unknown: {}, more: {}\n'
             'workers: {}, coroutines: {}\n'
-            'sightings cache: {}, mystery cache: {}, DB queue: {}\n'
+            'sightings cache: {}, mystery cache: {}, DB queue: {} ({})\n'
+            'cache memory: sightings {:.1f}MB, encounters {:.1f}MB, mysteries {:.1f}MB\n'
+            'DB items/sec: {:.1f}, batches: {}, batch size: last {}, avg {:.1f}, max {}, unchanged gyms skipped: {}\n'
         )
         try:
             self.counts = counts_template.format(
                 len(spawns), len(spawns.unknown), spawns.cells_count,
                 count, self.coroutines_count,
-                len(SIGHTING_CACHE), len(MYSTERY_CACHE), len(db_proc)
+                len(SIGHTING_CACHE), len(MYSTERY_CACHE), len(db_proc),
+                ', '.join('{} {}'.format(*d) for d in db_proc.depths().items()),
+                SIGHTING_CACHE.nbytes / 2 ** 20, ENCOUNTER_CACHE.nbytes / 2 ** 20,
+                MYSTERY_CACHE.nbytes / 2 ** 20,
+                db_proc.items_per_second, db_proc.batches,
+                db_proc.last_batch_size, db_proc.avg_batch_size, db_proc.max_batch_size,
+                FORT_CACHE.suppressed
             )
         except Exception as e:
             self.counts = counts_template.format(
                 0, 0, 0,
                 0, 0,
-                0, 0, 0
+                0, 0, 0, '',
+                0, 0, 0,
+                0, 0, 0, 0, 0, 0
             )
 
         if self.status_log_at < time() - 15.0:
@@ -468,18 +481,40 @@ class Overseer:
             else:
                 break
 
+    def preload_forts(self):
+        FORT_CACHE.preload()
+        FORT_CACHE.pickle()
+
+    async def preload(self):
+        """Fill the caches from the DB, each in its own thread"""
+        started = monotonic()
+        preloads = (self.preload_forts, SIGHTING_CACHE.preload, ENCOUNTER_CACHE.preload,
+                    RAID_CACHE.preload, WEATHER_CACHE.preload)
+        results = await gather(*(run_threaded(preload) for preload in preloads),
+                               loop=LOOP, return_exceptions=True)
+        for preload, result in zip(preloads, results):
+            if isinstance(result, Exception):
+                self.log.error('A wild {} appeared in {}: {}', result.__class__.__name__,
+                               preload.__qualname__, result)
+        self.log.info('Caches preloaded in {:.1f}s.', monotonic() - started)
+        # release the notifications and the raid and gym checks held meanwhile
+        Notifier.preloaded.set()
+        for cache in (SIGHTING_CACHE, ENCOUNTER_CACHE):
+            LOOP.call_later(60, cache.early.clear)
+
     async def launch(self, bootstrap, pickle):
         exceptions = 0
         self.next_mystery_reload = 0
-
-        #if not pickle or not spawns.unpickle():
+        self.launched = monotonic()
+
+        # start from the snapshot, and load what changed since it was taken
+        if pickle:
+            spawns.unpickle()
+        # scanning starts as soon as the spawns are loaded, the caches fill
+        # up meanwhile and notifications wait for them
+        self.preloader = LOOP.create_task(self.preload())
         await self.update_spawns(initial=True)
-
-        FORT_CACHE.preload()
-        FORT_CACHE.pickle()
-        SIGHTING_CACHE.preload()
-        ENCOUNTER_CACHE.preload()
-        RAID_CACHE.preload()
+        self.log.info('Spawn schedule ready after {:.1f}s.', monotonic() - self.launched)
 
         self.Worker30 = Worker30
         self.ENCOUNTER_CACHE = ENCOUNTER_CACHE
@@ -665,6 +700,9 @@ class Overseer:
 
                 if await worker.visit(point, spawn_id):
                     self.visits += 1
+                    if self.first_visit is None:
+                        self.first_visit = monotonic() - self.launched
+                        self.log.info('First visit {:.1f}s after launch.', self.first_visit)
         except CancelledError:
             raise
         except Exception:
@@ -0,0 +1,246 @@
+"""Time range partitions of the sightings tables
+
+With PARTITION_HOURS set on PostgreSQL (11 or later) or MySQL, the tables in
+TABLES are partitioned by range of their time column when migrating, each
+partition holding PARTITION_HOURS worth of rows. Cleanup then drops whole
+partitions instead of deleting rows.
+
+Rows outside of the partitions go to a default partition on PostgreSQL,
+they are moved to their partition when it is created. On MySQL, rows below
+the first partition go to the lowest partition.
+
+fort_sightings isn't partitioned: a gym that doesn't change keeps its only
+sighting, which fort_state refers to, for as long as it is scanned.
+"""
+
+import re
+
+from time import time
+
+from sqlalchemy import UniqueConstraint, inspect, text
+
+from .db import Sighting, Mystery
+from .shared import get_logger
+from . import sanitized as conf
+
+log = get_logger(__name__)
+
+# table, partition column, retention option
+TABLES = (
+    (Sighting.__table__, 'expire_timestamp', 'CLEANUP_SIGHTINGS_OLDER_THAN_X_HR'),
+    (Mystery.__table__, 'first_seen', 'CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR'),
+)
+COLUMNS = {table.name: column for table, column, _ in TABLES}
+# partitions are created this many intervals ahead
+AHEAD = 3
+
+
+def interval():
+    return int(conf.PARTITION_HOURS * 3600)
+
+
+def floor(timestamp):
+    return int(timestamp) // interval() * interval()
+
+
+def partition_name(conn, table, start):
+    if conn.dialect.name == 'mysql':
+        return 'p{}'.format(start)
+    return '{}_p{}'.format(table, start)
+
+
+def partitions(conn, table):
+    """Sorted starts of the range partitions of table, empty if it isn't
+    partitioned"""
+    if conn.dialect.name == 'postgresql':
+        query = '''
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = :table
+        '''
+    elif conn.dialect.name == 'mysql':
+        query = '''
+            SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table
+            AND PARTITION_NAME IS NOT NULL
+        '''
+    else:
+        return []
+    starts = []
+    for name, in conn.execute(text(query), table=table):
+        match = re.search(r'p(\d+)$', name)
+        if match:
+            starts.append(int(match.group(1)))
+    return sorted(starts)
+
+
+def partition_clauses(conn, starts):
+    """MySQL definitions of the partitions starting at starts"""
+    return ['PARTITION {} VALUES LESS THAN ({})'.format(
+                partition_name(conn, None, start), start + interval())
+            for start in starts]
+
+
+def create_partitions(conn, table, starts):
+    if not starts:
+        return
+    if conn.dialect.name == 'mysql':
+        clauses = partition_clauses(conn, starts)
+        clauses.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+        conn.execute('ALTER TABLE {} REORGANIZE PARTITION pmax INTO ({})'.format(
+            table, ', '.join(clauses)))
+    else:
+        # PostgreSQL refuses to create a partition for rows in the default one
+        column = COLUMNS[table]
+        moved = {'low': starts[0], 'high': starts[-1] + interval()}
+        in_range = '{} >= :low AND {} < :high'.format(column, column)
+        stragglers = conn.execute(text('SELECT 1 FROM {}_default WHERE {} LIMIT 1'.format(
+            table, in_range)), moved).first()
+        if stragglers:
+            log.warning('Moving rows of {} out of its default partition.', table)
+            conn.execute(text('CREATE TEMPORARY TABLE {0}_moved ON COMMIT DROP AS '
+                              'SELECT * FROM {0}_default WHERE {1}'.format(table, in_range)), moved)
+            conn.execute(text('DELETE FROM {}_default WHERE {}'.format(table, in_range)), moved)
+        for start in starts:
+            conn.execute('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})'.format(
+                partition_name(conn, table, start), table, start, start + interval()))
+        if stragglers:
+            conn.execute('INSERT INTO {0} SELECT * FROM {0}_moved'.format(table))
+
+
+def drop_partitions(conn, table, starts):
+    if not starts:
+        return
+    if conn.dialect.name == 'mysql':
+        conn.execute('ALTER TABLE {} DROP PARTITION {}'.format(
+            table, ', '.join(partition_name(conn, table, s) for s in starts)))
+    else:
+        for start in starts:
+            conn.execute('DROP TABLE {}'.format(partition_name(conn, table, start)))
+
+
+def has_rows_after(conn, table, start, max_id):
+    """Whether the partition of table starting at start holds rows with
+    an id above max_id"""
+    if conn.dialect.name == 'mysql':
+        source = '{} PARTITION ({})'.format(table, partition_name(conn, table, start))
+    else:
+        source = partition_name(conn, table, start)
+    return conn.execute(text('SELECT 1 FROM {} WHERE id > :max_id LIMIT 1'.format(source)),
+                        max_id=max_id).first() is not None
+
+
+def maintain(conn, table, older_than, max_id=None):
+    """Create the partitions of the next intervals and drop the ones that
+    only hold rows older than older_than, and none with an id above max_id
+    if given.
+
+    Returns the number of partitions dropped, None if table isn't partitioned.
+    """
+    starts = partitions(conn, table)
+    if not starts:
+        return None
+    now = int(time())
+    create_partitions(conn, table, list(range(
+        starts[-1] + interval(), floor(now) + (AHEAD + 1) * interval(), interval())))
+    if older_than is None:
+        return 0
+    expired = [s for s in starts if s + interval() <= older_than]
+    if max_id is not None:
+        # rows that weren't archived yet
+        expired = [s for s in expired if not has_rows_after(conn, table, s, max_id)]
+    drop_partitions(conn, table, expired)
+    return len(expired)
+
+
+def unique_columns(table, column, partitioned):
+    """(name, columns, changed) of the unique constraints of table, which
+    have to include the partition column when it's partitioned"""
+    for constraint in table.constraints:
+        if not isinstance(constraint, UniqueConstraint):
+            continue
+        columns = [c.name for c in constraint.columns]
+        changed = column not in columns
+        if partitioned and changed:
+            columns.append(column)
+        yield constraint.name, columns, changed
+
+
+def rebuild_postgresql(conn, table, column, partitioned, first_start=None):
+    """Copy table into a new table that is partitioned by column or not,
+    PostgreSQL can't change that in place"""
+    name = table.name
+    old = name + '_rebuild'
+    foreign_keys = inspect(conn).get_foreign_keys(name)
+    conn.execute('ALTER TABLE {} RENAME TO {}'.format(name, old))
+    conn.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS){}'.format(
+        name, old, ' PARTITION BY RANGE ({})'.format(column) if partitioned else ''))
+    # the sequence of the id goes with the old table otherwise
+    conn.execute('ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id'.format(name))
+    if partitioned:
+        conn.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(name))
+        create_partitions(conn, name, list(range(
+            first_start, floor(time()) + (AHEAD + 1) * interval(), interval())))
+    conn.execute('INSERT INTO {} SELECT * FROM {}'.format(name, old))
+    conn.execute('DROP TABLE {}'.format(old))
+
+    conn.execute('ALTER TABLE {} ADD PRIMARY KEY ({})'.format(
+        name, 'id, ' + column if partitioned else 'id'))
+    for constraint, columns, _ in unique_columns(table, column, partitioned):
+        conn.execute('ALTER TABLE {} ADD CONSTRAINT {} UNIQUE ({})'.format(
+            name, constraint, ', '.join(columns)))
+    for index in table.indexes:
+        index.create(conn)
+    for fk in foreign_keys:
+        conn.execute('ALTER TABLE {} ADD CONSTRAINT {} FOREIGN KEY ({}) REFERENCES {} ({})'.format(
+            name, fk['name'], ', '.join(fk['constrained_columns']),
+            fk['referred_table'], ', '.join(fk['referred_columns'])))
+
+
+def rebuild_mysql(conn, table, column, partitioned, first_start=None):
+    """Partition table by column or remove its partitioning. Partitioned
+    tables can't have foreign keys on MySQL, so they are dropped."""
+    name = table.name
+    if partitioned:
+        for fk in inspect(conn).get_foreign_keys(name):
+            conn.execute('ALTER TABLE {} DROP FOREIGN KEY {}'.format(name, fk['name']))
+    else:
+        conn.execute('ALTER TABLE {} REMOVE PARTITIONING'.format(name))
+    alters = ['DROP PRIMARY KEY', 'ADD PRIMARY KEY ({})'.format(
+        'id, ' + column if partitioned else 'id')]
+    for constraint, columns, changed in unique_columns(table, column, partitioned):
+        if not changed:
+            continue
+        alters.append('DROP INDEX {}'.format(constraint))
+        alters.append('ADD UNIQUE KEY {} ({})'.format(constraint, ', '.join(columns)))
+    conn.execute('ALTER TABLE {} {}'.format(name, ', '.join(alters)))
+    if partitioned:
+        clauses = partition_clauses(conn, range(
+            first_start, floor(time()) + (AHEAD + 1) * interval(), interval()))
+        clauses.append('PARTITION pmax VALUES LESS THAN MAXVALUE')
+        conn.execute('ALTER TABLE {} PARTITION BY RANGE ({}) ({})'.format(
+            name, column, ', '.join(clauses)))
+
+
+def partition_all(conn):
+    """Partition every table in TABLES, the first partition starting at the
+    retention of the table"""
+    rebuild = rebuild_mysql if conn.dialect.name == 'mysql' else rebuild_postgresql
+    now = time()
+    for table, column, option in TABLES:
+        if partitions(conn, table.name):
+            continue
+        log.info('Partitioning {} by {}...', table.name, column)
+        # the partition column becomes part of the primary key
+        conn.execute('DELETE FROM {} WHERE {} IS NULL'.format(table.name, column))
+        retention = max(getattr(conf, option), 0) * 3600
+        rebuild(conn, table, column, True, floor(now - retention))
+
+
+def unpartition_all(conn):
+    rebuild = rebuild_mysql if conn.dialect.name == 'mysql' else rebuild_postgresql
+    for table, column, _ in TABLES:
+        if partitions(conn, table.name):
+            log.info('Removing the partitions of {}...', table.name)
+            rebuild(conn, table, column, False)
@@ -28,6 +28,7 @@ _valid_types = {
     'ALWAYS_NOTIFY': int,
     'ALWAYS_NOTIFY_IDS': set_sequence_range,
     'APP_SIMULATION': bool,
+    'ARCHIVE_DIRECTORY': path,
     'AREA_NAME': str,
     'AUTHKEY': bytes,
     'BOOTSTRAP_RADIUS': Number,
@@ -35,18 +36,25 @@ _valid_types = {
     'CACHE_CELLS': bool,
     'CAPTCHAS_ALLOWED': int,
     'CAPTCHA_KEY': str,
+    'CLEANUP_CHUNK_SIZE': int,
     'CLEANUP_LIMIT': int,
+    'CLEANUP_PAUSE_QUEUE': int,
     'CLEANUP_RAIDS_OLDER_THAN_X_HR': Number,
     'CLEANUP_SIGHTINGS_OLDER_THAN_X_HR': Number,
     'CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR': Number,
     'CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR': Number,
+    'CLEANUP_ROWS_PER_SECOND': Number,
     'COMPLETE_TUTORIAL': bool,
     'COROUTINES_LIMIT': int,
     'DB': dict,
+    'DB_BATCH_LATENCY': Number,
+    'DB_BATCH_SIZE': int,
     'DB_ENGINE': str,
+    'DB_LANE_WEIGHTS': dict,
     'DB_POOL_RECYCLE': Number,
     'DB_POOL_SIZE': Number,
     'DB_MAX_OVERFLOW': Number,
+    'DB_WRITERS': int,
     'DIRECTORY': path,
     'DISCORD_INVITE_ID': str,
     'ENCOUNTER': str,
@@ -57,6 +65,7 @@ _valid_types = {
     'FB_PAGE_ID': str,
     'FIXED_OPACITY': bool,
     'FORCED_KILL': bool,
+    'FORT_SIGHTING_REFRESH': Number,
     'FULL_TIME': Number,
     'GIVE_UP_KNOWN': Number,
     'GIVE_UP_UNKNOWN': Number,
@@ -78,6 +87,10 @@ _valid_types = {
     'GMAP_EGG_ICONS_URL': str,
     'IGNORE_IVS': bool,
     'IGNORE_RARITY': bool,
+    'JOURNAL': bool,
+    'JOURNAL_FSYNC': Number,
+    'JOURNAL_MEMORY_ITEMS': int,
+    'JOURNAL_SEGMENT_SIZE': int,
     'IMAGE_STATS': bool,
     'INCUBATE_EGGS': bool,
     'INITIAL_SCORE': Number,
@@ -127,6 +140,7 @@ _valid_types = {
     'NOTIFY_RANKING': int,
     'NOTIFY_WEATHER': bool,
     'PARK_CHECK': bool,
+    'PARTITION_HOURS': Number,
     'PASS': str,
     'PB_API_KEY': str,
     'PB_CHANNEL': int,
@@ -165,6 +179,7 @@ _valid_types = {
     'SIMULTANEOUS_SIMULATION': int,
     'SKIP_SPAWN': Number,
     'SMART_THROTTLE': Number,
+    'SPAWN_FLUSH_INTERVAL': Number,
     'SPEED_LIMIT': Number,
     'SPEED_UNIT': str,
     'SPIN_COOLDOWN': Number,
@@ -191,6 +206,7 @@ _valid_types = {
     'USE_ANTICAPTCHA': bool,
     'UVLOOP': bool,
     'WEBHOOKS': set_sequence,
+    'WEATHER_FLUSH_INTERVAL': Number,
     'WEATHER_STATUS': dict,
     'WEBHOOK_GYM_MAPPING': dict,
     'WEBHOOK_RAID_MAPPING': dict, 
@@ -206,6 +222,7 @@ _defaults = {
     'ALWAYS_NOTIFY': 0,
     'ALWAYS_NOTIFY_IDS': set(),
     'APP_SIMULATION': True,
+    'ARCHIVE_DIRECTORY': None,
     'AREA_NAME': 'Area',
     'AUTHKEY': b'm3wtw0',
     'BOOTSTRAP_RADIUS': 120,
@@ -213,17 +230,24 @@ _defaults = {
     'CACHE_CELLS': False,
     'CAPTCHAS_ALLOWED': 3,
     'CAPTCHA_KEY': None,
-    'CLEANUP_LIMIT': 100000,
+    'CLEANUP_CHUNK_SIZE': 5000,
+    'CLEANUP_LIMIT': None,
+    'CLEANUP_PAUSE_QUEUE': 5000,
     'CLEANUP_RAIDS_OLDER_THAN_X_HR': 4.0,
     'CLEANUP_SIGHTINGS_OLDER_THAN_X_HR': 4.0,
     'CLEANUP_FORT_SIGHTINGS_OLDER_THAN_X_HR': 4.0,
     'CLEANUP_MYSTERY_SIGHTINGS_OLDER_THAN_X_HR': 48.0,
+    'CLEANUP_ROWS_PER_SECOND': 20000,
     'COMPLETE_TUTORIAL': False,
     'CONTROL_SOCKS': None,
     'COROUTINES_LIMIT': worker_count,
+    'DB_BATCH_LATENCY': 1000,
+    'DB_BATCH_SIZE': 500,
+    'DB_LANE_WEIGHTS': {'realtime': 4, 'background': 1},
     'DB_POOL_RECYCLE': 299,
     'DB_POOL_SIZE': 5,
     'DB_MAX_OVERFLOW': 10,
+    'DB_WRITERS': 1,
     'DIRECTORY': '.',
     'DISCORD_INVITE_ID': None,
     'ENCOUNTER': None,
@@ -234,6 +258,7 @@ _defaults = {
     'FB_PAGE_ID': None,
     'FIXED_OPACITY': False,
     'FORCED_KILL': None,
+    'FORT_SIGHTING_REFRESH': 600,
     'FULL_TIME': 1800,
     'GIVE_UP_KNOWN': 300,
     'GIVE_UP_UNKNOWN': 1500,
@@ -251,6 +276,10 @@ _defaults = {
     'GMAP_EGG_ICONS_URL': "https://raw.githubusercontent.com/M4d40/my-po-icons/master/Original-Assets-16x16/egg_{}.png",
     'IGNORE_IVS': False,
     'IGNORE_RARITY': False,
+    'JOURNAL': False,
+    'JOURNAL_FSYNC': 1.0,
+    'JOURNAL_MEMORY_ITEMS': 100000,
+    'JOURNAL_SEGMENT_SIZE': 16777216,
     'IMAGE_STATS': False,
     'INCUBATE_EGGS': True,
     'INITIAL_RANKING': None,
@@ -297,6 +326,7 @@ _defaults = {
     'NOTIFY_RANKING': None,
     'PARK_CHECK': True,
     'NOTIFY_WEATHER': True,
+    'PARTITION_HOURS': None,
     'PASS': None,
     'PB_API_KEY': None,
     'PB_CHANNEL': None,
@@ -332,6 +362,7 @@ _defaults = {
     'SIMULTANEOUS_SIMULATION': 4,
     'SKIP_SPAWN': 1500,
     'SMART_THROTTLE': False,
+    'SPAWN_FLUSH_INTERVAL': 5,
     'SPEED_LIMIT': 19.5,
     'SPEED_UNIT': 'miles',
     'SPIN_COOLDOWN': 300,
@@ -359,6 +390,7 @@ _defaults = {
     'UVLOOP': True,
     'WEBHOOK_GYM_MAPPING': {},
     'WEBHOOKS': None,
+    'WEATHER_FLUSH_INTERVAL': 60,
     'WEATHER_STATUS': {0: "Not boosted", 1: "Clear", 2: "Rainy", 3: "Partly Cloudy",
         4: "Overcast", 5: "Windy", 6: "Snow", 7: "Fog"},
     'WEBHOOK_RAID_MAPPING': {},
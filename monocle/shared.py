@@ -1,5 +1,6 @@
 from logging import getLogger, LoggerAdapter
 from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from time import time
 from asyncio import get_event_loop
 
@@ -72,6 +73,80 @@ def call_at(when, cb, *args):
     return call_later(delay, cb, *args)
 
 
+class ExpiryWheel:
+    """Callbacks bucketed by the second they are due at, all run by one
+    timer ticking every second instead of an event loop timer each.
+
+    The caches schedule the removal of every entry they hold, so this keeps
+    the loop's timer heap small. Scheduling is thread-safe, and only wakes
+    the loop up when the wheel was idle.
+    """
+    def __init__(self):
+        # {unix second: [[callback, args]]}
+        self.buckets = {}
+        self.lock = Lock()
+        # first second that wasn't run yet
+        self.cursor = int(time())
+        self.ticking = False
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def call_at(self, when, cb, *args):
+        """Run callback at the unix time given, up to a second late. Returns
+        the entry to pass to cancel."""
+        entry = [cb, args]
+        second = int(-(-when // 1))
+        with self.lock:
+            if second < self.cursor:
+                second = self.cursor
+            try:
+                self.buckets[second].append(entry)
+            except KeyError:
+                self.buckets[second] = [entry]
+            if not self.ticking:
+                self.ticking = True
+                LOOP.call_soon_threadsafe(self.tick)
+        return entry
+
+    def call_later(self, delay, cb, *args):
+        return self.call_at(time() + delay, cb, *args)
+
+    @staticmethod
+    def cancel(entry):
+        entry[0] = None
+
+    def take(self, now):
+        """Remove and return the buckets due at now"""
+        with self.lock:
+            if now - self.cursor > len(self.buckets):
+                # after a long stall, or a jump of the clock
+                seconds = sorted(s for s in self.buckets if s <= now)
+            else:
+                seconds = range(self.cursor, now + 1)
+            due = [self.buckets.pop(s) for s in seconds if s in self.buckets]
+            self.cursor = max(self.cursor, now + 1)
+            return due
+
+    def tick(self):
+        now = time()
+        for bucket in self.take(int(now)):
+            for cb, args in bucket:
+                if cb is None:
+                    continue
+                try:
+                    cb(*args)
+                except Exception:
+                    get_logger('expiry').exception('A wild exception appeared in {}', cb)
+        with self.lock:
+            self.ticking = bool(self.buckets)
+            if self.ticking:
+                LOOP.call_later(1 - now % 1, self.tick)
+
+
+EXPIRY = ExpiryWheel()
+
+
 async def run_threaded(cb, *args):
     with ThreadPoolExecutor(max_workers=1) as x:
         return await LOOP.run_in_executor(x, cb, *args)
@@ -93,7 +168,7 @@ class TtlCache:
     def add(self, key):
         now = time()
         self.store[key] = True 
-        call_at(now + self.ttl, self.remove, key)
+        EXPIRY.call_at(now + self.ttl, self.remove, key)
 
     def __contains__(self, key):
         return key in self.store
@@ -0,0 +1,237 @@
+"""Binary snapshots of the caches that are saved between runs
+
+A snapshot is a file in the pickles folder made of a fixed header, a JSON
+header and one little endian array per section, each aligned to 8 bytes:
+
+    MCS1 | version | header length | {"meta": {...}, "sections": [...]} | arrays
+
+Sections are mapped with mmap and read through memoryviews, so loading
+doesn't unpickle anything nor create an object per entry. Files are written
+to a temporary file first and renamed, so a crash never leaves a partial
+snapshot behind.
+"""
+
+import json
+import sys
+
+from array import array
+from bisect import bisect_left
+from mmap import mmap, ACCESS_READ
+from os import makedirs, replace
+from os.path import join
+from struct import Struct
+
+from . import bounds, sanitized as conf
+from .shared import get_logger
+
+log = get_logger(__name__)
+
+MAGIC = b'MCS1'
+VERSION = 1
+HEADER = Struct('<4sII')
+ALIGN = 8
+# stored in integer sections for keys without a value, and for None values
+MISSING = -2
+NULL = -1
+
+
+def path(name):
+    return join(conf.DIRECTORY, 'pickles', '{}.snapshot'.format(name))
+
+
+def dump(name, meta, sections):
+    """Write meta, a JSON serializable dict, and sections, a list of
+    (name, array), to the snapshot called name"""
+    layout = []
+    offset = 0
+    for section, values in sections:
+        layout.append([section, values.typecode, offset, len(values)])
+        offset += -(-len(values) * values.itemsize // ALIGN) * ALIGN
+    header = json.dumps({'meta': meta, 'sections': layout}).encode()
+    header += b' ' * (-(HEADER.size + len(header)) % ALIGN)
+
+    location = path(name)
+    makedirs(join(conf.DIRECTORY, 'pickles'), exist_ok=True)
+    with open(location + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for _, values in sections:
+            if sys.byteorder == 'big':
+                values = array(values.typecode, values)
+                values.byteswap()
+            data = values.tobytes()
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGN))
+    replace(location + '.tmp', location)
+
+
+def load(name):
+    """Map the snapshot called name, raises FileNotFoundError if there is
+    none and ValueError if it isn't a valid snapshot"""
+    return Snapshot(path(name))
+
+
+class Snapshot:
+    """A mapped snapshot, its sections are memoryviews into the file"""
+
+    def __init__(self, location):
+        with open(location, 'rb') as f:
+            try:
+                self.map = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError as e:
+                raise ValueError('{} is empty'.format(location)) from e
+        self.views = []
+        try:
+            magic, version, length = HEADER.unpack_from(self.map)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('{} is not a version {} snapshot'.format(location, VERSION))
+            start = HEADER.size + length
+            header = json.loads(self.map[HEADER.size:start].decode())
+            self.meta = header['meta']
+            self.sections = {}
+            for section, typecode, offset, count in header['sections']:
+                size = array(typecode).itemsize
+                if start + offset + count * size > len(self.map):
+                    raise ValueError('{} is truncated'.format(location))
+                self.sections[section] = typecode, start + offset, count, size
+        except Exception as e:
+            self.map.close()
+            if isinstance(e, ValueError):
+                raise
+            raise ValueError('{} is not a valid snapshot'.format(location)) from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, section):
+        return section in self.sections
+
+    def __getitem__(self, section):
+        typecode, offset, count, size = self.sections[section]
+        raw = memoryview(self.map)[offset:offset + count * size]
+        if sys.byteorder == 'big':
+            values = array(typecode, raw.tobytes())
+            raw.release()
+            values.byteswap()
+            return values
+        values = raw.cast(typecode)
+        self.views.extend((raw, values))
+        return values
+
+    def matches(self, class_version, db_hash):
+        """Whether the snapshot was taken with the current configuration,
+        the same checks as the pickles use"""
+        meta = self.meta
+        return all((meta.get('class_version') == class_version,
+                    meta.get('db_hash') == db_hash.hex(),
+                    meta.get('bounds_hash') == hash(bounds),
+                    meta.get('last_migration') == conf.LAST_MIGRATION))
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.map.close()
+
+
+def checked_meta(class_version, db_hash, **extra):
+    """The meta that Snapshot.matches checks, with extra values"""
+    extra.update(class_version=class_version,
+                 db_hash=db_hash.hex(),
+                 bounds_hash=hash(bounds),
+                 last_migration=conf.LAST_MIGRATION)
+    return extra
+
+
+def column(typecode, keys, mapping):
+    """Array of the values of mapping at keys, MISSING for the keys it doesn't
+    have and NULL for None, or NaN for both in float arrays"""
+    if typecode in 'fd':
+        missing = null = float('nan')
+    else:
+        missing, null = MISSING, NULL
+    get = mapping.get
+    return array(typecode, (null if value is None else value
+                            for value in (get(key, missing) for key in keys)))
+
+
+def restore(keys, values):
+    """Dict of the keys and values of a column, without the MISSING ones"""
+    return {key: None if value == NULL else value
+            for key, value in zip(keys, values) if value != MISSING}
+
+
+def cell_key(point):
+    """Integer key of a point rounded to 4 decimals, they sort by lat then lon"""
+    return (round(point[0] * 10000) + 900000) * 3600001 + round(point[1] * 10000) + 1800000
+
+
+class CellTable:
+    """{rounded point: cell ids} read from the cells snapshot, points added
+    since are kept in a dict until the next dump"""
+
+    def __init__(self, name='cells'):
+        self.name = name
+        self.added = {}
+        self.snapshot = None
+        self.keys = ()
+        try:
+            self.snapshot = load(name)
+            self.keys = self.snapshot['keys']
+            self.offsets = self.snapshot['offsets']
+            self.ids = self.snapshot['ids']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            log.warning('Invalid {} snapshot, computing cell ids again.', name)
+            if self.snapshot:
+                self.snapshot.close()
+                self.snapshot = None
+            self.keys = ()
+
+    def __len__(self):
+        return len(self.keys) + len(self.added)
+
+    def __getitem__(self, point):
+        try:
+            return self.added[point]
+        except KeyError:
+            pass
+        key = cell_key(point)
+        keys = self.keys
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            raise KeyError(point)
+        return array('Q', self.ids[self.offsets[i]:self.offsets[i + 1]])
+
+    def __setitem__(self, point, cells):
+        self.added[point] = cells
+
+    def dump(self):
+        """Write the mapped and added points to the snapshot"""
+        added = sorted((cell_key(point), cells) for point, cells in self.added.items())
+        keys = array('q')
+        offsets = array('I', (0,))
+        ids = array('Q')
+        mapped = len(self.keys)
+        i = 0
+        for key, cells in added:
+            while i < mapped and self.keys[i] < key:
+                keys.append(self.keys[i])
+                ids.extend(self.ids[self.offsets[i]:self.offsets[i + 1]])
+                offsets.append(len(ids))
+                i += 1
+            if i < mapped and self.keys[i] == key:
+                i += 1
+            keys.append(key)
+            ids.extend(cells)
+            offsets.append(len(ids))
+        if i < mapped:
+            keys.extend(self.keys[i:])
+            start = self.offsets[i]
+            ids.extend(self.ids[start:])
+            offsets.extend(offset - start + offsets[-1] for offset in self.offsets[i + 1:])
+        dump(self.name, {}, [('keys', keys), ('offsets', offsets), ('ids', ids)])
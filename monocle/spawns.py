@@ -1,17 +1,30 @@
 import sys
 
+from array import array
 from collections import deque, OrderedDict
 from time import time
 from itertools import chain
 from hashlib import sha256
+from threading import Lock
+from math import isnan
 
-from . import bounds, db, sanitized as conf
+from sqlalchemy import bindparam
+
+from . import bounds, db, snapshot, sanitized as conf
 from .shared import get_logger
-from .utils import dump_pickle, load_pickle, get_current_hour, time_until_time
+from .utils import get_current_hour, time_until_time
+
+
+def spawn_seconds(item):
+    # MoreSpawns keeps placeholders for points added since the last update
+    return item[1][1] if item[1] else 0
 
 
 class BaseSpawns:
     """Manage spawn points and times"""
+    # seconds of updated re-read by each update, for rows saved during the last one
+    WATERMARK_OVERLAP = 300
+
     def __init__(self):
         ## Spawns with known times
         # {(lat, lon): (spawn_id, spawn_seconds)}
@@ -25,6 +38,22 @@ class BaseSpawns:
         self.spawn_timestamps = {}
         # {spawn_id: failure count}
         self.failures = {}
+        # {spawn_id: spawnpoints.duration}
+        self.durations = {}
+        # spawn_ids whose updated, failures or duration changed since the last flush
+        self.dirty = set()
+        # spawn_ids to reset to unknown or delete at the next flush
+        self.pending_unknown = set()
+        self.pending_delete = set()
+        # {spawn_id: whether its point becomes unknown}, removed from known at the next update
+        self.tombstones = {}
+        # {spawn_id: (lat, lon)} of the spawns in known
+        self.points = {}
+        # highest updated of the rows loaded so far
+        self.watermark = 0
+        # points added to known since the last update, kept when it's replaced
+        self.placeholders = set()
+        self.lock = Lock()
 
         ## Spawns with unknown times
         # {(lat, lon)}
@@ -32,7 +61,7 @@ class BaseSpawns:
 
         self.have_point_cache = {}
 
-        self.class_version = 3.1 
+        self.class_version = 3.3
         self.db_hash = sha256(conf.DB_ENGINE.encode()).digest()
         self.log = get_logger('spawns')
 
@@ -43,42 +72,178 @@ class BaseSpawns:
         return len(self.despawn_times) > 0
 
     def update(self):
+        """Load the spawnpoints saved since the last update, all of them the
+        first time, and drop the ones that were tombstoned"""
         bound = bool(bounds)
         last_migration = conf.LAST_MIGRATION
+        initial = not self.watermark
+        watermark = self.watermark
+        # {(lat, lon): (spawn_id, spawn_seconds)} of the rows loaded
+        entries = {}
+        resort = False
+        changed = 0
 
         with db.session_scope() as session:
-            query = session.query(db.Spawnpoint)
-            query = query.filter(db.Spawnpoint.lat.between(bounds.south, bounds.north),
-                                 db.Spawnpoint.lon.between(bounds.west, bounds.east))
-            known = {}
+            Spawnpoint = db.Spawnpoint
+            query = session.query(Spawnpoint.id, Spawnpoint.spawn_id, Spawnpoint.lat,
+                                  Spawnpoint.lon, Spawnpoint.updated, Spawnpoint.despawn_time,
+                                  Spawnpoint.duration, Spawnpoint.failures)
+            query = query.filter(Spawnpoint.lat.between(bounds.south, bounds.north),
+                                 Spawnpoint.lon.between(bounds.west, bounds.east))
+            if not initial:
+                query = query.filter(Spawnpoint.updated > self.watermark - self.WATERMARK_OVERLAP)
+            with self.lock:
+                deleted = self.pending_delete.copy()
             for spawn in query:
                 point = spawn.lat, spawn.lon
 
                 # skip if point is not within boundaries (if applicable)
-                if bound and point not in bounds:
+                if spawn.spawn_id in deleted or (bound and point not in bounds):
                     continue
 
-                if not spawn.updated or spawn.updated <= last_migration:
+                self.load(spawn)
+                changed += 1
+                if spawn.updated and spawn.updated > watermark:
+                    watermark = spawn.updated
+
+                if not spawn.updated or spawn.updated <= last_migration or spawn.despawn_time is None:
                     self.unknown.add(point)
                     continue
 
-                if spawn.despawn_time is not None:
-                    if spawn.duration == 60:
-                        spawn_time = spawn.despawn_time
-                    else:
-                        spawn_time = (spawn.despawn_time + 1800) % 3600
-                    self.despawn_times[spawn.spawn_id] = spawn.despawn_time
-                    known[point] = spawn.spawn_id, spawn_time
+                if spawn.duration == 60:
+                    spawn_time = spawn.despawn_time
                 else:
-                    self.unknown.add(point)
-
-                self.updated_at[spawn.spawn_id] = spawn.updated
-                self.internal_ids[spawn.spawn_id] = spawn.id
-                self.failures[spawn.spawn_id] = spawn.failures if spawn.failures is not None else 0
-
-            self.log.info('Preloaded {} known spawnpoints', len(known))
+                    spawn_time = (spawn.despawn_time + 1800) % 3600
+                self.despawn_times[spawn.spawn_id] = spawn.despawn_time
+                self.points[spawn.spawn_id] = point
+                self.unknown.discard(point)
+                entries[point] = spawn.spawn_id, spawn_time
+
+        # known is read and added to by other threads, so the new one is
+        # built from a copy and replaced at once
+        with self.lock:
+            tombstones, self.tombstones = self.tombstones, {}
+            known = self.known.copy()
+        for point, entry in entries.items():
+            if known.get(point) != entry:
+                known[point] = entry
+                resort = True
+        for spawn_id, unknown in tombstones.items():
+            point = self.points.pop(spawn_id, None)
+            if point is None:
+                continue
+            known.pop(point, None)
+            if unknown:
+                self.unknown.add(point)
+
+        self.watermark = watermark
+        if resort:
+            # mostly sorted already, so this is close to linear
+            known = OrderedDict(sorted(known.items(), key=spawn_seconds))
+        with self.lock:
+            for point in self.placeholders:
+                known.setdefault(point, None)
+            self.placeholders.clear()
+            self.known = known
+        if initial:
+            self.log.info('Preloaded {} known spawnpoints', len(self.known))
             self.log.info('Preloaded {} unknown spawnpoints', len(self.unknown))
-        self.known = OrderedDict(sorted(known.items(), key=lambda k: k[1][1]))
+        else:
+            self.log.info('Loaded {} changed spawnpoints, {} tombstoned', changed, len(tombstones))
+
+    def load(self, spawnpoint):
+        """Take the state of a spawnpoint row, unless it has unsaved changes"""
+        spawn_id = spawnpoint.spawn_id
+        self.internal_ids[spawn_id] = spawnpoint.id
+        self.durations[spawn_id] = spawnpoint.duration
+        if spawn_id in self.pending_unknown:
+            self.updated_at[spawn_id] = 0
+            self.failures[spawn_id] = 0
+        elif spawn_id not in self.dirty:
+            self.updated_at[spawn_id] = spawnpoint.updated
+            self.failures[spawn_id] = spawnpoint.failures or 0
+
+    def mark_dirty(self, spawn_id):
+        with self.lock:
+            self.dirty.add(spawn_id)
+
+    def touch(self, spawn_id, now):
+        self.updated_at[spawn_id] = now
+        self.mark_dirty(spawn_id)
+
+    def set_failures(self, spawn_id, failures):
+        if self.failures.get(spawn_id) != failures:
+            self.failures[spawn_id] = failures
+            self.mark_dirty(spawn_id)
+
+    def set_duration(self, spawn_id, duration):
+        if self.durations.get(spawn_id) != duration:
+            self.durations[spawn_id] = duration
+            self.mark_dirty(spawn_id)
+
+    def mark_unknown(self, spawn_id):
+        """Forget the spawn time, the row is reset at the next flush"""
+        self.remove_known(spawn_id)
+        with self.lock:
+            self.pending_unknown.add(spawn_id)
+            self.tombstones[spawn_id] = True
+
+    def mark_deleted(self, spawn_id):
+        """Forget the spawnpoint, the row is deleted at the next flush"""
+        self.remove_known(spawn_id)
+        with self.lock:
+            self.pending_delete.add(spawn_id)
+            self.tombstones[spawn_id] = False
+
+    def revive(self, spawn_id):
+        """Cancel a pending transition of a spawnpoint that was seen again"""
+        with self.lock:
+            self.pending_unknown.discard(spawn_id)
+            if spawn_id in self.pending_delete:
+                self.pending_delete.discard(spawn_id)
+                # its row is kept, it must be read again rather than inserted
+                if spawn_id in self.internal_ids and self.internal_ids[spawn_id] is None:
+                    del self.internal_ids[spawn_id]
+            self.tombstones.pop(spawn_id, None)
+
+    def flush(self, session):
+        """Save the spawnpoint changes made since the last flush, with one
+        bulk statement per kind of change"""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            unknown, self.pending_unknown = self.pending_unknown, set()
+            deleted, self.pending_delete = self.pending_delete, set()
+        rows = [{'spawn': spawn_id,
+                 'updated_': self.updated_at[spawn_id],
+                 'failures_': self.failures.get(spawn_id, 0),
+                 'duration_': self.durations.get(spawn_id)}
+                for spawn_id in dirty
+                if self.internal_ids.get(spawn_id) and spawn_id in self.updated_at]
+        table = db.Spawnpoint.__table__
+        try:
+            if rows:
+                session.execute(table.update()
+                    .where(table.c.spawn_id == bindparam('spawn'))
+                    .values(updated=bindparam('updated_'),
+                            failures=bindparam('failures_'),
+                            duration=bindparam('duration_')),
+                    rows)
+            for spawn_ids in db.chunks(unknown):
+                session.execute(table.update()
+                    .where(table.c.spawn_id.in_(spawn_ids))
+                    .values(updated=0, failures=0))
+            for spawn_ids in db.chunks(deleted):
+                session.execute(table.delete()
+                    .where(table.c.spawn_id.in_(spawn_ids)))
+            session.commit()
+        except Exception:
+            session.rollback()
+            with self.lock:
+                self.dirty.update(dirty)
+                self.pending_unknown.update(unknown)
+                self.pending_delete.update(deleted)
+            raise
+        return len(rows) + len(unknown) + len(deleted)
 
     def after_last(self):
         try:
@@ -100,28 +265,80 @@ class BaseSpawns:
 
     def unpickle(self):
         try:
-            state = load_pickle('spawns', raise_exception=True)
-            if all((state['class_version'] == self.class_version,
-                    state['db_hash'] == self.db_hash,
-                    state['bounds_hash'] == hash(bounds),
-                    state['last_migration'] == conf.LAST_MIGRATION)):
-                self.__dict__.update(state)
-                return True
-            else:
+            with snapshot.load('spawns') as snap:
+                if snap.matches(self.class_version, self.db_hash):
+                    self.restore(snap)
+                    return True
                 self.log.warning('Configuration changed, reloading spawns from DB.')
         except FileNotFoundError:
-            self.log.warning('No spawns pickle found, will create one.')
-        except (TypeError, KeyError):
-            self.log.warning('Obsolete or invalid spawns pickle type, reloading from DB.')
+            self.log.warning('No spawns snapshot found, will create one.')
+        except (ValueError, KeyError):
+            self.log.warning('Obsolete or invalid spawns snapshot, reloading from DB.')
         return False
 
+    def restore(self, snap):
+        """Take the state saved by pickle from a spawns snapshot"""
+        spawn_ids = snap['spawn_id']
+        self.internal_ids = snapshot.restore(spawn_ids, snap['internal_id'])
+        self.updated_at = snapshot.restore(spawn_ids, snap['updated'])
+        self.failures = snapshot.restore(spawn_ids, snap['failures'])
+        self.durations = snapshot.restore(spawn_ids, snap['duration'])
+        self.despawn_times = snapshot.restore(spawn_ids, snap['despawn_time'])
+        self.points = {spawn_id: point for spawn_id, point
+                       in zip(spawn_ids, zip(snap['lat'], snap['lon']))
+                       if not isnan(point[0])}
+        self.known = OrderedDict(
+            (point, None if seconds == snapshot.NULL else (spawn_id, seconds))
+            for point, spawn_id, seconds in zip(zip(snap['known_lat'], snap['known_lon']),
+                                                snap['known_spawn_id'], snap['known_seconds']))
+        self.unknown = set(zip(snap['unknown_lat'], snap['unknown_lon']))
+        self.spawn_timestamps = dict(zip(snap['timestamp_spawn_id'], snap['timestamp']))
+        self.tombstones = {spawn_id: bool(unknown) for spawn_id, unknown
+                           in zip(snap['tombstone_spawn_id'], snap['tombstone_unknown'])}
+        self.watermark = snap.meta['watermark']
+
+    def sections(self):
+        """(name, array) of the state saved in the spawns snapshot"""
+        # the DB processors change the containers meanwhile, they are copied
+        # at once and the arrays built from the copies
+        with self.lock:
+            internal_ids = self.internal_ids.copy()
+            updated_at = self.updated_at.copy()
+            failures = self.failures.copy()
+            durations = self.durations.copy()
+            despawn_times = self.despawn_times.copy()
+            points = self.points.copy()
+            unknown = list(self.unknown)
+            timestamps = list(self.spawn_timestamps.items())
+            known = list(self.known.items())
+            tombstones = list(self.tombstones.items())
+        spawn_ids = sorted(set(chain(internal_ids, updated_at, failures,
+                                     durations, despawn_times, points)))
+        return [
+            ('spawn_id', array('q', spawn_ids)),
+            ('internal_id', snapshot.column('q', spawn_ids, internal_ids)),
+            ('updated', snapshot.column('q', spawn_ids, updated_at)),
+            ('failures', snapshot.column('h', spawn_ids, failures)),
+            ('duration', snapshot.column('h', spawn_ids, durations)),
+            ('despawn_time', snapshot.column('h', spawn_ids, despawn_times)),
+            ('lat', snapshot.column('d', spawn_ids, {k: p[0] for k, p in points.items()})),
+            ('lon', snapshot.column('d', spawn_ids, {k: p[1] for k, p in points.items()})),
+            ('known_lat', array('d', (point[0] for point, _ in known))),
+            ('known_lon', array('d', (point[1] for point, _ in known))),
+            ('known_spawn_id', array('q', (entry[0] if entry else 0 for _, entry in known))),
+            ('known_seconds', array('h', (entry[1] if entry else snapshot.NULL for _, entry in known))),
+            ('unknown_lat', array('d', (point[0] for point in unknown))),
+            ('unknown_lon', array('d', (point[1] for point in unknown))),
+            ('timestamp_spawn_id', array('q', (spawn_id for spawn_id, _ in timestamps))),
+            ('timestamp', array('q', (timestamp for _, timestamp in timestamps))),
+            ('tombstone_spawn_id', array('q', (spawn_id for spawn_id, _ in tombstones))),
+            ('tombstone_unknown', array('b', (unknown for _, unknown in tombstones))),
+        ]
+
     def pickle(self):
-        state = self.__dict__.copy()
-        del state['log']
-        state.pop('cells_count', None)
-        state['bounds_hash'] = hash(bounds)
-        state['last_migration'] = conf.LAST_MIGRATION
-        dump_pickle('spawns', state)
+        snapshot.dump('spawns',
+                      snapshot.checked_meta(self.class_version, self.db_hash, watermark=self.watermark),
+                      self.sections())
 
     def remove_known(self, spawn_id):
         if spawn_id in self.despawn_times:
@@ -134,6 +351,10 @@ class BaseSpawns:
             del self.internal_ids[spawn_id]
         if spawn_id in self.spawn_timestamps:
             del self.spawn_timestamps[spawn_id]
+        if spawn_id in self.durations:
+            del self.durations[spawn_id]
+        with self.lock:
+            self.dirty.discard(spawn_id)
 
 
     @property
@@ -157,14 +378,6 @@ class Spawns(BaseSpawns):
     def add_unknown(self, point):
         self.unknown.add(point)
 
-    def unpickle(self):
-        result = super().unpickle()
-        try:
-            del self.cell_points
-        except AttributeError:
-            pass
-        return result
-
     def mystery_gen(self):
         for mystery in self.unknown.copy():
             yield mystery
@@ -181,13 +394,17 @@ class MoreSpawns(BaseSpawns):
 
     def items(self):
         # return a copy since it may be modified
-        return self.known.copy().items()
+        with self.lock:
+            return self.known.copy().items()
 
     def add_known(self, spawn_id, despawn_time, point):
         self.despawn_times[spawn_id] = despawn_time
         self.failures[spawn_id] = 0
         # add so that have_point() will be up to date
-        self.known[point] = None
+        with self.lock:
+            if point not in self.known:
+                self.known[point] = None
+                self.placeholders.add(point)
         self.unknown.discard(point)
         self.cell_points.discard(point)
         if point in self.have_point_cache:
@@ -212,6 +429,19 @@ class MoreSpawns(BaseSpawns):
         if point in self.have_point_cache:
             del self.have_point_cache[point]
 
+    def restore(self, snap):
+        super().restore(snap)
+        if 'cell_lat' in snap:
+            self.cell_points = set(zip(snap['cell_lat'], snap['cell_lon']))
+
+    def sections(self):
+        with self.lock:
+            cell_points = list(self.cell_points)
+        return super().sections() + [
+            ('cell_lat', array('d', (point[0] for point in cell_points))),
+            ('cell_lon', array('d', (point[1] for point in cell_points))),
+        ]
+
     def mystery_gen(self):
         for mystery in chain(self.unknown.copy(), self.cell_points.copy()):
             yield mystery
@@ -1,7 +1,7 @@
 import random
 import socket
 
-from os import mkdir
+from os import mkdir, replace
 from os.path import join, exists
 from sys import platform
 from asyncio import sleep, Semaphore
@@ -209,8 +209,9 @@ def dump_pickle(name, var):
         raise OSError("Failed to create 'pickles' folder, please create it manually") from e
 
     location = join(folder, '{}.pickle'.format(name))
-    with open(location, 'wb') as f:
+    with open(location + '.tmp', 'wb') as f:
         pickle_dump(var, f, HIGHEST_PROTOCOL)
+    replace(location + '.tmp', location)
 
 
 def randomize_point(point, amount=0.0003, randomize=uniform):
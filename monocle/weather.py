@@ -1,16 +1,29 @@
-from sqlalchemy import Column
+from sqlalchemy import Column, UniqueConstraint
 from sqlalchemy.types import Integer, BigInteger, Boolean, SmallInteger
+from threading import Lock
 from time import time
 from . import db, utils, sanitized as conf
+from .shared import get_logger
+
+log = get_logger(__name__)
 
 class WeatherCache:
     """Simple cache for storing actual weathers
 
-    It's used in order not to make as many queries to the database.
-    It schedules raids to be removed as soon as they expire.
+    It holds the latest state of every cell, and the cells whose state
+    still has to be written. Identical reports are ignored, except for
+    one every REFRESH seconds which bumps the updated column.
     """
+    REFRESH = 1800
+
     def __init__(self):
         self.store = {}
+        # {s2_cell_id: time of the last report that was queued}
+        self.reported = {}
+        # cells known to have a row
+        self.saved = set()
+        self.pending = {}
+        self.lock = Lock()
 
     def __len__(self):
         return len(self.store)
@@ -22,13 +35,22 @@ class WeatherCache:
             return None
 
     def add(self, weather):
-        self.store[weather['s2_cell_id']] = weather
+        """Keep weather as the latest state of its cell, and queue it to be
+        written unless it repeats a recent report"""
+        cell = weather['s2_cell_id']
+        now = time()
+        with self.lock:
+            if weather in self and self.reported.get(cell, 0) > now - self.REFRESH:
+                return
+            self.store[cell] = weather
+            self.reported[cell] = now
+            self.pending[cell] = weather
 
     def remove(self, cache_id):
-        try:
-            del self.store[cache_id]
-        except KeyError:
-            pass
+        with self.lock:
+            self.store.pop(cache_id, None)
+            self.reported.pop(cache_id, None)
+            self.pending.pop(cache_id, None)
 
     def __contains__(self, raw_weather):
         try:
@@ -40,6 +62,47 @@ class WeatherCache:
         except KeyError:
             return False
 
+    def take(self, new_only=False):
+        """Remove and return the pending states, or only those of cells
+        that have no row yet"""
+        with self.lock:
+            if new_only:
+                taken = {cell: weather for cell, weather in self.pending.items()
+                         if cell not in self.saved}
+                for cell in taken:
+                    del self.pending[cell]
+            else:
+                taken, self.pending = self.pending, {}
+            return taken
+
+    def restore(self, taken):
+        """Queue states that failed to be written again, unless a newer
+        report replaced them in the meantime"""
+        with self.lock:
+            for cell, weather in taken.items():
+                self.pending.setdefault(cell, weather)
+
+    def preload(self):
+        with db.session_scope() as session:
+            weathers = session.query(Weather.s2_cell_id, Weather.condition, Weather.alert_severity,
+                                     Weather.warn, Weather.day, Weather.updated)
+            for cell, condition, alert_severity, warn, day, updated in weathers:
+                with self.lock:
+                    self.saved.add(cell)
+                    # reported since the scan started
+                    if cell in self.store:
+                        continue
+                    self.store[cell] = {
+                        'type': 'weather',
+                        's2_cell_id': cell,
+                        'condition': condition,
+                        'alert_severity': alert_severity,
+                        'warn': warn,
+                        'day': day
+                    }
+                    self.reported[cell] = updated or 0
+        log.info("Preloaded {} weather cells", len(self))
+
 class Weather(db.Base):
     __tablename__ = 'weather'
 
@@ -51,6 +114,13 @@ class Weather(db.Base):
     day = Column(SmallInteger)
     updated = Column(Integer, default=time, onupdate=time)
 
+    __table_args__ = (
+        UniqueConstraint(
+            's2_cell_id',
+            name='weather_s2_cell_id_unique'
+        ),
+    )
+
     @classmethod
     def normalize_weather(self, raw, time_of_day):
         alert_severity = 0
@@ -70,30 +140,40 @@ class Weather(db.Base):
         }
 
     @classmethod
-    def add_weather(self, session, raw_weather):
-        s2_cell_id = raw_weather['s2_cell_id']
-    
-        weather = session.query(Weather) \
-            .filter(Weather.s2_cell_id == s2_cell_id) \
-            .with_for_update() \
-            .first()
-        if not weather:
-            weather = Weather(
-                s2_cell_id=s2_cell_id,
-                condition=raw_weather['condition'],
-                alert_severity=raw_weather['alert_severity'],
-                warn=raw_weather['warn'],
-                day=raw_weather['day'],
-                updated=int(time())
-            )
-            session.add(weather)
-        else:
-            weather.condition = raw_weather['condition']
-            weather.alert_severity = raw_weather['alert_severity']
-            weather.warn = raw_weather['warn']
-            weather.day = raw_weather['day']
-            weather.updated = int(time())
-        WEATHER_CACHE.add(raw_weather)
+    def row(cls, raw_weather, now):
+        return {
+            's2_cell_id': raw_weather['s2_cell_id'],
+            'condition': raw_weather['condition'],
+            'alert_severity': raw_weather['alert_severity'],
+            'warn': raw_weather['warn'],
+            'day': raw_weather['day'],
+            'updated': now
+        }
+
+    @classmethod
+    def add_weathers(cls, session, raw_weathers):
+        # only the latest report for each cell in a batch is worth writing
+        latest = {w['s2_cell_id']: w for w in raw_weathers}
+        now = int(time())
+        db.upsert(session, cls, [cls.row(w, now) for w in latest.values()],
+                  keys=('s2_cell_id',),
+                  update=('condition', 'alert_severity', 'warn', 'day', 'updated'))
+
+    @classmethod
+    def flush(cls, session, new_only=False):
+        """Write the weather states queued in WEATHER_CACHE, one row per cell"""
+        taken = WEATHER_CACHE.take(new_only)
+        if not taken:
+            return 0
+        try:
+            cls.add_weathers(session, list(taken.values()))
+            session.commit()
+        except Exception:
+            session.rollback()
+            WEATHER_CACHE.restore(taken)
+            raise
+        WEATHER_CACHE.saved.update(taken)
+        return len(taken)
 
     @classmethod
     def has_weather_changed(self, current_weather):
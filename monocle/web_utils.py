@@ -4,7 +4,7 @@ from multiprocessing.managers import BaseManager, RemoteError
 from time import time
 
 from monocle import sanitized as conf
-from monocle.db import get_forts, Pokestop, session_scope, Sighting, Spawnpoint, Raid, Fort, FortSighting
+from monocle.db import get_forts, Pokestop, session_scope, Sighting, Spawnpoint, Raid, Fort, FortState, STREAM_SIZE
 from monocle.weather import Weather
 from monocle.utils import Units, get_address, dump_pickle, load_pickle
 from monocle.names import DAMAGE, MOVES, POKEMON
@@ -153,14 +153,13 @@ def get_raid_markers(names=POKEMON, moves=MOVES):
             fort = session.query(Fort) \
                 .filter(Fort.id == raid.fort_id) \
                 .scalar()
-            fortsighting = session.query(FortSighting) \
-                .filter(FortSighting.fort_id == fort.id) \
-                .order_by(FortSighting.last_modified.desc()) \
-                .first()
+            team = session.query(FortState.team) \
+                .filter(FortState.fort_id == fort.id) \
+                .scalar()
             markers.append({
                 'id': 'raid-' + str(raid.id),
                 'level': raid.level,
-                'team': fortsighting.team,
+                'team': team,
                 'pokemon_id': raid.pokemon_id,
                 'pokemon_name': names[raid.pokemon_id],
                 'move1': moves[raid.move_1],
@@ -218,15 +217,19 @@ def get_gym_markers(names=POKEMON):
 
 
 def get_spawnpoint_markers():
+    """Yield the markers of every spawnpoint, streamed from the DB"""
     with session_scope() as session:
-        spawns = session.query(Spawnpoint)
-        return [{
-            'spawn_id': spawn.spawn_id,
-            'despawn_time': spawn.despawn_time,
-            'lat': spawn.lat,
-            'lon': spawn.lon,
-            'duration': spawn.duration
-        } for spawn in spawns]
+        spawns = session.query(Spawnpoint.spawn_id, Spawnpoint.despawn_time,
+                               Spawnpoint.lat, Spawnpoint.lon, Spawnpoint.duration) \
+            .yield_per(STREAM_SIZE)
+        for spawn in spawns:
+            yield {
+                'spawn_id': spawn.spawn_id,
+                'despawn_time': spawn.despawn_time,
+                'lat': spawn.lat,
+                'lon': spawn.lon,
+                'duration': spawn.duration
+            }
 
 if conf.BOUNDARIES:
     from shapely.geometry import mapping
@@ -19,7 +19,8 @@ from cyrandom import choice, randint, uniform
 from pogeo import get_distance
 
 from .db import FORT_CACHE, MYSTERY_CACHE, SIGHTING_CACHE, RAID_CACHE
-from .utils import round_coords, load_pickle, get_device_info, get_start_coords, Units, randomize_point, calc_pokemon_level
+from .snapshot import CellTable
+from .utils import round_coords, get_device_info, get_start_coords, Units, randomize_point, calc_pokemon_level
 from .shared import get_logger, LOOP, SessionManager, run_threaded, TtlCache
 from .sb import SbDetector, SbAccountException
 from .accounts import Account, get_accounts, InsufficientAccountsException, LoginCredentialsException, \
@@ -73,7 +74,7 @@ class Worker:
     log = get_logger("worker")
 
     if conf.CACHE_CELLS:
-        cells = load_pickle('cells') or {}
+        cells = CellTable()
 
         @classmethod
         def get_cell_ids(cls, point):
@@ -993,10 +994,7 @@ class Worker:
             for w in map_objects.client_weather:
                 weather = Weather.normalize_weather(w, map_objects.time_of_day)
                 weather_condition = weather['condition']
-                if weather not in WEATHER_CACHE:
-                    if conf.NOTIFY_WEATHER and Weather.has_weather_changed(weather):
-                        LOOP.create_task(self.notifier.webhook_weather(weather))
-                    db_proc.add(weather)
+                self.after_preload(self.update_weather, weather)
 
         for map_cell in map_objects.map_cells:
             request_time_ms = map_cell.current_timestamp_ms
@@ -1103,7 +1101,7 @@ class Worker:
                             encountered = await self.pgscout(session, normalized, pokemon.spawn_point_id)
 
                 if should_notify:
-                    LOOP.create_task(self.notifier.notify(normalized, normalized['time_of_day']))
+                    LOOP.create_task(self.notify(normalized))
 
                 db_proc.add(normalized)
 
@@ -1158,7 +1156,10 @@ class Worker:
 
                     self.overseer.WorkerRaider.add_gym(normalized_fort)
 
-                    if (scan_gym_external_id or not self.has_raiders) and fort not in FORT_CACHE:
+                    # whether the gym changed, known once the caches are preloaded
+                    check_gym = (scan_gym_external_id or not self.has_raiders)
+                    preloaded = self.notifier.preloaded.is_set()
+                    if check_gym and preloaded and fort not in FORT_CACHE:
                         should_update_gym = True
 
                     if (is_target_gym or
@@ -1175,27 +1176,12 @@ class Worker:
                                 self.log.info('Got gym info for {}', normalized_fort["name"])
 
                     if should_update_gym:
-                        db_proc.add(normalized_fort)
-
-                        if conf.NOTIFY_GYMS_WEBHOOK:
-                            LOOP.create_task(self.notifier.webhook_gym(gym))
+                        self.update_gym(normalized_fort, gym)
+                    elif check_gym and not preloaded:
+                        self.after_preload(self.update_gym, normalized_fort, gym, fort)
 
                     if fort.HasField('raid_info'):
-                        if fort not in RAID_CACHE:
-                            if WEATHER_CACHE[fort_weather_cell] != None:
-                                weather_cond = WEATHER_CACHE[fort_weather_cell]['condition']
-                            else:
-                                weather_cond = 0
-                            normalized_raid = self.normalize_raid(fort, weather_cond)
-                            RAID_CACHE.add(normalized_raid)
-                            if normalized_raid['time_end'] > int(time()):
-                                normalized_fort["park"] = FORT_CACHE.park.get(fort.id) if FORT_CACHE.park.get(fort.id) \
-                                    else ""
-                                if conf.NOTIFY_RAIDS:
-                                    LOOP.create_task(self.notifier.notify_raid(normalized_raid, normalized_fort))
-                                if conf.NOTIFY_RAIDS_WEBHOOK:
-                                    LOOP.create_task(self.notifier.webhook_raid(normalized_raid, normalized_fort))
-                            db_proc.add(normalized_raid)
+                        self.after_preload(self.update_raid, fort, normalized_fort, fort_weather_cell)
 
             if more_points and (map_cell.s2_cell_id not in self.more_point_cell_cache):
                 self.more_point_cell_cache.add(map_cell.s2_cell_id)
@@ -1312,7 +1298,7 @@ class Worker:
 
         should_notify = self.should_notify(sighting)
         if should_notify:
-            LOOP.create_task(self.notifier.notify(sighting, sighting['time_of_day']))
+            LOOP.create_task(self.notify(sighting))
 
         db_proc.add(sighting)
         self.last_gmo = self.last_request
@@ -1328,6 +1314,60 @@ class Worker:
         self.handle = LOOP.call_later(60, self.unset_code)
         return 1 
 
+    def after_preload(self, handler, *args):
+        """Call handler now if the caches are preloaded, once they are
+        otherwise, scanning goes on meanwhile"""
+        if self.notifier.preloaded.is_set():
+            handler(*args)
+        else:
+            LOOP.create_task(self.held(handler, args))
+
+    async def held(self, handler, args):
+        await self.notifier.preloaded.wait()
+        handler(*args)
+
+    def update_weather(self, weather):
+        if weather not in WEATHER_CACHE:
+            if conf.NOTIFY_WEATHER and Weather.has_weather_changed(weather):
+                LOOP.create_task(self.notifier.webhook_weather(weather))
+        # written by the DB processor along with other changes
+        WEATHER_CACHE.add(weather)
+
+    def update_gym(self, normalized_fort, gym, raw_fort=None):
+        """Save a gym, unless raw_fort is given and it didn't change"""
+        if raw_fort is not None and raw_fort in FORT_CACHE:
+            return
+        db_proc.add(normalized_fort)
+        if conf.NOTIFY_GYMS_WEBHOOK:
+            LOOP.create_task(self.notifier.webhook_gym(gym))
+
+    def update_raid(self, fort, normalized_fort, fort_weather_cell):
+        if fort in RAID_CACHE:
+            return
+        if WEATHER_CACHE[fort_weather_cell] != None:
+            weather_cond = WEATHER_CACHE[fort_weather_cell]['condition']
+        else:
+            weather_cond = 0
+        normalized_raid = self.normalize_raid(fort, weather_cond)
+        RAID_CACHE.add(normalized_raid)
+        if normalized_raid['time_end'] > int(time()):
+            normalized_fort["park"] = FORT_CACHE.park.get(fort.id) if FORT_CACHE.park.get(fort.id) \
+                else ""
+            if conf.NOTIFY_RAIDS:
+                LOOP.create_task(self.notifier.notify_raid(normalized_raid, normalized_fort))
+            if conf.NOTIFY_RAIDS_WEBHOOK:
+                LOOP.create_task(self.notifier.webhook_raid(normalized_raid, normalized_fort))
+        db_proc.add(normalized_raid)
+
+    async def notify(self, sighting):
+        """Notify sighting once the caches are preloaded, unless the preload
+        found it was already known"""
+        await self.notifier.preloaded.wait()
+        if (SIGHTING_CACHE.preexisting(sighting) or
+                self.overseer.ENCOUNTER_CACHE.preexisting(sighting)):
+            return False
+        return await self.notifier.notify(sighting, sighting['time_of_day'])
+
     def should_skip_sighting(self, sighting, cache):
         # Check if already marked for save as sighting
         if sighting in cache:
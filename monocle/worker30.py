@@ -245,38 +245,35 @@ class Worker30(Worker):
 class EncounterCache(SightingCache):
     """Simple cache for storing encountered sightings
     """
-    def __contains__(self, raw_sighting):
-        try:
-            return (self.store[raw_sighting['encounter_id']] is not None)
-        except KeyError:
-            return False
-
     # Preloading from db
     def preload(self):
+        now = int(time())
         with session_scope() as session:
-            sightings = session.query(Sighting) \
+            columns = (Sighting.encounter_id, Sighting.spawn_id, Sighting.expire_timestamp)
+            sightings = session.query(*columns) \
                 .join(Sighting.spawnpoint) \
-                .filter(Sighting.expire_timestamp >= time()) \
+                .filter(Sighting.expire_timestamp >= now) \
                 .filter(Sighting.atk_iv != None) \
                 .filter(Spawnpoint.lat.between(bounds.south - 0.015, bounds.north + 0.015),
                         Spawnpoint.lon.between(bounds.west - 0.015, bounds.east + 0.015))
 
-            sightings_lured = session.query(Sighting) \
+            sightings_lured = session.query(*columns) \
                 .filter(Sighting.spawn_id == 0) \
                 .filter(Sighting.atk_iv != None) \
-                .filter(Sighting.expire_timestamp >= time()) \
+                .filter(Sighting.expire_timestamp >= now) \
                 .filter(Sighting.lat.between(bounds.south - 0.015, bounds.north + 0.015),
                         Sighting.lon.between(bounds.west - 0.015, bounds.east + 0.015))
 
             sightings = sightings.union(sightings_lured)
 
-            for sighting in sightings:
-                obj = {
-                    'encounter_id': sighting.encounter_id,
-                    'spawn_id': sighting.spawn_id,
-                    'expire_timestamp': sighting.expire_timestamp,
-                }
-                self.add(obj)
-            log.info("Preloaded {} encountered sightings", sightings.count())
+            count = 0
+            for encounter_id, spawn_id, expire_timestamp in sightings:
+                self.add({
+                    'encounter_id': encounter_id,
+                    'spawn_id': spawn_id,
+                    'expire_timestamp': expire_timestamp,
+                })
+                count += 1
+            log.info("Preloaded {} encountered sightings", count)
 
 ENCOUNTER_CACHE = EncounterCache()
@@ -4,14 +4,13 @@ from queue import PriorityQueue
 from time import time, monotonic
 from random import random
 from asyncio import CancelledError, Semaphore, sleep
-from sqlalchemy import desc
-from sqlalchemy.orm import joinedload
+from sqlalchemy import and_, desc, func
 
 
-from .db import Fort, FortSighting, GymDefender, Raid, session_scope, get_fort_internal_id, FORT_CACHE
+from .db import Fort, FortSighting, FortState, GymDefender, Raid, session_scope, get_fort_internal_id, FORT_CACHE
 from .utils import randomize_point
 from .worker import Worker, UNIT
-from .shared import LOOP, call_at, get_logger
+from .shared import LOOP, call_at, get_logger, run_threaded
 from .accounts import Account
 from . import bounds, sanitized as conf
 
@@ -54,29 +53,32 @@ class WorkerRaider(Worker):
     def preload(self):
         log.info("Preloading forts")
         with session_scope() as session:
-            forts = session.query(Fort) \
-                .options(joinedload(Fort.sightings)) \
+            # the first sighting of each fort, by last_modified
+            first = session.query(FortSighting.fort_id,
+                                  func.min(FortSighting.last_modified).label('last_modified')) \
+                .group_by(FortSighting.fort_id) \
+                .subquery()
+            forts = session.query(Fort.id, Fort.external_id, Fort.lat, Fort.lon, Fort.name, Fort.url,
+                                  first.c.last_modified, FortSighting.updated) \
+                .outerjoin(first, first.c.fort_id == Fort.id) \
+                .outerjoin(FortSighting, and_(FortSighting.fort_id == Fort.id,
+                                              FortSighting.last_modified == first.c.last_modified)) \
                 .filter(Fort.lat.between(bounds.south, bounds.north),
                         Fort.lon.between(bounds.west, bounds.east))
             try:
                 for fort in forts:
                     if (fort.lat, fort.lon) not in bounds:
                         continue
-                    obj = {
+                    self.add_gym({
                         'id': fort.id,
                         'external_id': fort.external_id,
                         'lat': fort.lat,
                         'lon': fort.lon,
                         'name': fort.name,
                         'url': fort.url,
-                        'last_modified': 0,
-                        'updated': 0,
-                    }
-                    if len(fort.sightings) > 0:
-                        sighting = fort.sightings[0]
-                        obj['last_modified'] = sighting.last_modified or 0
-                        obj['updated'] = sighting.updated or 0
-                    self.add_gym(obj)
+                        'last_modified': fort.last_modified or 0,
+                        'updated': fort.updated or 0,
+                    })
             except Exception as e:
                 log.error("ERROR: {}", e)
             log.info("Loaded {} forts", self.job_queue.qsize())
@@ -117,6 +119,7 @@ class WorkerRaider(Worker):
             session.query(GymDefender).filter(GymDefender.fort_id==fort_id).delete()
             session.query(Raid).filter(Raid.fort_id==fort_id).delete()
             session.query(FortSighting).filter(FortSighting.fort_id==fort_id).delete()
+            session.query(FortState).filter(FortState.fort_id==fort_id).delete()
             session.query(Fort).filter(Fort.id==fort_id).delete()
 
             del self.gyms[external_id]
@@ -126,7 +129,7 @@ class WorkerRaider(Worker):
     @classmethod
     async def launch(self, overseer):
         self.overseer = overseer
-        self.preload()
+        await run_threaded(self.preload)
         try:
             await sleep(5)
             log.info("Couroutine launched.")
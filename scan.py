@@ -162,11 +162,11 @@ def cleanup(overseer, manager):
         FORT_CACHE.pickle()
         altitudes.pickle()
         if conf.CACHE_CELLS:
-            dump_pickle('cells', Worker.cells)
+            Worker.cells.dump()
 
         spawns.pickle()
-        while not db_proc.queue.empty():
-            pending = db_proc.queue.qsize()
+        while db_proc.is_alive():
+            pending = len(db_proc)
             # Spaces at the end are important, as they clear previously printed
             # output - \r doesn't clean whole line
             print('{} DB items pending     '.format(pending), end='\r')
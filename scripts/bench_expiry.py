@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Compare a loop timer per cache entry with the shared expiry wheel.
+
+Schedules the removal of --entries live entries both ways, then measures
+how fast the event loop still spins, and how long it takes to expire a
+second batch of entries that are all due within a few seconds.
+"""
+
+import sys
+import tracemalloc
+
+from pathlib import Path
+from argparse import ArgumentParser
+from asyncio import sleep
+from random import Random
+from time import time, perf_counter
+
+monocle_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(monocle_dir))
+
+from monocle.shared import LOOP, ExpiryWheel, call_at
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--entries',
+        type=int,
+        default=500000,
+        help='Number of live entries, due within the next hour.'
+    )
+    parser.add_argument(
+        '--expiring',
+        type=int,
+        default=100000,
+        help='Number of entries due within the next few seconds.'
+    )
+    parser.add_argument(
+        '--seconds',
+        type=float,
+        default=3.0,
+        help='Seconds the loop spins for while measuring.'
+    )
+    parser.add_argument(
+        '--memory',
+        action='store_true',
+        help='Trace the memory used by the scheduled entries, slows scheduling down.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='Seed of the due times.'
+    )
+    return parser.parse_args()
+
+
+async def spin(seconds):
+    """Iterations of the loop per second, and the longest iteration in ms"""
+    iterations = 0
+    longest = 0
+    end = perf_counter() + seconds
+    last = perf_counter()
+    while last < end:
+        await sleep(0)
+        now = perf_counter()
+        longest = max(longest, now - last)
+        last = now
+        iterations += 1
+    return iterations / seconds, longest * 1000
+
+
+async def drain(store, timeout=30):
+    """Seconds until store is empty"""
+    start = perf_counter()
+    while store and perf_counter() - start < timeout:
+        await sleep(0.05)
+    return perf_counter() - start
+
+
+def run(name, schedule, args):
+    rng = Random(args.seed)
+    store = set()
+    now = time()
+
+    if args.memory:
+        tracemalloc.start()
+    start = perf_counter()
+    for i in range(args.entries):
+        schedule(now + 3000 + rng.random() * 600, store.discard, i)
+    # the timers scheduled from threads are only added by the loop
+    LOOP.run_until_complete(sleep(0))
+    scheduling = perf_counter() - start
+    memory = float('nan')
+    if args.memory:
+        memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+
+    rate, longest = LOOP.run_until_complete(spin(args.seconds))
+
+    now = time()
+    for i in range(args.expiring):
+        key = -i - 1
+        store.add(key)
+        schedule(now + 1 + rng.random() * 2, store.discard, key)
+    expiring = LOOP.run_until_complete(drain(store))
+    return name, scheduling, memory, rate, longest, expiring
+
+
+def main():
+    args = parse_args()
+    wheel = ExpiryWheel()
+    # the wheel first, the loop keeps the timers of the other run
+    results = [
+        run('expiry wheel', wheel.call_at, args),
+        run('timer per entry', call_at, args),
+    ]
+    print('{} live entries, {} expiring'.format(args.entries, args.expiring))
+    print('{:<16} {:>12} {:>12} {:>14} {:>14} {:>12}'.format(
+        '', 'schedule (s)', 'memory (MB)', 'iterations/s', 'longest (ms)', 'expire (s)'))
+    for result in results:
+        print('{:<16} {:>12.3f} {:>12.1f} {:>14.0f} {:>14.3f} {:>12.3f}'.format(*result))
+
+
+if __name__ == '__main__':
+    main()
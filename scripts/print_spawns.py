@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 
-from pickle import load
+import sys
+
 from pprint import PrettyPrinter
 from pathlib import Path
 
-pickle_path = Path(__file__).resolve().parents[1] / 'pickles' / 'spawns.pickle'
+monocle_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(monocle_dir))
+
+from monocle.snapshot import Snapshot
+
+snapshot_path = monocle_dir / 'pickles' / 'spawns.snapshot'
 
-with pickle_path.open('rb') as f:
-    spawns = load(f)
+with Snapshot(str(snapshot_path)) as snapshot:
+    spawns = {'meta': snapshot.meta}
+    for name in snapshot.sections:
+        spawns[name] = snapshot[name].tolist()
 
 pp = PrettyPrinter(indent=3)
 pp.pprint(spawns)
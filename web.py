@@ -11,7 +11,7 @@ try:
 except ImportError:
     from json import dumps
 
-from flask import Flask, jsonify, Markup, render_template, request, make_response
+from flask import Flask, Response, jsonify, Markup, render_template, request, make_response
 
 from monocle import db, sanitized as conf
 from monocle.names import POKEMON
@@ -55,6 +55,22 @@ def social_links():
     return Markup(social_links)
 
 
+def json_stream(items, chunk=1000):
+    """Yield a JSON array of items a chunk of items at a time"""
+    yield '['
+    buffer = []
+    separator = ''
+    for item in items:
+        buffer.append(dumps(item))
+        if len(buffer) >= chunk:
+            yield separator + ','.join(buffer)
+            separator = ','
+            buffer = []
+    if buffer:
+        yield separator + ','.join(buffer)
+    yield ']'
+
+
 def render_map():
     css_js = ''
 
@@ -127,7 +143,7 @@ def gym_data():
 @app.route('/spawnpoints')
 @auth_required
 def spawn_points():
-    return jsonify(get_spawnpoint_markers())
+    return Response(json_stream(get_spawnpoint_markers()), mimetype='application/json')
 
 
 @app.route('/pokestops')
@@ -255,8 +271,12 @@ def report_single(pokemon_id,
 @auth_required
 def report_heatmap():
     pokemon_id = request.args.get('id')
-    with db.session_scope() as session:
-        return dumps(db.get_all_spawn_coords(session, pokemon_id=pokemon_id))
+
+    def coords():
+        with db.session_scope() as session:
+            yield from db.get_all_spawn_coords(session, pokemon_id=pokemon_id)
+    # served as text, the page parses it
+    return Response(json_stream(coords()))
 
 
 def main():
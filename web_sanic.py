@@ -111,19 +111,14 @@ async def gym_data(request, names=POKEMON, _str=str):
         results = await conn.fetch('''
             SELECT
                 fs.fort_id,
-                fs.id,
+                fs.sighting_id AS id,
                 fs.team,
                 fs.guard_pokemon_id,
                 fs.last_modified,
                 f.lat,
                 f.lon
-            FROM fort_sightings fs
+            FROM fort_state fs
             JOIN forts f ON f.id=fs.fort_id
-            WHERE (fs.fort_id, fs.last_modified) IN (
-                SELECT fort_id, MAX(last_modified)
-                FROM fort_sightings
-                GROUP BY fort_id
-            )
         ''')
     return json([{
             'id': 'fort-' + _str(fort['fort_id']),